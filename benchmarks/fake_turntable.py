@@ -0,0 +1,813 @@
+#!/usr/bin/env python
+"""A local stand-in for turntable's chat servers, for load testing LazySusan.
+
+The server speaks the subset of the turntable websocket protocol that ttapi
+and LazySusan use, and hosts a single room (which answers to any room id)
+full of simulated users that join, leave, chat, pm the bot, vote and step up
+to the dj table. Activity rates can be scripted in phases, delivered in
+bursts, and the frames sent to the bot can be delayed and dropped. The
+server reports the bot's requests and the latency of its replies to pmmed
+commands every few seconds.
+
+Point a bot at the server with its `chat_server` option, as in the
+[loadtest] section of lazysusan-sample.ini, and start the server first:
+
+    python benchmarks/fake_turntable.py --listeners 5000 --chat-rate 50
+    lazysusan -c loadtest
+
+A script is a JSON list of phases, each a dictionary of the rate options
+below (using underscores) plus a `duration` in seconds. Options a phase does
+not set keep their command line values. The server exits after the last
+phase unless it has no duration.
+
+"""
+
+from __future__ import print_function
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from optparse import OptionParser
+
+COMMANDS = ('/about', '/commands', '/help /pllist', '/pllist', '/playlists',
+            '/theme', '/uptime')
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PAGE_SIZE = 20  # Rooms per room.list_rooms response
+PM_COMMANDS = ('/about', '/commands', '/uptime')  # Always answered by pm
+RATES = ('chat_rate', 'command_fraction', 'dj_rate', 'join_rate',
+         'leave_rate', 'pm_rate', 'vote_rate', 'burst', 'song_length')
+WORDS = ('nice', 'track', 'who', 'is', 'this', 'love', 'it', 'awesome', 'bop',
+         'lol', 'next', 'song', 'please', 'that', 'bass', 'drop', 'great')
+
+
+def percentile(values, percent):
+    """Return the percentile of a sorted list of values."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class WebSocket(object):
+
+    """The server side of a websocket connection, as described by RFC 6455.
+
+    Only unfragmented text messages are sent, and the pings and close frames
+    the client sends are answered.
+
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def _read(self, count):
+        """Return the next count bytes received."""
+        while len(self._buffer) < count:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError('Connection closed')
+            self._buffer += data
+        data, self._buffer = self._buffer[:count], self._buffer[count:]
+        return data
+
+    def _send_frame(self, opcode, payload):
+        """Send a single unmasked frame."""
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._lock:
+            self.sock.sendall(header + payload)
+
+    def close(self):
+        """Send a close frame and close the socket."""
+        try:
+            self._send_frame(0x8, '')
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def handshake(self):
+        """Read the client's upgrade request and accept it."""
+        while '\r\n\r\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError('Connection closed during the handshake')
+            self._buffer += data
+        request, self._buffer = self._buffer.split('\r\n\r\n', 1)
+        lines = (x.partition(':') for x in request.split('\r\n')[1:])
+        headers = dict((name.strip().lower(), value.strip())
+                       for name, _, value in lines)
+        accept = base64.b64encode(hashlib.sha1(
+            headers['sec-websocket-key'] + GUID).digest())
+        self.sock.sendall('HTTP/1.1 101 Switching Protocols\r\n'
+                          'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                          'Sec-WebSocket-Accept: {0}\r\n\r\n'.format(accept))
+
+    def recv(self):
+        """Return the next text message, or None when the client closes."""
+        fragments = []
+        while True:
+            first, second = struct.unpack('!BB', self._read(2))
+            opcode = first & 0x0f
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read(8))[0]
+            mask = bytearray(self._read(4)) if second & 0x80 else None
+            payload = bytearray(self._read(length))
+            if mask:
+                for index in xrange(length):
+                    payload[index] ^= mask[index % 4]
+            if opcode == 0x8:
+                return None
+            elif opcode == 0x9:
+                self._send_frame(0xa, str(payload))
+            elif opcode in (0x0, 0x1):
+                fragments.append(str(payload))
+                if first & 0x80:
+                    return ''.join(fragments).decode('utf-8')
+
+    def send(self, text):
+        """Send text as a single message."""
+        self._send_frame(0x1, text.encode('utf-8'))
+
+
+class Connection(object):
+
+    """A client of the chat server.
+
+    Frames are sent from a writer thread so that they can be delayed by
+    `latency` plus up to `jitter` seconds without being reordered, and all but
+    the initial `no_session` frame are dropped with probability `drop`.
+
+    """
+
+    def __init__(self, server, sock):
+        self.closed = False
+        self.registered = False
+        self.server = server
+        self.socket = WebSocket(sock)
+        self.user_id = None
+        self._condition = threading.Condition()
+        self._outgoing = deque()  # (due time, frame) tuples
+
+    def _write(self):
+        """Send the queued frames as they become due."""
+        while True:
+            with self._condition:
+                while not self._outgoing and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                delay = self._outgoing[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                frame = self._outgoing.popleft()[1]
+            try:
+                self.socket.send(frame)
+            except (EOFError, socket.error):
+                self.close()
+
+    def close(self):
+        """Close the connection and remove the client from the room."""
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify()
+        self.socket.close()
+        self.server.disconnected(self)
+
+    def run(self):
+        """Handle the client's requests until the connection closes."""
+        try:
+            self.socket.handshake()
+            writer = threading.Thread(target=self._write)
+            writer.daemon = True
+            writer.start()
+            self.send('no_session', reliable=True)
+            while True:
+                message = self.socket.recv()
+                if message is None:
+                    break
+                self.server.handle(self, message)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.close()
+
+    def send(self, data, reliable=False):
+        """Queue data, a dictionary or a raw message, for the client."""
+        options = self.server.options
+        if not reliable and options.drop and random.random() < options.drop:
+            self.server.metrics['dropped'] += 1
+            return
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+        due = time.time() + options.latency + random.random() * options.jitter
+        with self._condition:
+            if self._outgoing:  # Never overtake an earlier frame
+                due = max(due, self._outgoing[-1][0])
+            frame = '~m~{0}~m~{1}'.format(len(data), data)
+            self._outgoing.append((due, frame))
+            self._condition.notify()
+
+
+class Listeners(object):
+
+    """A set of user ids that supports choosing a random member quickly."""
+
+    def __init__(self):
+        self._ids = []
+        self._indexes = {}
+
+    def __contains__(self, user_id):
+        return user_id in self._indexes
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, user_id):
+        """Add user_id if it is not already a member."""
+        if user_id not in self._indexes:
+            self._indexes[user_id] = len(self._ids)
+            self._ids.append(user_id)
+
+    def choice(self):
+        """Return a random member."""
+        return random.choice(self._ids)
+
+    def discard(self, user_id):
+        """Remove user_id if it is a member."""
+        index = self._indexes.pop(user_id, None)
+        if index is None:
+            return
+        last = self._ids.pop()
+        if last != user_id:
+            self._ids[index] = last
+            self._indexes[last] = index
+
+
+class FakeTurntable(object):
+
+    """A chat server hosting a single room of simulated users."""
+
+    MAX_DJS = 5
+
+    def __init__(self, options, phases):
+        self.clients = set()  # The bots' connections
+        self.djs = []
+        self.listeners = Listeners()
+        self.lock = threading.RLock()
+        self.metrics = defaultdict(int)
+        self.offline = Listeners()
+        self.options = options
+        self.pending = defaultdict(list)  # Times of unanswered pm commands
+        self.phases = phases
+        self.playlists = {'default': [self.song_metadata(x)
+                                      for x in range(50)]}
+        self.active_playlist = 'default'
+        self.requests = defaultdict(int)
+        self.reply_latencies = []
+        self.song = None
+        self.song_number = 0
+        self.songlog = deque(maxlen=30)
+        self.votes = [0, 0]
+        self._queued = []  # Events to broadcast after the current response
+        for number in range(options.listeners + options.listeners // 5 + 1):
+            user_id = 'user{0:05d}'.format(number)
+            if number < options.listeners:
+                self.listeners.add(user_id)
+            else:
+                self.offline.add(user_id)
+        self.moderators = list(self.listeners)[:3]
+        self.djs = list(self.listeners)[3:6]
+        self._next_song()
+        self._queued = []
+
+    @staticmethod
+    def song_metadata(number):
+        """Return a playlist entry for song number."""
+        return {'_id': 'song{0:06d}'.format(number),
+                'metadata': {'artist': 'Artist {0}'.format(number % 97),
+                             'song': 'Song {0}'.format(number),
+                             'length': 120 + number % 240}}
+
+    def broadcast(self, event):
+        """Send event to every client in the room."""
+        for client in list(self.clients):
+            if client.registered:
+                client.send(event)
+                self.metrics['events'] += 1
+
+    def disconnected(self, client):
+        """Forget a client whose connection has closed."""
+        with self.lock:
+            self.clients.discard(client)
+            if client.registered:
+                self._leave(client.user_id)
+
+    def handle(self, client, message):
+        """Respond to a message received from client."""
+        payload = message[message.index('~m~', 3) + 3:]
+        if payload.startswith('~h~'):  # A heartbeat echoed by the client
+            return
+        rq = json.loads(payload)
+        api = rq['api']
+        handler = getattr(self, 'api_' + api.replace('.', '_'), None)
+        with self.lock:
+            self.requests[api] += 1
+            if handler:
+                response = handler(client, rq) or {'success': True}
+            else:
+                response = {'success': False,
+                            'err': 'Unsupported api `{0}`'.format(api)}
+            response['msgid'] = rq['msgid']
+            client.send(response)
+            events, self._queued = self._queued, []
+            for event in events:
+                self.broadcast(event)
+
+    def room(self, room_id):
+        """Return the description of the room."""
+        metadata = {'current_dj': self.song['djid'] if self.song else None,
+                    'current_song': self.song, 'djs': list(self.djs),
+                    'downvotes': self.votes[1],
+                    'listeners': len(self.listeners),
+                    'max_djs': self.MAX_DJS, 'moderator_id': self.moderators,
+                    'songlog': list(self.songlog), 'upvotes': self.votes[0]}
+        return {'chatserver': [self.options.host, self.options.port],
+                'metadata': metadata, 'name': 'Load test',
+                'roomid': room_id or self.options.room_id,
+                'shortcut': 'load_test'}
+
+    def _answered(self, user_id):
+        """Record the bot's reply to the pm commands sent by user_id."""
+        now = time.time()
+        for sent in self.pending.pop(user_id, ()):
+            self.reply_latencies.append(now - sent)
+
+    def _leave(self, user_id):
+        """Remove user_id from the room and dj table."""
+        if user_id in self.djs:
+            self.djs.remove(user_id)
+            self._queued.append({'command': 'rem_dj', 'success': True,
+                                 'user': [{'userid': user_id}]})
+        self.listeners.discard(user_id)
+        self._queued.append({'command': 'deregistered', 'success': True,
+                             'user': [{'userid': user_id, 'name': user_id}]})
+
+    def _next_song(self):
+        """Start the next dj's song, or stop the music without djs."""
+        if self.song:
+            self.songlog.append(self.song)
+        if not self.djs:
+            if not self.song:
+                return
+            self.song = None
+            self._queued.append({'command': 'nosong', 'success': True,
+                                 'room': self.room(None)})
+            return
+        if self.song and self.song['djid'] in self.djs:
+            index = self.djs.index(self.song['djid']) + 1
+        else:
+            index = 0
+        dj_id = self.djs[index % len(self.djs)]
+        self.song_number += 1
+        self.song = self.song_metadata(self.song_number)
+        self.song.update(djid=dj_id, djname=dj_id, score=random.random())
+        self.votes = [0, 0]
+        self._queued.append({'command': 'newsong', 'success': True,
+                             'room': self.room(None)})
+
+    # API request handlers
+    def api_pm_send(self, client, rq):  # pylint: disable-msg=W0613
+        """Deliver a private message from the bot."""
+        self._answered(rq['receiverid'])
+
+    def api_playlist_add(self, client, rq):  # pylint: disable-msg=W0613
+        """Add a song to a playlist."""
+        playlist = self.playlists.get(rq['playlist_name'])
+        if playlist is None:
+            return {'success': False, 'err': 'Playlist not found'}
+        self.song_number += 1
+        song = self.song_metadata(self.song_number)
+        song['_id'] = rq['song_dict']['fileid']
+        playlist.insert(rq['index'], song)
+
+    def api_playlist_all(self, client, rq):  # pylint: disable-msg=W0613
+        """Return the songs in a playlist."""
+        playlist = self.playlists.get(rq['playlist_name'])
+        if playlist is None:
+            return {'success': False, 'err': 'Playlist not found'}
+        return {'success': True, 'list': playlist}
+
+    def api_playlist_create(self, client, rq):  # pylint: disable-msg=W0613
+        """Create an empty playlist."""
+        name = rq['playlist_name']
+        if name in self.playlists:
+            return {'success': False, 'err': 'Playlist already exists'}
+        self.playlists[name] = []
+        return {'success': True, 'playlist_name': name}
+
+    def api_playlist_delete(self, client, rq):  # pylint: disable-msg=W0613
+        """Delete a playlist other than the active one."""
+        name = rq['playlist_name']
+        if name not in self.playlists or name == self.active_playlist:
+            return {'success': False, 'err': 'Cannot delete that playlist'}
+        del self.playlists[name]
+        return {'success': True, 'playlist_name': name}
+
+    def api_playlist_list_all(self, client, rq):  # pylint: disable-msg=W0613
+        """Return the names of the playlists."""
+        return {'success': True,
+                'list': [{'name': x, 'active': x == self.active_playlist}
+                         for x in sorted(self.playlists)]}
+
+    def api_playlist_remove(self, client, rq):  # pylint: disable-msg=W0613
+        """Remove a song from a playlist."""
+        playlist = self.playlists.get(rq['playlist_name'])
+        if playlist is None or rq['index'] >= len(playlist):
+            return {'success': False, 'err': 'Song not found'}
+        song = playlist.pop(rq['index'])
+        return {'success': True, 'song_dict': [{'fileid': song['_id']}]}
+
+    def api_playlist_rename(self, client, rq):  # pylint: disable-msg=W0613
+        """Rename a playlist."""
+        old, new = rq['old_playlist_name'], rq['new_playlist_name']
+        if old not in self.playlists or new in self.playlists:
+            return {'success': False, 'err': 'Cannot rename that playlist'}
+        self.playlists[new] = self.playlists.pop(old)
+        if self.active_playlist == old:
+            self.active_playlist = new
+
+    def api_playlist_reorder(self, client, rq):  # pylint: disable-msg=W0613
+        """Move a song within a playlist."""
+        playlist = self.playlists.get(rq['playlist_name'])
+        if playlist is None or rq['index_from'] >= len(playlist):
+            return {'success': False, 'err': 'Song not found'}
+        playlist.insert(rq['index_to'], playlist.pop(rq['index_from']))
+
+    def api_playlist_switch(self, client, rq):  # pylint: disable-msg=W0613
+        """Make a playlist the active one."""
+        name = rq['playlist_name']
+        if name not in self.playlists:
+            return {'success': False, 'err': 'Playlist not found'}
+        self.active_playlist = name
+        return {'success': True, 'playlist_name': name}
+
+    def api_presence_update(self, client, rq):  # pylint: disable-msg=W0613
+        """Acknowledge the client's presence."""
+
+    def api_room_add_dj(self, client, rq):  # pylint: disable-msg=W0613
+        """Move the bot to the dj table."""
+        if client.user_id in self.djs or len(self.djs) >= self.MAX_DJS:
+            return {'success': False, 'err': 'Cannot dj right now'}
+        self._step_up(client.user_id)
+
+    def api_room_deregister(self, client, rq):  # pylint: disable-msg=W0613
+        """Remove the bot from the room."""
+        if client.registered:
+            client.registered = False
+            self._leave(client.user_id)
+
+    def api_room_info(self, client, rq):  # pylint: disable-msg=W0613
+        """Return the room and its users."""
+        return {'room': self.room(rq.get('roomid')), 'success': True,
+                'users': [{'userid': x, 'name': x} for x in self.listeners]}
+
+    def api_room_list_rooms(self, client, rq):  # pylint: disable-msg=W0613
+        """Return a page of the room directory, busiest rooms first."""
+        skip = rq.get('skip') or 0
+        rooms = []
+        for number in range(skip, skip + PAGE_SIZE):
+            if number >= self.options.rooms:
+                break
+            room = self.room('room{0:04d}'.format(number))
+            room['shortcut'] = 'room_{0:04d}'.format(number)
+            room['metadata'] = {'listeners': max(1000 - number, 0)}
+            rooms.append([room, None])
+        return {'rooms': rooms, 'success': True}
+
+    def api_room_register(self, client, rq):  # pylint: disable-msg=W0613
+        """Add the bot to the room."""
+        if not client.registered:
+            client.registered = True
+            self.listeners.add(client.user_id)
+            self._queued.append({'command': 'registered', 'success': True,
+                                 'user': [{'userid': client.user_id,
+                                           'name': client.user_id}]})
+
+    def api_room_rem_dj(self, client, rq):  # pylint: disable-msg=W0613
+        """Remove the bot, or the dj it names, from the dj table."""
+        dj_id = rq.get('djid') or client.user_id
+        if dj_id not in self.djs:
+            return {'success': False, 'err': 'Not a dj'}
+        self._step_down(dj_id)
+
+    def api_room_speak(self, client, rq):  # pylint: disable-msg=W0613
+        """Repeat the bot's chat message to the room."""
+        self._queued.append({'command': 'speak', 'name': client.user_id,
+                             'text': rq['text'], 'userid': client.user_id})
+
+    def api_room_stop_song(self, client, rq):  # pylint: disable-msg=W0613
+        """Skip the current song."""
+        self._next_song()
+
+    def api_room_vote(self, client, rq):  # pylint: disable-msg=W0613
+        """Count the bot's vote."""
+        self.votes[0 if rq.get('val') == 'up' else 1] += 1
+
+    def api_user_authenticate(self, client, rq):  # pylint: disable-msg=W0613
+        """Accept any credentials."""
+        client.user_id = rq['userid']
+
+    def api_user_get_fan_of(self, client, rq):  # pylint: disable-msg=W0613
+        """Return the users the bot is a fan of."""
+        return {'fanof': [], 'success': True}
+
+    def api_user_info(self, client, rq):  # pylint: disable-msg=W0613
+        """Return the bot's profile."""
+        return {'name': client.user_id, 'success': True,
+                'userid': client.user_id}
+
+    def api_user_modify(self, client, rq):  # pylint: disable-msg=W0613
+        """Accept changes to the bot's profile."""
+
+    def api_user_set_avatar(self, client, rq):  # pylint: disable-msg=W0613
+        """Accept changes to the bot's avatar."""
+
+    # Simulated users
+    def _step_down(self, dj_id):
+        """Remove dj_id from the dj table."""
+        self.djs.remove(dj_id)
+        self._queued.append({'command': 'rem_dj', 'success': True,
+                             'user': [{'userid': dj_id}]})
+        if self.song and self.song['djid'] == dj_id:
+            self._next_song()
+
+    def _step_up(self, user_id):
+        """Add user_id to the dj table."""
+        self.djs.append(user_id)
+        self._queued.append({'command': 'add_dj', 'success': True,
+                             'user': [{'userid': user_id, 'name': user_id}]})
+        if not self.song:
+            self._next_song()
+
+    def _simulated(self):
+        """Return a random simulated user in the room, or None."""
+        if not self.listeners:
+            return None
+        user_id = self.listeners.choice()
+        if any(x.user_id == user_id for x in self.clients):
+            return None
+        return user_id
+
+    def simulate_chat(self, rates):
+        """A simulated user chats, sometimes sending the bot a command."""
+        user_id = self._simulated()
+        if user_id is None:
+            return
+        if random.random() < rates['command_fraction']:
+            text = random.choice(COMMANDS)
+        else:
+            text = ' '.join(random.choice(WORDS)
+                            for _ in range(random.randint(1, 12)))
+        self._queued.append({'command': 'speak', 'name': user_id,
+                             'text': text, 'userid': user_id})
+
+    def simulate_dj(self, rates):  # pylint: disable-msg=W0613
+        """A simulated user steps up to, or down from, the dj table."""
+        simulated = [x for x in self.djs
+                     if not any(x == y.user_id for y in self.clients)]
+        if simulated and (len(self.djs) >= self.MAX_DJS
+                          or random.random() < 0.5):
+            self._step_down(random.choice(simulated))
+        elif len(self.djs) < self.MAX_DJS:
+            user_id = self._simulated()
+            if user_id is not None and user_id not in self.djs:
+                self._step_up(user_id)
+
+    def simulate_join(self, rates):  # pylint: disable-msg=W0613
+        """A simulated user joins the room."""
+        if not self.offline:
+            return
+        user_id = self.offline.choice()
+        self.offline.discard(user_id)
+        self.listeners.add(user_id)
+        self._queued.append({'command': 'registered', 'success': True,
+                             'user': [{'userid': user_id, 'name': user_id}]})
+
+    def simulate_leave(self, rates):  # pylint: disable-msg=W0613
+        """A simulated user leaves the room."""
+        user_id = self._simulated()
+        if user_id is None:
+            return
+        self._leave(user_id)
+        self.offline.add(user_id)
+
+    def simulate_pm(self, rates):  # pylint: disable-msg=W0613
+        """A simulated user sends each bot a command by pm."""
+        user_id = self._simulated()
+        if user_id is None:
+            return
+        text = random.choice(PM_COMMANDS)
+        for client in list(self.clients):
+            if client.registered:
+                self.pending[user_id].append(time.time())
+                client.send({'command': 'pmmed', 'senderid': user_id,
+                             'text': text, 'userid': client.user_id})
+                self.metrics['events'] += 1
+
+    def simulate_vote(self, rates):  # pylint: disable-msg=W0613
+        """A simulated user votes on the current song."""
+        user_id = self._simulated()
+        if user_id is None or not self.song:
+            return
+        vote = random.choice(('up', 'up', 'up', 'down'))
+        self.votes[0 if vote == 'up' else 1] += 1
+        self._queued.append({'command': 'update_votes', 'success': True,
+                             'room': {'metadata': {
+                                 'downvotes': self.votes[1],
+                                 'listeners': len(self.listeners),
+                                 'upvotes': self.votes[0],
+                                 'votelog': [[user_id, vote]]}}})
+
+    def report(self, elapsed):
+        """Output and reset the metrics collected over elapsed seconds."""
+        latencies = sorted(self.reply_latencies)
+        requests = ', '.join('{0} {1}'.format(api, count) for api, count
+                             in sorted(self.requests.items()))
+        unanswered = sum(len(x) for x in self.pending.values())
+        print('{0} bots, {1} listeners, {2} djs | {3:.1f} events/s, {4} '
+              'dropped | requests: {5} | pm replies: {6}, p50 {7:.2f}s, p95 '
+              '{8:.2f}s, {9} unanswered'.format(
+                  len(self.clients), len(self.listeners), len(self.djs),
+                  self.metrics['events'] / elapsed, self.metrics['dropped'],
+                  requests or 'none', len(latencies),
+                  percentile(latencies, 50), percentile(latencies, 95),
+                  unanswered))
+        sys.stdout.flush()
+        self.metrics.clear()
+        self.reply_latencies = []
+        self.requests.clear()
+
+    def serve(self):
+        """Accept connections on a background thread."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.options.host, self.options.port))
+        listener.listen(16)
+
+        def accept():
+            """Start a thread for each new connection."""
+            while True:
+                sock, _ = listener.accept()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client = Connection(self, sock)
+                with self.lock:
+                    self.clients.add(client)
+                thread = threading.Thread(target=client.run)
+                thread.daemon = True
+                thread.start()
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+    def simulate(self):
+        """Run the simulated users through each phase of the script."""
+        options = self.options
+        now = time.time()
+        next_disconnect = now + (options.disconnect_every or float('inf'))
+        next_report = now + options.report
+        last_report = now
+        next_song = now + options.song_length
+        for phase in self.phases:
+            rates = dict((x, getattr(options, x)) for x in RATES)
+            rates.update(phase)
+            print('Starting phase: {0}'.format(', '.join(
+                '{0} {1}'.format(*x) for x in sorted(phase.items()))))
+            actions = [(getattr(self, 'simulate_' + x[:-5]), x)
+                       for x in RATES if x.endswith('_rate')]
+            credit = defaultdict(float)
+            end = now + phase.get('duration', float('inf'))
+            last = now
+            while now < end:
+                time.sleep(max(rates['burst'], 0.05))
+                now = time.time()
+                with self.lock:
+                    for action, rate in actions:
+                        credit[rate] += rates[rate] * (now - last)
+                        while credit[rate] >= 1:
+                            credit[rate] -= 1
+                            action(rates)
+                    if now >= next_song:
+                        next_song = now + rates['song_length']
+                        self._next_song()
+                    events, self._queued = self._queued, []
+                    for event in events:
+                        self.broadcast(event)
+                    if now >= next_disconnect:
+                        next_disconnect = now + options.disconnect_every
+                        for client in list(self.clients):
+                            client.close()
+                    if now >= next_report:
+                        self.report(now - last_report)
+                        last_report = now
+                        next_report = now + options.report
+                last = now
+
+
+def main():
+    """Run the fake turntable server."""
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--host', default='localhost',
+                      help='The address to listen on (default: %default).')
+    parser.add_option('--port', type='int', default=8080,
+                      help='The port to listen on (default: %default).')
+    parser.add_option('--room-id', default='load_test',
+                      help='The id reported for the room (default: %default).')
+    parser.add_option('--rooms', type='int', default=100,
+                      help=('The number of rooms in the room directory '
+                            '(default: %default).'))
+    parser.add_option('--listeners', type='int', default=5000,
+                      help=('The number of simulated users in the room at '
+                            'the start (default: %default).'))
+    parser.add_option('--chat-rate', type='float', default=50,
+                      help='Chat messages per second (default: %default).')
+    parser.add_option('--command-fraction', type='float', default=0.02,
+                      help=('The fraction of chat messages that are '
+                            'commands (default: %default).'))
+    parser.add_option('--pm-rate', type='float', default=0.5,
+                      help=('Commands sent to the bot by pm per second '
+                            '(default: %default).'))
+    parser.add_option('--join-rate', type='float', default=2,
+                      help='Users joining per second (default: %default).')
+    parser.add_option('--leave-rate', type='float', default=2,
+                      help='Users leaving per second (default: %default).')
+    parser.add_option('--dj-rate', type='float', default=0.1,
+                      help=('Users stepping up or down per second (default: '
+                            '%default).'))
+    parser.add_option('--vote-rate', type='float', default=2,
+                      help='Votes per second (default: %default).')
+    parser.add_option('--song-length', type='float', default=240,
+                      help='Seconds per song (default: %default).')
+    parser.add_option('--burst', type='float', default=0,
+                      help=('Deliver the simulated activity in bursts every '
+                            'BURST seconds.'))
+    parser.add_option('--latency', type='float', default=0,
+                      help='Seconds to delay every frame sent to the bot.')
+    parser.add_option('--jitter', type='float', default=0,
+                      help=('Up to this many more seconds of random delay '
+                            'per frame.'))
+    parser.add_option('--drop', type='float', default=0,
+                      help='The fraction of frames sent to the bot to drop.')
+    parser.add_option('--disconnect-every', type='float', metavar='SECONDS',
+                      help='Periodically close the connections to the bots.')
+    parser.add_option('--report', type='float', default=10,
+                      help=('Seconds between metrics reports (default: '
+                            '%default).'))
+    parser.add_option('--script', metavar='FILE',
+                      help='A JSON list of phases to run.')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: {0}'.format(' '.join(args)))
+    if options.script:
+        with open(options.script) as script:
+            phases = json.load(script)
+        for phase in phases:
+            unknown = set(phase) - set(RATES) - set(['duration'])
+            if unknown:
+                parser.error('Unknown phase options: {0}'
+                             .format(', '.join(sorted(unknown))))
+    else:
+        phases = [{}]
+
+    server = FakeTurntable(options, phases)
+    server.serve()
+    print('Listening on {0}:{1}'.format(options.host, options.port))
+    try:
+        server.simulate()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
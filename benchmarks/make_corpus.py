@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Generate the session corpus replayed by benchmarks/replay.py.
+
+The session is modelled on a busy room: mostly chat and votes, with users
+joining and leaving, djs stepping up and down, songs changing and listeners
+sending commands. Every user that joins and every dj that steps up leaves
+again before the end, so the session can be replayed repeatedly.
+
+Usage: python benchmarks/make_corpus.py [NUM_EVENTS] > CORPUS
+
+"""
+
+from __future__ import print_function
+import json
+import random
+import sys
+
+BOT_ID = 'replaybot'
+CHAT_SERVER = ['chat.replay', 80]
+COMMANDS = ('/about', '/commands', '/echo hello', '/help /pllist', '/pllist',
+            '/playlists', '/plswitch def', '/theme', '/uptime')
+ROOM_ID = 'replayroom'
+WORDS = ('nice', 'track', 'who', 'is', 'this', 'love', 'it', 'awesome', 'bop',
+         'lol', 'next', 'song', 'please', 'that', 'bass', 'drop', 'great')
+
+
+def song(number, dj_id):
+    """Return the room metadata of a song played by dj_id."""
+    return {'_id': 'song{0:04d}'.format(number), 'djid': dj_id,
+            'djname': dj_id, 'score': random.random(),
+            'metadata': {'artist': 'Artist {0}'.format(number % 97),
+                         'song': 'Song {0}'.format(number),
+                         'length': random.randint(120, 400)}}
+
+
+def header(users, djs):
+    """Return the first corpus line: configuration and api responses."""
+    room = {'roomid': ROOM_ID, 'shortcut': 'replay', 'chatserver': CHAT_SERVER,
+            'metadata': {'current_dj': djs[0], 'current_song': song(0, djs[0]),
+                         'djs': djs, 'listeners': len(users), 'max_djs': 5,
+                         'moderator_id': users[:2],
+                         'songlog': [song(x, djs[0]) for x in range(1, 31)]}}
+    rooms = [[{'shortcut': 'room{0:02d}'.format(x),
+               'roomid': 'roomid{0:02d}'.format(x), 'chatserver': CHAT_SERVER,
+               'metadata': {'listeners': 100 - x}}, None] for x in range(15)]
+    playlist = [{'_id': x['_id'], 'metadata': x['metadata']}
+                for x in room['metadata']['songlog']]
+    return {'config': {'admin_ids': users[0], 'auth_id': 'auth',
+                       'plugins': ('simple.Talk\nbotdj.Dj\nbotdj.Playlist\n'
+                                   'theme.Theme\nappearance.Appearance'),
+                       'room_id': ROOM_ID, 'user_id': BOT_ID},
+            'responses': {
+                'playlist.all': {'success': True, 'list': playlist},
+                'playlist.list_all': {'success': True, 'list': [
+                    {'name': 'default', 'active': True},
+                    {'name': 'chill', 'active': False}]},
+                'playlist.switch': {'success': True,
+                                    'playlist_name': 'default'},
+                'room.info': {'success': True, 'room': room,
+                              'users': [{'userid': x, 'name': x}
+                                        for x in users + [BOT_ID]]},
+                'room.list_rooms': {'success': True, 'rooms': rooms},
+                'user.get_fan_of': {'success': True, 'fanof': []},
+                'user.info': {'success': True, 'name': BOT_ID,
+                              'userid': BOT_ID}},
+            'thresholds': {'max_p99_ms': 5, 'max_peak_memory_mb': 100,
+                           'min_events_per_second': 2000}}
+
+
+def session(num_events):
+    """Yield the corpus lines of a session with about num_events events."""
+    users = ['user{0:03d}'.format(x) for x in range(60)]
+    djs = users[2:5]
+    yield header(users, djs)
+    present = list(users)
+    visitors = ['visitor{0:03d}'.format(x) for x in range(200)]
+    table = list(djs)
+    song_number = 100
+    for _ in range(num_events):
+        roll = random.random()
+        user = random.choice(present)
+        if roll < 0.6:
+            text = ' '.join(random.choice(WORDS)
+                            for _ in range(random.randint(1, 12)))
+            yield {'command': 'speak', 'userid': user, 'name': user,
+                   'text': text}
+        elif roll < 0.75:
+            yield {'command': 'update_votes', 'success': True, 'room': {
+                'metadata': {'upvotes': random.randint(0, 30),
+                             'downvotes': random.randint(0, 5),
+                             'listeners': len(present),
+                             'votelog': [[user, 'up']]}}}
+        elif roll < 0.8:
+            song_number += 1
+            dj_id = random.choice(table)
+            metadata = {'current_dj': dj_id, 'djs': table,
+                        'current_song': song(song_number, dj_id),
+                        'listeners': len(present), 'upvotes': 0,
+                        'downvotes': 0}
+            yield {'command': 'newsong', 'success': True,
+                   'room': {'roomid': ROOM_ID, 'metadata': metadata}}
+        elif roll < 0.86:
+            joined = [x for x in present if x in visitors]
+            if joined and random.random() < 0.5:
+                visitor = random.choice(joined)
+                if visitor in table:
+                    continue
+                present.remove(visitor)
+                yield {'command': 'deregistered', 'success': True,
+                       'user': [{'userid': visitor, 'name': visitor}]}
+            else:
+                visitor = random.choice(visitors)
+                if visitor in present:
+                    continue
+                present.append(visitor)
+                yield {'command': 'registered', 'success': True,
+                       'user': [{'userid': visitor, 'name': visitor}]}
+        elif roll < 0.9:
+            if user in djs:  # The initial djs remain at the table
+                continue
+            if user in table:
+                table.remove(user)
+                yield {'command': 'rem_dj', 'success': True,
+                       'user': [{'userid': user}]}
+            elif len(table) < 5:
+                table.append(user)
+                yield {'command': 'add_dj', 'success': True,
+                       'user': [{'userid': user}]}
+        elif roll < 0.95:
+            yield {'command': 'speak', 'userid': user, 'name': user,
+                   'text': random.choice(COMMANDS)}
+        else:
+            yield {'command': 'pmmed', 'senderid': user, 'userid': BOT_ID,
+                   'text': random.choice(COMMANDS)}
+    for user in table:
+        if user not in djs:
+            yield {'command': 'rem_dj', 'success': True,
+                   'user': [{'userid': user}]}
+    for user in present:
+        if user in visitors:
+            yield {'command': 'deregistered', 'success': True,
+                   'user': [{'userid': user, 'name': user}]}
+
+
+def main():
+    """Write the corpus to stdout."""
+    random.seed(0)
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for line in session(num):
+        print(json.dumps(line, sort_keys=True))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare the linear best_match with NameIndex lookups over room shortcuts.
+
+Usage: python benchmarks/names.py [NUM_NAMES] [NUM_QUERIES]
+
+"""
+
+from __future__ import print_function
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lazysusan.names import NameIndex  # noqa
+
+WORDS = ('indie', 'rock', 'chill', 'house', 'dubstep', 'coding', 'jazz',
+         'metal', 'lounge', 'disco', 'soul', 'techno', 'folk', 'pop')
+
+
+def best_match(selection, options):
+    """Return the best match from a set of options if possible.
+
+    Return a list when there is not a single viable option. This is the
+    linear scan that NameIndex replaced in the Playlist plugin.
+
+    """
+    if selection in options:
+        return selection
+    possibles = [x for x in options if x.startswith(selection)]
+    if not possibles:
+        return [x for x in options if selection in x]
+    elif len(possibles) == 1:
+        return possibles[0]
+    else:
+        return possibles
+
+
+def shortcut():
+    """Return a random room shortcut."""
+    suffix = ''.join(random.choice(string.ascii_lowercase + string.digits)
+                     for _ in range(random.randint(2, 8)))
+    return '_'.join(random.sample(WORDS, 2)) + '_' + suffix
+
+
+def typo(name):
+    """Return name with a single character substituted."""
+    i = random.randrange(len(name))
+    return name[:i] + random.choice(string.ascii_lowercase) + name[i + 1:]
+
+
+def timed(label, count, function, queries):
+    """Run function on each query and output the time it took per lookup."""
+    start = time.time()
+    for query in queries:
+        function(query)
+    elapsed = time.time() - start
+    print('{0:<22} {1:>6} ops {2:>10.3f} ms total {3:>10.3f} us/op'
+          .format(label, count, elapsed * 1000, elapsed * 1e6 / count))
+
+
+def main():
+    """Benchmark both lookups on exact, prefix, substring and typo queries."""
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    names = set()
+    while len(names) < num:
+        names.add(shortcut())
+    names = list(names)
+
+    start = time.time()
+    index = NameIndex(names)
+    print('Indexed {0} names in {1:.3f} s'.format(num, time.time() - start))
+
+    samples = random.sample(names, num_queries)
+    queries = (('exact', samples),
+               ('prefix', [x[:len(x) - 2] for x in samples]),
+               ('substring', [x[len(x) // 3:] for x in samples]),
+               ('typo', [typo(x) for x in samples]))
+    for kind, items in queries:
+        timed('best_match ' + kind, num_queries,
+              lambda x: best_match(x, names), items)
+        timed('NameIndex ' + kind, num_queries, index.best, items)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
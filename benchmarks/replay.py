@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Replay a recorded turntable session through LazySusan and its plugins.
+
+The bot runs against ReplayApi, a stand-in for the ttapi Bot that never
+touches the network: requests are counted and answered from the responses in
+the corpus header, and the session's events are fed to `on_message` as fast
+as the bot handles them. Every event is timed until the requests it caused,
+including queued chat messages, have been answered and the plugins have
+finished handling it.
+
+The first line of a corpus holds the bot's configuration, the api
+`responses` and the regression `thresholds`; every other line is an event.
+benchmarks/make_corpus.py generates the bundled corpus.
+
+Usage: python benchmarks/replay.py [--check] [--repeat N] [--stats] [CORPUS]
+
+"""
+
+from __future__ import print_function
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lazysusan import BotApi, LazySusan  # noqa
+
+CHAT_SERVER = ['chat.replay', 80]
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'session.jsonl')
+
+
+class _NullSocket(object):
+
+    """A websocket that discards everything sent through it."""
+
+    def __init__(self, url):
+        self.on_error = None
+        self.url = url
+
+    def close(self):
+        """Pretend to close the connection."""
+
+    def send(self, _):
+        """Discard the message."""
+
+
+class ReplayApi(BotApi):
+
+    """A BotApi that answers its own requests from fixture responses."""
+
+    responses = {}
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayApi, self).__init__(*args, **kwargs)
+        self.calls = defaultdict(int)
+        self.rateLimit = None
+        self._pending = []
+
+    def _send(self, rq, callback=None):
+        super(ReplayApi, self)._send(rq, callback)
+        self.calls[rq['api']] += 1
+        self._pending.append(rq)
+
+    def answer(self):
+        """Respond to every outstanding request, including new ones."""
+        while self._pending:
+            rq = self._pending.pop(0)
+            response = dict(self.responses.get(rq['api'], {'success': True}))
+            response['msgid'] = rq['msgid']
+            self.receive(response)
+
+    def connect(self, roomId):
+        result = super(ReplayApi, self).connect(roomId)
+        self.ws = _NullSocket(self.ws.url)
+        return result
+
+    def receive(self, data):
+        """Handle data as if it had arrived over the websocket."""
+        msg = json.dumps(data)
+        self.on_message(None, '~m~{0}~m~{1}'.format(len(msg), msg))
+
+    def whichServer(self, roomId):
+        return CHAT_SERVER
+
+
+class ReplayBot(LazySusan):
+
+    """A LazySusan configured by the corpus and connected to a ReplayApi."""
+
+    api_class = ReplayApi
+    config = {}
+    update_checked = True
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayBot, self).__init__(*args, **kwargs)
+        self.outbox.window = 0
+
+    def _get_config(self, section):
+        return dict(ReplayBot.config)
+
+    def settle(self):
+        """Answer requests and flush the outbox until both are empty and the
+        plugin queues are idle."""
+        api, outbox = self.api, self.outbox
+        while True:
+            # Checked first, as idle queues send nothing more until answered
+            idle = all(x.idle for x in list(api.queues.values()))
+            with api.lock:
+                api.answer()
+                if outbox.in_flight is None and len(outbox):
+                    outbox._flush()  # pylint: disable-msg=W0212
+                elif outbox.in_flight is None and not api._pending and idle:
+                    return
+            if not idle:
+                time.sleep(0)  # Let the pool's threads run
+
+
+def percentile(values, percent):
+    """Return the percentile of a sorted list of values."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def load(path):
+    """Return the header and the events of the corpus at path."""
+    with open(path) as corpus:
+        lines = [json.loads(x) for x in corpus if x.strip()]
+    return lines[0], lines[1:]
+
+
+def replay(bot, events, repeat):
+    """Feed the events to bot repeat times and return their latencies.
+
+    Latencies are returned as a dictionary mapping each event command to a
+    list of seconds.
+
+    """
+    latencies = defaultdict(list)
+    for _ in range(repeat):
+        for event in events:
+            start = time.time()
+            bot.api.receive(event)
+            bot.settle()
+            latencies[event['command']].append(time.time() - start)
+    return latencies
+
+
+def main():
+    """Replay the corpus and report throughput, latency and memory use."""
+    parser = OptionParser(usage='Usage: %prog [options] [CORPUS]')
+    parser.add_option('--check', action='store_true',
+                      help=('Exit with an error when the corpus thresholds '
+                            'are not met.'))
+    parser.add_option('--repeat', type='int', default=3,
+                      help='The number of times to replay the session.')
+    parser.add_option('--stats', action='store_true',
+                      help='Also report the bot\'s own handler statistics.')
+    options, args = parser.parse_args()
+    header, events = load(args[0] if args else CORPUS)
+    ReplayApi.responses = header['responses']
+    ReplayBot.config = header['config']
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        bot = ReplayBot('DEFAULT', None, False, enable_stats=options.stats)
+        bot.api.on_message(None, '~m~10~m~no_session')  # Authenticate
+        bot.settle()
+        bot.api.calls.clear()
+        start = time.time()
+        latencies = replay(bot, events, options.repeat)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    count = len(events) * options.repeat
+    rate = count / elapsed
+    print('{0} events in {1:.3f} s: {2:.0f} events/s'
+          .format(count, elapsed, rate))
+    everything = sorted(x for values in latencies.values() for x in values)
+    print('{0:<14} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'
+          .format('event', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, values in sorted(latencies.items()) + [('all', everything)]:
+        values.sort()
+        print('{0:<14} {1:>7} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f}'
+              .format(name, len(values), percentile(values, 50) * 1000,
+                      percentile(values, 95) * 1000,
+                      percentile(values, 99) * 1000, values[-1] * 1000))
+    # ru_maxrss is in kilobytes on Linux
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print('peak memory: {0:.1f} MB'.format(memory))
+    calls = sorted(bot.api.calls.items())
+    print('api calls: ' + ', '.join('{0} {1}'.format(name, number)
+                                    for name, number in calls))
+    if options.stats:
+        for line in bot.stats.summary(10):
+            print(line)
+
+    if not options.check:
+        return 0
+    thresholds = header['thresholds']
+    failures = []
+    if rate < thresholds['min_events_per_second']:
+        failures.append('{0:.0f} events/s is below {1}'
+                        .format(rate, thresholds['min_events_per_second']))
+    p99 = percentile(everything, 99) * 1000
+    if p99 > thresholds['max_p99_ms']:
+        failures.append('p99 of {0:.3f} ms is above {1} ms'
+                        .format(p99, thresholds['max_p99_ms']))
+    if memory > thresholds['max_peak_memory_mb']:
+        failures.append('peak memory of {0:.1f} MB is above {1} MB'
+                        .format(memory, thresholds['max_peak_memory_mb']))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
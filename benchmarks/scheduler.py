@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Measure the cost of scheduling, cancelling and popping scheduler jobs.
+
+Usage: python benchmarks/scheduler.py [NUM_JOBS]
+
+"""
+
+from __future__ import print_function
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from lazysusan.scheduler import Scheduler  # noqa
+
+
+def noop():
+    """The callback used for every benchmarked job."""
+
+
+def timed(label, count, function, *args):
+    """Run function and output the time it took per operation."""
+    start = time.time()
+    retval = function(*args)
+    elapsed = time.time() - start
+    print('{0:<10} {1:>8} ops {2:>9.3f} ms total {3:>8.3f} us/op'
+          .format(label, count, elapsed * 1000, elapsed * 1e6 / count))
+    return retval
+
+
+def main():
+    """Benchmark push, cancel and pop with NUM_JOBS pending jobs."""
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # Deadlines are far in the future so the timer thread never runs a job
+    scheduler = Scheduler()
+    delays = [1e6 + random.random() * 1e3 for _ in range(num)]
+
+    def push():
+        return [scheduler.schedule(delay, noop) for delay in delays]
+
+    def cancel(jobs):
+        for job in jobs:
+            job.cancel()
+
+    def reschedule(jobs):
+        for job in jobs:
+            job.reschedule(1e6 + random.random() * 1e3)
+
+    def pop():
+        count = 0
+        with scheduler._condition:  # pylint: disable-msg=W0212
+            while scheduler._pop_due(float('inf'))[0]:  # noqa pylint: disable-msg=W0212
+                count += 1
+        return count
+
+    jobs = timed('push', num, push)
+    random.shuffle(jobs)
+    timed('cancel', num // 2, cancel, jobs[:num // 2])
+    timed('reschedule', num // 4, reschedule, jobs[num // 2:-num // 4])
+    popped = timed('pop', len(scheduler), pop)
+    print('Popped {0} live jobs, heap size {1}'.format(
+        popped, len(scheduler._heap)))  # pylint: disable-msg=W0212
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,33 @@
 """LazySusan is a pluginable bot for turntable.fm."""
 
 from __future__ import print_function
-import heapq
+import json
 import logging
 import os
 import sys
+import threading
 import time
 from ConfigParser import ConfigParser
 from datetime import datetime
+from functools import partial, wraps
+from weakref import WeakSet
+from lazysusan.commands import CommandRegistry
+from lazysusan.flood import FloodControl
 from lazysusan.helpers import (admin_required, display_exceptions,
                                dynamic_permissions, get_sender_id,
-                               no_arg_command, single_arg_command)
-from lazysusan.plugins import CommandPlugin
+                               no_arg_command, single_arg_command,
+                               write_atomically)
+from lazysusan.outbox import BULK, INTERACTIVE, Outbox
+from lazysusan.plugins import CommandPlugin, PluginException, find_plugin
+from lazysusan.pool import DROP_NEWEST, DROP_OLDEST, SerialQueue, WorkerPool
+from lazysusan.remote import RemotePlugin
+from lazysusan.rooms import RoomDirectory
+from lazysusan.scheduler import Scheduler
+from lazysusan.supervisor import Supervisor
+from lazysusan.stats import SampledProfiler, Stats
+from lazysusan.tasks import Future, coroutine
+from lazysusan.tracker import UNTRACKED, RequestTracker
+from lazysusan.users import UserRegistry
 from optparse import OptionParser
 from ttapi import Bot
 from update_checker import pretty_date, update_check
@@ -30,12 +46,212 @@ class LazySusanException(Exception):
     """Exception class used for internal LazySusan issues."""
 
 
+def _thread_local(name):
+    """Return a property whose value is separate for each thread."""
+    def getter(self):  # pylint: disable-msg=C0111
+        return getattr(self._context, name, None)
+
+    def setter(self, value):  # pylint: disable-msg=C0111
+        setattr(self._context, name, value)
+    return property(getter, setter)
+
+
+class BotApi(Bot):
+
+    """A ttapi Bot whose event handling is serialized by a lock.
+
+    Events and API callbacks run on the websocket thread, while scheduled
+    callbacks run on the scheduler thread. Both hold `lock` so that handlers
+    never run concurrently. The work of plugins that have a SerialQueue in
+    `queues` instead runs on that queue, without holding the lock; sending a
+    request takes the lock, but waits for ttapi's `rateLimit` without it.
+
+    Requests sent while `command` is set are attributed to that flood.Command,
+    and requests sent while `owner` is set are attributed to that plugin, as
+    are the requests sent from their callbacks. Both are set per thread. When
+    `tracker` is set, every request is sent through that RequestTracker.
+
+    When `stats` is set, event callbacks registered afterwards record their
+    latency, and when `profiler` is set, message handling is sampled by it.
+    `received` counts the messages handled.
+
+    When `chat_server` is set to a [host, port] list, every room is joined
+    through that server rather than the one turntable assigns to the room.
+
+    """
+
+    command = _thread_local('command')
+    owner = _thread_local('owner')
+    request_timeout = _thread_local('request_timeout')  # Overrides tracker's
+
+    def __init__(self, *args, **kwargs):
+        self.chat_server = None
+        self.lock = threading.RLock()
+        self.profiler = None
+        self.queues = {}  # Maps a plugin name to its SerialQueue
+        self.received = 0
+        self.stats = None
+        self.tracker = None
+        self._context = threading.local()
+        super(BotApi, self).__init__(*args, **kwargs)
+
+    def _owned(self, callback, owner):
+        """Return a version of callback that runs as owner's droppable work."""
+        @wraps(callback)
+        def wrapper(*args):  # pylint: disable-msg=C0111
+            queue = self.queues.get(owner)
+            if queue is None:
+                self.run_as(None, owner, callback, *args)
+            else:
+                queue.submit(self.run_as, None, owner, callback, *args)
+        return wrapper
+
+    def _reserve_send(self):
+        """Reserve the next send allowed by rateLimit and return the seconds
+        until it. Hold the lock."""
+        if not self.rateLimit:
+            return 0
+        now = time.time()
+        self.lastSend = max(now, self.lastSend + self.rateLimit)
+        return self.lastSend - now
+
+    def _send(self, rq, callback=None):
+        command, owner = self.command, self.owner
+        # ttapi finds the requests it answers itself, and those without a
+        # callback, by their original callback, so those are not wrapped
+        if (command is not None or owner is not None) \
+                and callback is not None and rq['api'] not in UNTRACKED:
+            def _closure(data):
+                queue = self.queues.get(owner) if owner else None
+                if queue is None:
+                    self.run_as(command, owner, _respond, data)
+                else:  # Responses are never dropped
+                    queue.submit(self.run_as, command, owner, _respond, data,
+                                 droppable=False)
+
+            def _respond(data):
+                try:
+                    callback(data)
+                finally:
+                    if command is not None:
+                        with self.lock:
+                            command.finished()
+            wrapped = _closure
+        else:
+            command = None  # The request is not waited for
+            wrapped = callback
+        with self.lock:
+            if command is not None:
+                command.sent()
+            delay = self._reserve_send()
+        if delay > 0:  # Wait for the rate limit without holding the lock
+            time.sleep(delay)
+        with self.lock:
+            if self.tracker is None:
+                return self._transmit(rq, wrapped)
+            self.tracker.send(rq, wrapped, owner, self.request_timeout)
+
+    def _transmit(self, rq, callback):
+        """Send rq at once with ttapi's _send. Hold the lock.
+
+        Sends that did not reserve a slot, such as the tracker's retries,
+        still push back the next reserved one.
+
+        """
+        rate_limit, self.rateLimit = self.rateLimit, None
+        try:
+            super(BotApi, self)._send(rq, callback)
+        finally:
+            self.rateLimit = rate_limit
+        self.lastSend = max(self.lastSend, time.time())
+
+    def on(self, signal, callback, owner='core'):
+        """Register callback for the signal and return the registered callable.
+
+        :param owner: The name of the plugin registering the callback, which
+            is used to group the callback's statistics, and to which the
+            requests it makes are attributed. The callback runs on the
+            plugin's queue, if it has one.
+
+        """
+        if self.stats is not None:
+            callback = self.stats.wrap(callback, ('event', signal),
+                                       ('plugin', owner))
+        if owner != 'core':
+            callback = self._owned(callback, owner)
+        super(BotApi, self).on(signal, callback)
+        return callback
+
+    def on_message(self, *args, **kwargs):
+        with self.lock:
+            self.received += 1
+            if self.profiler is None:
+                super(BotApi, self).on_message(*args, **kwargs)
+            else:
+                self.profiler.call(super(BotApi, self).on_message, *args,
+                                   **kwargs)
+
+    def request(self, method, *args, **kwargs):
+        """Call the ttapi method and return a Future of its response.
+
+        The future's `set_result` is passed as the method's callback, which
+        every ttapi method accepts as its final positional argument. Yield the
+        future from a coroutine (see lazysusan.tasks) to wait for it.
+
+        :param timeout: A keyword argument giving the seconds to wait for a
+            response, instead of the tracker's default. Without a response the
+            future's result is a failed response.
+
+        """
+        future = Future()
+        previous = self.request_timeout
+        self.request_timeout = kwargs.pop('timeout', None)
+        try:
+            getattr(self, method)(*(args + (future.set_result,)), **kwargs)
+        finally:
+            self.request_timeout = previous
+        return future
+
+    def run_as(self, command, owner, function, *args, **kwargs):
+        """Call function with the command and owner context set."""
+        previous = self.command, self.owner
+        self.command, self.owner = command, owner
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.command, self.owner = previous
+
+    def whichServer(self, roomId):
+        if self.chat_server:
+            return self.chat_server
+        return super(BotApi, self).whichServer(roomId)
+
+
 class LazySusan(object):
 
     """The primary class for LazySusan that represents a bot."""
 
+    RECONCILE_INTERVAL = 600
+    SNAPSHOT_INTERVAL = 60
+    SNAPSHOT_MAX_AGE = 600
+    api_class = BotApi  # Replaced by stand-ins, such as the replay harness
     update_checked = False
 
+    @property
+    def dj_ids(self):
+        """The ids of the djs in the bot's room."""
+        return self.users.dj_ids
+
+    @property
+    def listener_ids(self):
+        """The ids of the users in the bot's room."""
+        return self.users.listener_ids
+
+    @property
+    def moderator_ids(self):
+        """The ids of the moderators of the bot's room."""
+        return self.users.moderator_ids
+
     @staticmethod
     def _get_config(section):
         """Return a dictionary of configuration options for the section."""
@@ -58,10 +274,19 @@ class LazySusan(object):
                                      .format(section))
         return dict(config.items(section))
 
-    def __init__(self, config_section, plugin_dir, enable_logging):
-        if not self.update_checked:
+    def __init__(self, config_section, plugin_dir, enable_logging,
+                 enable_stats=False, profile_path=None, room_id=None,
+                 host=None):
+        """Initialize the bot and connect it to its room.
+
+        :param room_id: The room to join, instead of the configured one.
+        :param host: The Host whose resources the bot shares. By default the
+            bot has a host of its own.
+
+        """
+        if not LazySusan.update_checked:  # Only check once per process
             update_check(__name__, __version__)
-            self.update_checked = True
+            LazySusan.update_checked = True
 
         self.start_time = datetime.utcnow()
 
@@ -72,22 +297,29 @@ class LazySusan(object):
                 print('`{0}` is not a directory.'.format(plugin_dir))
 
         config = self._get_config(config_section)
-        self._delayed_events = []
+        if room_id:
+            config['room_id'] = room_id
+        self.admin_ids = frozenset(config.get('admin_ids', '').split())
+        self._command_aliases = self._parse_pairs(config.get('aliases', ''),
+                                                  'alias')
+        self._command_registry = None
         self._loaded_plugins = {}
-        self.api = Bot(config['auth_id'], config['user_id'], rate_limit=0.575)
+        self._remote_plugins = set()  # Plugins that run in their own process
+        self.api = self.api_class(config['auth_id'], config['user_id'],
+                                  rate_limit=0.575)
+        self.api.chat_server = self._parse_chat_server(
+            config.get('chat_server'))
         self.api.debug = enable_logging
-        self.api.on('add_dj', self.handle_add_dj)
+        self.stats = self.api.stats = Stats() if enable_stats else None
+        if profile_path:
+            self.api.profiler = SampledProfiler(profile_path)
         self.api.on('booted_user', self.handle_booted_user)
-        self.api.on('deregistered', self.handle_user_leave)
-        self.api.on('new_moderator', self.handle_add_moderator)
-        self.api.on('post_message', self.run_delayed_events)
         self.api.on('pmmed', self.handle_pm)
         self.api.on('ready', self.handle_ready)
-        self.api.on('registered', self.handle_user_join)
-        self.api.on('rem_dj', self.handle_remove_dj)
-        self.api.on('rem_moderator', self.handle_remove_moderator)
         self.api.on('roomChanged', self.handle_room_change)
         self.api.on('speak', self.handle_room_message)
+        for event in sorted(UserRegistry.EVENTS):
+            self.api.on(event, self.handle_user_update)
         self.bot_id = config['user_id']
         self.commands = {'/about': self.cmd_about,
                          '/commands': self.cmd_commands,
@@ -98,17 +330,63 @@ class LazySusan(object):
                          '/pgreload': self.cmd_plugin_reload,
                          '/pgunload': self.cmd_plugin_unload,
                          '/plugins': self.cmd_plugins,
+                         '/stats': self.cmd_stats,
                          '/uptime': self.cmd_uptime}
+        self._build_command_registry()
         self.config = config
-        self.dj_ids = set()
-        self.listener_ids = set()
+        self.host = host or Host()
+        self.flood = FloodControl(
+            config.get('flood_user'),
+            self._parse_pairs(config.get('flood_commands', ''), 'flood limit'),
+            config.get('flood_max_in_flight'))
         self.max_djs = None
-        self.moderator_ids = set()
+        policy = config.get('plugin_queue_policy')
+        if policy not in (None, DROP_NEWEST, DROP_OLDEST):
+            print('Ignoring invalid plugin_queue_policy `{0}`.'.format(policy))
+            policy = None
+        self._queue_options = {'max_size': config.get('plugin_queue_size'),
+                               'policy': policy}
+        self.scheduler = self.host.scheduler
+        self._jobs = WeakSet()  # The jobs scheduled by the bot and plugins
+        self.outbox = Outbox(self.api, self.schedule)
+        # The tracker sends requests once BotApi._send has waited for them
+        self.api.tracker = RequestTracker(
+            self.api, self.api._transmit,  # pylint: disable-msg=W0212
+            self.schedule, config.get('request_timeout'),
+            config.get('request_max_in_flight'))
+        self._evict_job = self.schedule_every(FloodControl.EVICT_INTERVAL,
+                                              self.flood.evict)
+        interval = float(config.get('users_reconcile_interval',
+                                    self.RECONCILE_INTERVAL))
+        self._reconcile_job = self.schedule_every(
+            interval, self.reconcile_users) if interval > 0 else None
+        self.snapshot_path = None
+        self._snapshot_job = None
+        if config.get('snapshot_path'):
+            self.snapshot_path = os.path.expanduser(
+                config['snapshot_path'].format(room_id=config['room_id'],
+                                               section=config_section))
         self.username = None
+        self.users = UserRegistry()
 
         # Load plugins after everything has been initialized
-        for plugin in config['plugins'].split('\n'):
-            self.load_plugin(plugin)
+        for line in config['plugins'].split('\n'):
+            parts = line.split()
+            if not parts:
+                continue
+            for flag in parts[1:]:
+                if flag == 'process':
+                    self._remote_plugins.add(parts[0])
+                else:
+                    print('Ignoring unknown flag `{0}` of plugin `{1}`.'
+                          .format(flag, parts[0]))
+            self.load_plugin(parts[0])
+
+        if self.snapshot_path:
+            self._restore_snapshot()
+            self._snapshot_job = self.schedule_every(
+                float(config.get('snapshot_interval', self.SNAPSHOT_INTERVAL)),
+                self.save_snapshot)
 
         self.api.connect(config['room_id'])
         self.api.ws.on_error = handle_error
@@ -133,12 +411,170 @@ class LazySusan(object):
                 return False
             to_add[command] = getattr(plugin, func_name)
         self.commands.update(to_add)
+        self._build_command_registry()
         return True
 
+    @staticmethod
+    def _parse_chat_server(value):
+        """Return a [host, port] list from a `host:port` string, or None."""
+        if not value:
+            return None
+        host, _, port = value.strip().rpartition(':')
+        if not host or not port.isdigit():
+            raise LazySusanException('Invalid chat_server `{0}`. Expected '
+                                     '`host:port`.'.format(value))
+        return [host, int(port)]
+
+    @staticmethod
+    def _parse_pairs(value, kind):
+        """Return a dictionary from a multi-line config value.
+
+        Each line contains a key followed by its value, for example the alias
+        `/pl /playlists` or the flood limit `/pllist 2/30`.
+
+        """
+        pairs = {}
+        for line in value.split('\n'):
+            parts = line.split()
+            if len(parts) == 2:
+                pairs[parts[0]] = parts[1]
+            elif parts:
+                print('Ignoring invalid {0} `{1}`.'.format(kind, line.strip()))
+        return pairs
+
+    def _build_command_registry(self):
+        """Rebuild the registry used to resolve commands after they change."""
+        self._command_registry = CommandRegistry(
+            self.commands, self._command_aliases, self)
+
+    def _close_queue(self, plugin_name):
+        """Discard the work waiting on the plugin's queue."""
+        queue = self.api.queues.pop(plugin_name, None)
+        if queue is not None:
+            queue.close()
+
+    def _dispatch_scheduled(self, callback, args, kwargs):
+        """Run a scheduled callback in the context of the event handlers.
+
+        The jobs of plugins with a queue run on that queue instead.
+
+        """
+        owner = getattr(getattr(callback, 'im_self', None), 'NAME', None)
+        if self.stats is not None:
+            callback = self.stats.wrap(
+                callback, ('job', getattr(callback, '__name__', '?')),
+                ('plugin', owner or 'core'))
+        queue = self.api.queues.get(owner) if owner else None
+        if queue is not None:
+            queue.submit(self.api.run_as, None, owner,
+                         partial(callback, *args, **kwargs))
+            return
+        with self.api.lock:
+            if self.api.profiler is None:
+                self.api.run_as(None, owner, callback, *args, **kwargs)
+            else:
+                self.api.profiler.call(self.api.run_as, None, owner,
+                                       callback, *args, **kwargs)
+
+    def _pending_jobs(self, now):
+        """Return the snapshot entries of the jobs that can be restored.
+
+        Those are the pending one-off jobs that call a method of the bot or
+        of a loaded plugin with arguments that are serializable as JSON.
+
+        """
+        owners = dict((id(plugin), name) for name, plugin
+                      in self._loaded_plugins.items())
+        owners[id(self)] = None
+        entries = []
+        for job in list(self._jobs):
+            instance = getattr(job.callback, 'im_self', None)
+            if not job.active or job.interval or id(instance) not in owners:
+                continue
+            entry = [owners[id(instance)], job.callback.__name__,
+                     list(job.args), job.kwargs, job.deadline - now]
+            try:
+                json.dumps(entry)
+            except (TypeError, ValueError):
+                continue
+            entries.append(entry)
+        return entries
+
+    def _restore_snapshot(self):
+        """Restore the state written by save_snapshot, if there is any.
+
+        The room's users are only restored when the snapshot is of the room
+        the bot is joining and is at most snapshot_max_age seconds old.
+
+        """
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            # Read every field first so that nothing is restored from a
+            # snapshot that turns out to be incomplete
+            age = time.time() - snapshot['saved']
+            username, room_id, max_djs, users, plugins, jobs = [
+                snapshot[x] for x in ('username', 'room_id', 'max_djs',
+                                      'users', 'plugins', 'jobs')]
+            plugins = dict(plugins)
+            jobs = [tuple(x) for x in jobs]
+        except IOError:
+            return  # No snapshot has been written yet
+        except (KeyError, TypeError, ValueError):
+            print('Ignoring invalid snapshot `{0}`.'
+                  .format(self.snapshot_path))
+            return
+        self.username = username
+        if room_id == self.config['room_id'] and age <= float(
+                self.config.get('snapshot_max_age', self.SNAPSHOT_MAX_AGE)):
+            self.max_djs = max_djs
+            self.users.set_state(users)
+        for plugin_name, state in plugins.items():
+            if plugin_name in self._loaded_plugins:
+                self._set_plugin_state(plugin_name, state)
+        for owner, name, args, kwargs, remaining in jobs:
+            instance = self if owner is None \
+                else self._loaded_plugins.get(owner)
+            callback = getattr(instance, name, None)
+            if callable(callback):
+                instance.schedule(max(0, remaining - age), callback, *args,
+                                  **kwargs)
+        print('Restored the snapshot from {0:.0f} seconds ago.'.format(age))
+
+    def _run_command(self, context, owner, command, descriptor, message,
+                     data):
+        """Run a command that flood control admitted as context."""
+        start = time.time()
+        try:
+            self.api.run_as(context, owner, descriptor.guard, message, data)
+        finally:
+            if self.stats is not None:
+                keys = [('command', command)]
+                if owner:
+                    keys.append(('plugin', owner))
+                self.stats.record(keys, time.time() - start)
+            with self.api.lock:
+                context.finished()
+
+    @display_exceptions
+    def _set_plugin_state(self, plugin_name, state):
+        """Restore the state of the plugin from a snapshot."""
+        self.api.run_as(None, plugin_name,
+                        self._loaded_plugins[plugin_name].set_state, state)
+
+    def _update_room(self, data):
+        """Replace the room's state with that of a room.info response."""
+        metadata = data['room']['metadata']
+        self.max_djs = metadata['max_djs']
+        self.users.reconcile(((x['userid'], x.get('name')) for x in
+                              data['users']), metadata['djs'],
+                             metadata['moderator_id'])
+
     def _unload_command_plugin(self, plugin):
         """Unload a plugin (by name) that responds to commands."""
         for command in plugin.COMMANDS:
             del self.commands[command]
+        self._build_command_registry()
 
     @no_arg_command
     def cmd_about(self, data):
@@ -150,42 +586,12 @@ class LazySusan(object):
     @no_arg_command
     def cmd_commands(self, data):
         """List the available commands."""
-
-        admin_cmds = []
-        admin_or_moderator_cmds = []
-        moderator_cmds = []
-        no_priv_cmds = []
-
-        for command, func in self.commands.items():
-            if func.func_dict.get('dynamic_permissions'):
-                # TODO: Handle this case
-                pass
-            elif func.func_dict.get('admin_required'):
-                admin_cmds.append(command)
-            elif func.func_dict.get('admin_or_moderator_required'):
-                admin_or_moderator_cmds.append(command)
-            elif func.func_dict.get('moderator_required'):
-                moderator_cmds.append(command)
-            else:
-                no_priv_cmds.append(command)
-        reply = 'Available commands: '
-        reply += ', '.join(sorted(no_priv_cmds))
-        self.reply(reply, data)
-
         user_id = get_sender_id(data)
-        if moderator_cmds and self.is_moderator(user_id):
-            reply = 'Moderator commands: '
-            reply += ', '.join(sorted(moderator_cmds))
-            self.api.pm(reply, user_id)
-        if admin_or_moderator_cmds and (self.is_moderator(user_id)
-                                        or self.is_admin(user_id)):
-            reply = 'Priviliged commands: '
-            reply += ', '.join(sorted(admin_or_moderator_cmds))
-            self.api.pm(reply, user_id)
-        if admin_cmds and self.is_admin(user_id):
-            reply = 'Admin commands: '
-            reply += ', '.join(sorted(admin_cmds))
-            self.api.pm(reply, user_id)
+        listings = self._command_registry.listings(self.is_admin(user_id),
+                                                   self.is_moderator(user_id))
+        self.reply(listings[0], data)
+        for reply in listings[1:]:  # Only list privileged commands privately
+            self.pm(reply, user_id)
 
     def _connect(self, room_id, when_connected=True):
         """Internal function to handling joining rooms.
@@ -204,25 +610,16 @@ class LazySusan(object):
     def cmd_help(self, message, data):
         """With no arguments, display this message. Otherwise, display the help
         for the given command. Type /commands to see the list of commands."""
-        def docstr(item):
-            """Return a stripped version of a command function's docstring."""
-            lines = []
-            for line in item.__doc__.split('\n'):
-                line = line.strip()
-                if line:
-                    lines.append(line)
-            return ' '.join(lines)
-
         if not message:
-            reply = docstr(self.cmd_help)
+            reply = self._command_registry['/help'].help
         elif ' ' not in message:
-            if message in self.commands:
-                tmp = self.commands[message].func_dict
-                if tmp.get('admin_required') and not self.is_admin(data) or \
-                        tmp.get('moderator_required') and \
-                        not self.is_moderator(data):
+            command = self._command_registry.resolve(message)
+            if command:
+                descriptor = self._command_registry[command]
+                if not descriptor.allowed(self.is_admin(data),
+                                          self.is_moderator(data)):
                     return
-                reply = docstr(self.commands[message])
+                reply = descriptor.help
             else:
                 reply = '`{0}` is not a valid command.'.format(message)
         else:
@@ -244,21 +641,19 @@ class LazySusan(object):
 
     @admin_required
     @no_arg_command
+    @coroutine
     def cmd_leave(self, data):
         """Leave the current room and remain connected to the chat server."""
-        def callback(cb_data):
-            """Handle the response from the roomDeregister API call."""
-            user_id = get_sender_id(data)
-            if cb_data['success']:
-                # Schedule an event to possibly rejoin after 1 minute
-                self.schedule(60, self._connect, self.config['room_id'], False)
-                self.api.pm('I have left the room. If I remain roomless after '
-                            '~1 minute, I will rejoin the default room.',
-                            user_id)
-            else:
-                self.api.pm('Leaving the room failed.', user_id)
         print('Leaving {0}'.format(self.api.roomId))
-        self.api.roomDeregister(callback)
+        response = yield self.api.request('roomDeregister')
+        user_id = get_sender_id(data)
+        if response['success']:
+            # Schedule an event to possibly rejoin after 1 minute
+            self.schedule(60, self._connect, self.config['room_id'], False)
+            self.pm('I have left the room. If I remain roomless after '
+                    '~1 minute, I will rejoin the default room.', user_id)
+        else:
+            self.pm('Leaving the room failed.', user_id)
 
     @admin_required
     @single_arg_command
@@ -305,6 +700,28 @@ class LazySusan(object):
         reply += ', '.join(sorted(self._loaded_plugins.keys()))
         self.reply(reply, data)
 
+    @admin_required
+    def cmd_stats(self, message, data):
+        """Privately list the api requests in flight, the plugin queues and
+        processes, and the slowest handlers by total time.
+
+        Optionally limit the list to one kind: event, plugin, command or job.
+        Statistics are only collected when LazySusan is started with --stats.
+        """
+        lines = [self.api.tracker.summary()]
+        lines.extend(self.api.queues[x].summary()
+                     for x in sorted(self.api.queues))
+        lines.extend(self._loaded_plugins[x].summary()
+                     for x in sorted(self._remote_plugins)
+                     if x in self._loaded_plugins)
+        if self.stats is None:
+            lines.append('Handler statistics are disabled. Restart with '
+                         '--stats to enable them.')
+        else:
+            lines.extend(self.stats.summary(kind=message or None)
+                         or ['No statistics have been collected.'])
+        self.pm(' | '.join(lines), get_sender_id(data))
+
     @no_arg_command
     def cmd_uptime(self, data):
         """Display how long since LazySusan was started."""
@@ -315,7 +732,7 @@ class LazySusan(object):
         """item can be either the user_id, or a dictionary from a message."""
         if isinstance(item, dict):
             item = get_sender_id(item)
-        return item in self.config['admin_ids']
+        return item in self.admin_ids
 
     def is_moderator(self, item):
         """item can be either the user_id, or a dictionary from a message."""
@@ -323,10 +740,9 @@ class LazySusan(object):
             item = get_sender_id(item)
         return item in self.moderator_ids
 
-    def handle_add_dj(self, data):
-        """Handle the event indicating a new dj stepped up to the table."""
-        for user in data['user']:
-            self.dj_ids.add(user['userid'])
+    def roles(self, user_id):
+        """Return an (is_admin, is_moderator) tuple for the user."""
+        return user_id in self.admin_ids, user_id in self.moderator_ids
 
     def handle_booted_user(self, data):
         """Handle the event indicating a user was booted from the room."""
@@ -335,36 +751,21 @@ class LazySusan(object):
             self.api.roomId = None
             self.schedule(30, self._connect, self.config['room_id'], False)
 
-    def handle_add_moderator(self, data):
-        """Handle the event indicating a user was promoted to moderator."""
-        self.moderator_ids.add(data['userid'])
-
     def handle_pm(self, data):
         """Handle the event indicating LazySusan received a private message."""
         self.process_message(data)
 
+    @coroutine
     def handle_ready(self, _):
         """Handle the event indicating LazySusan has connected to turntable."""
-        def callback(cb_data):
-            """Handle response to the userInfo API call."""
-            self.username = cb_data['name']
-        self.api.userInfo(callback)
-
-    @display_exceptions
-    def handle_remove_dj(self, data):
-        """Handle the event indicating user has left the dj table."""
-        for user in data['user']:
-            self.dj_ids.remove(user['userid'])
-
-    @display_exceptions
-    def handle_remove_moderator(self, data):
-        """Handle the event indicating a user was demoted from moderator."""
-        self.moderator_ids.remove(data['userid'])
+        response = yield self.api.request('userInfo')
+        if response['success']:
+            self.username = response['name']
 
     def handle_room_change(self, data):
         """Handle the response to a room connect event (_connect)."""
         if not data['success']:
-            if data['errno'] == 3:
+            if data.get('errno') == 3:
                 print('You are banned from that room. Retrying in 3 minutes.')
                 self.schedule(180, self._connect, self.config['room_id'],
                               False)
@@ -374,10 +775,7 @@ class LazySusan(object):
             self.api.roomId = None
             self._connect(self.config['room_id'])
             return
-        self.dj_ids = set(data['room']['metadata']['djs'])
-        self.listener_ids = set(x['userid'] for x in data['users'])
-        self.max_djs = data['room']['metadata']['max_djs']
-        self.moderator_ids = set(data['room']['metadata']['moderator_id'])
+        self._update_room(data)
 
     @display_exceptions
     def handle_room_message(self, data):
@@ -385,16 +783,16 @@ class LazySusan(object):
         if self.username and self.username != data['name']:
             self.process_message(data)
 
-    def handle_user_join(self, data):
-        """Handle the event indicating a user joined the room."""
-        for user in data['user']:
-            self.listener_ids.add(user['userid'])
+    def handle_room_info(self, data):
+        """Handle the room information requested by reconcile_users."""
+        if data['success'] and data['room']['roomid'] == self.api.roomId:
+            self._update_room(data)
+            self.api.emit('users_reconciled', data)
 
-    @display_exceptions
-    def handle_user_leave(self, data):
-        """Handle the event indicating a user left the room."""
-        for user in data['user']:
-            self.listener_ids.remove(user['userid'])
+    def handle_user_update(self, data):
+        """Handle the events indicating a user joined or left the room, or
+        the dj table, or became or stopped being a moderator."""
+        self.users.update(data)
 
     def load_plugin(self, plugin_name, attempt_reload=False):
         """Load a LazySusan plugin by name.
@@ -406,103 +804,197 @@ class LazySusan(object):
         :param attempt_reload: Must be set to True in order to reload an
             already loaded plugin.
 
+        Plugins flagged with `process` in lazysusan.ini are loaded into a
+        process of their own, and represented by a RemotePlugin.
+
         """
-        parts = plugin_name.split('.')
-        if len(parts) > 1:
-            module_name = '.'.join(parts[:-1])
-            class_name = parts[-1]
-        else:
-            # Use the titlecase format of the module name as the class name
-            module_name = parts[0]
-            class_name = parts[0].title()
-
-        # First try to load plugins from the passed in plugins_dir and then
-        # from the lazysusan.plugins package.
-        module = None
-        for package in (None, 'lazysusan.plugins'):
-            if package:
-                module_name = '{0}.{1}'.format(package, module_name)
-
-            if attempt_reload and module_name in sys.modules:
-                module = reload(sys.modules[module_name])
-            else:
-                try:
-                    module = __import__(module_name, fromlist=[class_name])
-                except ImportError:
-                    pass
-            if module:
-                break
-        if not module:
-            print('Cannot find plugin `{0}`.'.format(plugin_name))
+        if plugin_name in self._loaded_plugins:
+            print('Plugin `{0}` is already loaded.'.format(plugin_name))
             return False
-        try:
-            plugin = getattr(module, class_name)(self)
-        except AttributeError:
-            print('Cannot find plugin `{0}`.'.format(plugin_name))
-            return False
-
-        plugin.__class__.NAME = plugin_name
+        remote = plugin_name in self._remote_plugins
+        if remote:
+            plugin_class = RemotePlugin
+        else:
+            plugin_class = find_plugin(plugin_name, attempt_reload)
+            if plugin_class is None:
+                return False
+            # Set the name first so that it is available to the constructor
+            plugin_class.NAME = plugin_name
+        if self.host.pool is not None:
+            self.api.queues[plugin_name] = SerialQueue(
+                self.host.pool, plugin_name, **self._queue_options)
+        if not remote:
+            plugin = self.api.run_as(None, plugin_name, plugin_class, self)
+        else:
+            try:
+                plugin = self.api.run_as(None, plugin_name, plugin_class, self,
+                                         plugin_name, attempt_reload)
+            except PluginException as exc:
+                print(exc.message)
+                self._close_queue(plugin_name)
+                return False
         if isinstance(plugin, CommandPlugin):
             if not self._load_command_plugin(plugin):
+                plugin.cleanup()
+                self._close_queue(plugin_name)
                 return
         self._loaded_plugins[plugin_name] = plugin
         print('Loaded plugin `{0}`.'.format(plugin_name))
         return True
 
     def process_message(self, data):
-        """Parse messages and invoke a command_plugin if appropriate."""
-        parts = data['text'].split()
-        if not parts:
+        """Parse messages and invoke a command_plugin if appropriate.
+
+        Most messages are not commands, so they are rejected by their first
+        character before any further parsing takes place. Commands from users
+        that exceed their flood limits are dropped without a reply.
+
+        """
+        text = data['text']
+        if text[:1].isspace():
+            text = text.lstrip()
+        if text[:1] not in self._command_registry.first_chars:
+            return
+        parts = text.split(None, 1)
+        command = self._command_registry.resolve(parts[0])
+        if not command:
             return
-        command = parts[0]
         if len(parts) == 1:
             message = ''
         else:
-            message = ' '.join(parts[1:])  # Normalize with single spaces
-        handler = self.commands.get(command)
-        if not handler:
+            message = ' '.join(parts[1].split())  # Normalize spaces
+        # Drop messages the command would ignore before they count as floods
+        descriptor = self._command_registry[command]
+        arity = descriptor.arity
+        if arity == 0 and message or arity == 1 and (not message
+                                                     or ' ' in message):
             return
-        handler(message, data)
-
-    def reply(self, message, data):
+        user_id = get_sender_id(data)
+        context = self.flood.admit(user_id, command, self.is_admin(user_id))
+        if context is None:
+            return
+        plugin = getattr(descriptor.function, 'im_self', None)
+        owner = plugin.NAME if isinstance(plugin, CommandPlugin) else None
+        queue = self.api.queues.get(owner) if owner else None
+        if queue is None:
+            self._run_command(context, owner, command, descriptor, message,
+                              data)
+        else:  # Flood control already limits commands, so they are kept
+            queue.submit(self._run_command, context, owner, command,
+                         descriptor, message, data, droppable=False)
+
+    def pm(self, message, user_id, bulk=False):
+        """Queue a private message to user_id.
+
+        Bulk messages, such as progress notifications, are sent after all
+        queued interactive messages."""
+        with self.api.lock:
+            self.outbox.send(message, user_id, BULK if bulk else INTERACTIVE)
+
+    def reply(self, message, data, bulk=False):
         """Reply to a command on the same stream (pm/room chat) as invoked."""
         if data['command'] == 'speak':
-            self.api.speak(message)
+            self.speak(message, bulk)
         elif data['command'] == 'pmmed':
-            self.api.pm(message, data['senderid'])
+            self.pm(message, data['senderid'], bulk)
         else:
             raise Exception('Unrecognized command type `{0}`'
                             .format(data['command']))
 
-    def run_delayed_events(self, _):
-        """Run scheduled events whose min_delay time has expired."""
-        now = time.time()
-        process = True
-        while process and self._delayed_events:
-            item = self._delayed_events[0]  # Peek at the top
-            if item[0] < now:
-                heapq.heappop(self._delayed_events)  # Actually remove
-                item[1](*item[2], **item[3])
-            else:
-                process = False
+    def reconcile_users(self):
+        """Correct the room's users, which missed events may have left wrong.
+
+        Every RECONCILE_INTERVAL seconds, or users_reconcile_interval if
+        configured, the room's information is requested and replaces the
+        user registry's contents. The `users_reconciled` event follows."""
+        if self.api.roomId:
+            self.api.roomInfo(self.handle_room_info)
+
+    def room_directory(self):
+        """Return the directory of rooms, which the bot's host may share."""
+        return self.host.room_directory(self.api)
+
+    def save_snapshot(self):
+        """Atomically write the bot's state to snapshot_path, if configured.
+
+        The snapshot holds the room's users, the state returned by each
+        plugin's get_state, and the pending jobs that can be restored (see
+        _pending_jobs). It is restored when the bot next starts."""
+        if not self.snapshot_path:
+            return
+        with self.api.lock:
+            now = time.time()
+            plugins = {}
+            for plugin_name, plugin in self._loaded_plugins.items():
+                state = display_exceptions(plugin.get_state)()
+                try:
+                    json.dumps(state)
+                except (TypeError, ValueError):
+                    print('Cannot save the state of plugin `{0}`.'
+                          .format(plugin_name))
+                    continue
+                if state is not None:
+                    plugins[plugin_name] = state
+            snapshot = {'jobs': self._pending_jobs(now),
+                        'max_djs': self.max_djs, 'plugins': plugins,
+                        'room_id': self.api.roomId, 'saved': now,
+                        'username': self.username,
+                        'users': self.users.get_state()}
+        try:
+            write_atomically(self.snapshot_path, json.dumps(snapshot))
+        except (IOError, OSError) as exc:
+            print('Cannot write the snapshot `{0}`: {1}'
+                  .format(self.snapshot_path, exc))
 
     def schedule(self, min_delay, callback, *args, **kwargs):
         """Schedule an event to occur at least min_delay seconds in the future.
 
         The passed in callback function will be called with all remaining
-        arguments.
-
-        Scheduled events are checked and processed after every received message
-        from turntable. In an inactive room the longest duration between
-        received messages is 12 seconds."""
-        schedule_time = time.time() + min_delay
-        heapq.heappush(self._delayed_events,
-                       (schedule_time, callback, args, kwargs))
+        arguments. Return a Job handle that can be used to `cancel` or
+        `reschedule` the event, or to make it recur `every` so many seconds.
+
+        Scheduled events run on the scheduler thread as soon as their deadline
+        passes, regardless of whether or not turntable is sending messages."""
+        job = self.scheduler.schedule(min_delay, callback, args, kwargs,
+                                      dispatch=self._dispatch_scheduled)
+        self._jobs.add(job)
+        return job
+
+    def schedule_every(self, interval, callback, *args, **kwargs):
+        """Schedule an event to occur every interval seconds.
+
+        The first occurrence is interval seconds in the future. Return a Job
+        whose `cancel` method stops the recurring event."""
+        return self.scheduler.schedule(interval, callback, args, kwargs,
+                                       interval=interval,
+                                       dispatch=self._dispatch_scheduled)
+
+    def speak(self, message, bulk=False):
+        """Queue a message to the bot's current room."""
+        with self.api.lock:
+            self.outbox.send(message, None, BULK if bulk else INTERACTIVE)
 
     def start(self):
         """Start LazySusan."""
         self.api.start()
 
+    def stop(self):
+        """Save a snapshot, unload every plugin and disconnect, which makes
+        `start` return."""
+        self.save_snapshot()
+        with self.api.lock:
+            for plugin_name in list(self._loaded_plugins):
+                self.unload_plugin(plugin_name)
+            for job in (self._evict_job, self._reconcile_job,
+                        self._snapshot_job):
+                if job:
+                    job.cancel()
+            self.outbox.clear()
+            self.api.tracker.clear()
+            ws, self.api.ws = self.api.ws, None
+        if ws:
+            ws.close()
+
     def unload_plugin(self, plugin_name):
         """Unload a LazySusan plugin by name."""
         if plugin_name not in self._loaded_plugins:
@@ -510,12 +1002,114 @@ class LazySusan(object):
         plugin = self._loaded_plugins[plugin_name]
         if isinstance(plugin, CommandPlugin):
             self._unload_command_plugin(plugin)
+        plugin.cleanup()
+        self._close_queue(plugin_name)
         del self._loaded_plugins[plugin_name]
         del plugin
         print('Unloaded plugin `{0}`.'.format(plugin_name))
         return True
 
 
+class Host(object):
+
+    """Run several bots in a single process.
+
+    The bots share the scheduler thread, the pool of threads that runs plugin
+    work, and a room directory for each chat server they use. Everything
+    else, including the plugins and the state of each room, belongs to a
+    single bot, and each bot's core handlers are serialized by its own api
+    lock. Every bot's connection runs on a thread of its own because ttapi's
+    websocket client blocks while reading.
+
+    """
+
+    def __init__(self, threads=None):
+        """Initialize the host.
+
+        :param threads: The number of threads that run plugin work, which
+            defaults to WorkerPool.SIZE. With 0, plugins run on the connection
+            and scheduler threads like the core handlers.
+
+        """
+        self.bots = []
+        self.pool = WorkerPool(threads) if threads != 0 else None
+        self.scheduler = Scheduler()
+        self._added = 0
+        self._directories = {}  # Maps a chat server override to a directory
+        self._started = False
+
+    def add(self, config_section, plugin_dir, enable_logging,
+            enable_stats=False, profile_path=None, room_ids=None):
+        """Add a bot for each room listed in the section's room_id option.
+
+        Return the list of new bots, which are started right away if the host
+        has already been started.
+
+        :param room_ids: The rooms to add bots for, instead of those listed
+            in the section.
+
+        When profiling, every bot after the first writes its profile to the
+        path followed by the bot's number (e.g., `lazysusan.prof.1`).
+
+        """
+        if room_ids is None:
+            room_ids = LazySusan._get_config(config_section)['room_id'].split()
+        bots = []
+        for room_id in room_ids:
+            path = profile_path
+            if path and self._added:
+                path = '{0}.{1}'.format(path, self._added)
+            self._added += 1
+            bots.append(LazySusan(config_section, plugin_dir, enable_logging,
+                                  enable_stats, path, room_id, self))
+        self.bots.extend(bots)
+        if self._started:
+            for bot in bots:
+                self.launch(bot)
+        return bots
+
+    @staticmethod
+    def launch(bot):
+        """Run bot on a thread of its own and return the thread."""
+        thread = threading.Thread(target=bot.start,
+                                  name='lazysusan-{0}-{1}'.format(
+                                      bot.bot_id, bot.config['room_id']))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def remove(self, bot):
+        """Stop bot and remove it from the host."""
+        self.bots.remove(bot)
+        bot.stop()
+
+    def room_directory(self, api):
+        """Return the room directory shared by bots using api's chat server."""
+        key = tuple(api.chat_server or ())
+        if key not in self._directories:
+            self._directories[key] = RoomDirectory(api)
+        return self._directories[key]
+
+    def start(self, block=True):
+        """Start every bot, and unless block is False, run until interrupted.
+
+        A single bot runs on the calling thread when blocking.
+
+        """
+        self._started = True
+        if block and len(self.bots) == 1:
+            self.bots[0].start()
+            return
+        threads = [self.launch(bot) for bot in self.bots]
+        if not block:
+            return
+        try:
+            while any(x.is_alive() for x in threads):
+                time.sleep(1)  # Joining would block KeyboardInterrupt
+        except KeyboardInterrupt:
+            print('Interrupt received.')
+
+
 class TruncateFormatter(logging.Formatter):
 
     """A log formatter that will truncate lines over a certain length."""
@@ -533,13 +1127,30 @@ class TruncateFormatter(logging.Formatter):
 def main():
     """The command-line entry point to LazySusan."""
     parser = OptionParser(version='%prog {0}'.format(__version__))
-    parser.add_option('-c', '--config', metavar='SECTION', default='DEFAULT',
+    parser.add_option('-c', '--config', metavar='SECTION', action='append',
                       help=('Select the config section to load the settings '
-                            'from.'))
+                            'from. Repeat to run several bots in one '
+                            'process.'))
     parser.add_option('-p', '--plugin-dir', metavar='DIR',
                       help='Specify the path to a folder containing plugins.')
     parser.add_option('-l', '--log-file',
                       help='Log all messages to the specified file.')
+    parser.add_option('-s', '--stats', action='store_true',
+                      help=('Record the latency of event handlers, commands '
+                            'and scheduled jobs for the /stats command.'))
+    parser.add_option('-t', '--threads', type='int', metavar='NUM',
+                      help=('Run plugin handlers on NUM threads (default '
+                            '{0}). With 0, plugins run on the connection '
+                            'thread.'
+                            .format(WorkerPool.SIZE)))
+    parser.add_option('-w', '--workers', type='int', metavar='NUM',
+                      help=('Spread the bots across NUM worker processes, '
+                            'restarting workers that crash and rebalancing '
+                            'the bots by event rate.'))
+    parser.add_option('--profile', metavar='FILE',
+                      help=('Profile a sample of the message handling and '
+                            'periodically write the results to FILE for use '
+                            'with the pstats module.'))
     options, _ = parser.parse_args()
 
     if bool(options.log_file):
@@ -555,12 +1166,36 @@ def main():
         handler.setFormatter(formatter)
         logger.addHandler(handler)
 
+    host_options = {'plugin_dir': options.plugin_dir,
+                    'enable_logging': bool(options.log_file),
+                    'enable_stats': options.stats,
+                    'profile_path': options.profile}
+    sections = options.config or ['DEFAULT']
+    if options.workers:
+        try:
+            specs = [(section, room_id) for section in sections for room_id
+                     in LazySusan._get_config(section)['room_id'].split()]
+        except LazySusanException as exc:
+            print(exc.message)
+            sys.exit(1)
+        update_check(__name__, __version__)
+        LazySusan.update_checked = True  # Inherited by the workers
+        Supervisor(specs, options.workers, partial(Host, options.threads),
+                   host_options).run()
+        return
+
+    host = Host(options.threads)
     try:
-        bot = LazySusan(config_section=options.config,
-                        plugin_dir=options.plugin_dir,
-                        enable_logging=bool(options.log_file))
+        for section in sections:
+            host.add(section, **host_options)
     except LazySusanException as exc:
         print(exc.message)
         sys.exit(1)
 
-    bot.start()
+    try:
+        host.start()
+    finally:
+        for bot in host.bots:
+            bot.save_snapshot()
+            if bot.api.profiler:
+                bot.api.profiler.dump()
@@ -0,0 +1,233 @@
+"""Structures used to resolve chat messages into LazySusan commands."""
+
+import traceback
+from lazysusan.helpers import PERMISSION_DENIED, get_sender_id
+
+_AMBIGUOUS = object()
+
+ADMIN = 'admin'
+ADMIN_OR_MODERATOR = 'admin_or_moderator'
+MODERATOR = 'moderator'
+PUBLIC = 'public'
+
+_PERMISSIONS = (('admin_required', ADMIN),
+                ('admin_or_moderator_required', ADMIN_OR_MODERATOR),
+                ('moderator_required', MODERATOR))
+
+
+def _unwrap(function):
+    """Return the undecorated function and the kinds of its decorators.
+
+    Only the outermost run of decorators from lazysusan.helpers is unwrapped;
+    any other decorator is treated as the undecorated function.
+
+    """
+    kinds = []
+    while True:
+        decoration = function.func_dict.get('decoration')
+        if not decoration or decoration[0] is not function:
+            return function, kinds
+        function, kind = decoration[1], decoration[2]
+        kinds.append(kind)
+
+
+def permitted(permission, is_admin, is_moderator):
+    """Return True if a user with the given roles holds permission."""
+    if permission == ADMIN:
+        return is_admin
+    elif permission == ADMIN_OR_MODERATOR:
+        return is_admin or is_moderator
+    elif permission == MODERATOR:
+        return is_moderator
+    return True
+
+
+class _Node(object):
+
+    """A node of the CommandTrie."""
+
+    __slots__ = ('children', 'command', 'target')
+
+    def __init__(self):
+        self.children = {}
+        self.command = None  # The command for a name ending at this node
+        self.target = None  # The only command below this node, if unique
+
+
+class CommandTrie(object):
+
+    """A prefix tree that resolves command names.
+
+    A token resolves to a command when it is the name of the command, an alias
+    of the command, or a prefix shared only by names (and aliases) of that
+    single command. The trie is immutable; build a new one when the set of
+    commands changes.
+
+    """
+
+    def __init__(self, commands, aliases=None):
+        """Build the trie.
+
+        :param commands: An iterable of command names.
+        :param aliases: A dictionary mapping an alias to a command name.
+            Aliases to commands that do not exist are ignored.
+
+        """
+        self._root = _Node()
+        names = dict((x, x) for x in commands)
+        for alias, command in (aliases or {}).items():
+            if command in names and alias not in names:
+                names[alias] = command
+        for name, command in names.items():
+            self._insert(name, command)
+        self.first_chars = frozenset(self._root.children)
+
+    def _insert(self, name, command):
+        """Add the name for command to the trie."""
+        node = self._root
+        for char in name:
+            node.target = command if node.target in (None, command) \
+                else _AMBIGUOUS
+            node = node.children.setdefault(char, _Node())
+        node.target = command if node.target in (None, command) \
+            else _AMBIGUOUS
+        node.command = command
+
+    def resolve(self, token):
+        """Return the command name token refers to, or None."""
+        node = self._root
+        for char in token:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        if node.command:
+            return node.command
+        if node.target is _AMBIGUOUS:
+            return None
+        return node.target
+
+
+class CommandDescriptor(object):
+
+    """The precomputed properties of a command function.
+
+    :ivar arity: 0 for commands that take no argument, 1 for commands that take
+        a single argument and None for commands that accept any message.
+    :ivar guard: A function equivalent to the command that checks its
+        permissions with a single role lookup instead of running each
+        decorator in turn. Arity is not checked; see `arity`.
+    :ivar help: The command's docstring joined into a single line.
+    :ivar permission: One of ADMIN, ADMIN_OR_MODERATOR, MODERATOR or PUBLIC.
+        The current permissions of dynamic_permissions commands are used.
+
+    """
+
+    __slots__ = ('arity', 'function', 'guard', 'help', 'name', 'permission')
+
+    def __init__(self, name, function, bot=None):
+        self.name = name
+        self.function = function
+        undecorated, kinds = _unwrap(getattr(function, 'im_func', function))
+        if 'no_arg_command' in kinds:
+            self.arity = 0
+        elif 'single_arg_command' in kinds:
+            self.arity = 1
+        else:
+            self.arity = None
+        required = [x for x, _ in _PERMISSIONS if x in kinds]
+        self.permission = dict(_PERMISSIONS)[required[0]] if required \
+            else PUBLIC
+        self.help = ' '.join(line.strip() for line in
+                             (function.__doc__ or '').split('\n')
+                             if line.strip())
+        if bot is None or getattr(function, 'im_self', None) is None:
+            self.guard = function
+        else:
+            self.guard = self._compile(bot, function.im_self, undecorated,
+                                       kinds, required)
+
+    @staticmethod
+    def _compile(bot, instance, function, kinds, required):
+        """Return the guard that calls function as its decorators would."""
+        catch = 'display_exceptions' in kinds
+        checks = [(dict(_PERMISSIONS)[x], PERMISSION_DENIED[x])
+                  for x in required]
+        takes_message = 'no_arg_command' not in kinds
+
+        def guard(message, data):  # pylint: disable-msg=C0111
+            if checks:
+                user_id = get_sender_id(data)
+                is_admin, is_moderator = bot.roles(user_id)
+                for permission, denied in checks:
+                    if not permitted(permission, is_admin, is_moderator):
+                        return bot.pm(denied, user_id)
+            args = (instance, message, data) if takes_message \
+                else (instance, data)
+            if not catch:
+                return function(*args)
+            try:
+                return function(*args)
+            except:  # Handle all exceptions -- pylint: disable-msg=W0702
+                traceback.print_exc()
+        return guard
+
+    def allowed(self, is_admin, is_moderator):
+        """Return True if a user with the given roles may run the command."""
+        return permitted(self.permission, is_admin, is_moderator)
+
+
+class CommandRegistry(object):
+
+    """The descriptors of all commands and the listings derived from them.
+
+    The registry is immutable; build a new one when the set of commands
+    changes. Listings are rendered on first use and cached per role.
+
+    """
+
+    LISTINGS = ((PUBLIC, 'Available commands: '),
+                (MODERATOR, 'Moderator commands: '),
+                (ADMIN_OR_MODERATOR, 'Priviliged commands: '),
+                (ADMIN, 'Admin commands: '))
+
+    def __init__(self, commands, aliases=None, bot=None):
+        """Build the registry.
+
+        :param commands: A dictionary mapping command names to functions.
+        :param aliases: A dictionary mapping an alias to a command name.
+        :param bot: The LazySusan instance used by the command guards. Without
+            it the guards are the command functions themselves.
+
+        """
+        self.descriptors = dict((name, CommandDescriptor(name, function, bot))
+                                for name, function in commands.items())
+        self.trie = CommandTrie(commands, aliases)
+        self.first_chars = self.trie.first_chars
+        self.resolve = self.trie.resolve
+        self._listings = {}
+
+    def __getitem__(self, name):
+        return self.descriptors[name]
+
+    def listings(self, is_admin, is_moderator):
+        """Return the command listings visible to a user with the given roles.
+
+        The first listing contains the public commands. The remaining
+        listings, one per permission level the user holds, are only returned
+        when they are not empty.
+
+        """
+        key = (bool(is_admin), bool(is_moderator))
+        if key not in self._listings:
+            by_permission = {}
+            for descriptor in self.descriptors.values():
+                by_permission.setdefault(descriptor.permission, []).append(
+                    descriptor.name)
+            listings = []
+            for permission, title in self.LISTINGS:
+                names = by_permission.get(permission)
+                if permission == PUBLIC or names and permitted(permission,
+                                                               *key):
+                    listings.append(title + ', '.join(sorted(names or [])))
+            self._listings[key] = listings
+        return self._listings[key]
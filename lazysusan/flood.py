@@ -0,0 +1,144 @@
+"""Flood control for the commands users send to LazySusan."""
+
+from __future__ import print_function
+import time
+
+
+def parse_limit(value):
+    """Return a (burst, rate) tuple from a `count/seconds` limit string.
+
+    For example, `5/10` allows a burst of five commands that refills at half a
+    command per second. Return None if the value is invalid.
+
+    """
+    try:
+        count, seconds = value.split('/')
+        count, seconds = int(count), float(seconds)
+    except ValueError:
+        return None
+    if count < 1 or seconds <= 0:
+        return None
+    return count, count / seconds
+
+
+class Command(object):
+
+    """A dispatched command along with the api requests made on its behalf.
+
+    The command is in flight until every request made while it, or the
+    callback of one of its requests, runs has received a response.
+
+    """
+
+    __slots__ = ('flood', 'pending', 'start_time')
+
+    def __init__(self, flood):
+        self.flood = flood
+        self.pending = 1  # Held until the command handler has returned
+        self.start_time = time.time()
+
+    def finished(self):
+        """Release one pending request (or the handler itself)."""
+        self.pending -= 1
+        if self.pending <= 0:
+            self.flood.in_flight.pop(self, None)
+
+    def sent(self):
+        """Record a request made on behalf of the command."""
+        self.pending += 1
+
+
+class FloodControl(object):
+
+    """Token buckets that limit how often each user may run commands.
+
+    Every user has a bucket shared by all commands, and commands may have
+    their own, tighter, per-user buckets. Buckets are stored as
+    [tokens, timestamp] lists keyed by user id or (user id, command) and are
+    evicted once they have refilled. In addition, no new commands are admitted
+    while `max_in_flight` commands are waiting for api responses.
+
+    """
+
+    EVICT_INTERVAL = 300
+    MAX_IN_FLIGHT = 8
+    TIMEOUT = 60  # Commands in flight for longer are assumed to be lost
+    USER_LIMIT = '5/10'
+
+    def __init__(self, user_limit=None, command_limits=None,
+                 max_in_flight=None):
+        """Initialize the flood control.
+
+        :param user_limit: A `count/seconds` limit applied to each user.
+        :param command_limits: A dictionary mapping a command to a
+            `count/seconds` limit applied per user.
+        :param max_in_flight: The number of commands that can wait for api
+            responses at once.
+
+        """
+        self.user_limit = parse_limit(user_limit or self.USER_LIMIT)
+        if not self.user_limit:
+            print('Ignoring invalid flood limit `{0}`.'.format(user_limit))
+            self.user_limit = parse_limit(self.USER_LIMIT)
+        self.command_limits = {}
+        for command, limit in (command_limits or {}).items():
+            parsed = parse_limit(limit)
+            if parsed:
+                self.command_limits[command] = parsed
+            else:
+                print('Ignoring invalid flood limit `{0}` for `{1}`.'
+                      .format(limit, command))
+        self.max_in_flight = int(max_in_flight or self.MAX_IN_FLIGHT)
+        self.buckets = {}
+        self.dropped = 0
+        self.in_flight = {}  # Used as a set of Commands
+
+    @staticmethod
+    def _take(bucket, limit, now):
+        """Refill the bucket and return True if it holds a whole token."""
+        burst, rate = limit
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket[0] >= 1
+
+    def admit(self, user_id, command, exempt=False):
+        """Return a Command if user_id may run command now, otherwise None.
+
+        Exempt users bypass the limits, but their commands are still tracked.
+
+        """
+        if not exempt:
+            now = time.time()
+            if len(self.in_flight) >= self.max_in_flight:
+                for other in list(self.in_flight):
+                    if now - other.start_time > self.TIMEOUT:
+                        del self.in_flight[other]
+                if len(self.in_flight) >= self.max_in_flight:
+                    self.dropped += 1
+                    return None
+            buckets = [(self.buckets.setdefault(
+                user_id, [self.user_limit[0], now]), self.user_limit)]
+            if command in self.command_limits:
+                command_limit = self.command_limits[command]
+                buckets.append((self.buckets.setdefault(
+                    (user_id, command), [command_limit[0], now]),
+                    command_limit))
+            # Check every bucket before taking a token from any of them
+            if not all([self._take(bucket, limit, now)
+                        for bucket, limit in buckets]):
+                self.dropped += 1
+                return None
+            for bucket, _ in buckets:
+                bucket[0] -= 1
+        context = Command(self)
+        self.in_flight[context] = None
+        return context
+
+    def evict(self):
+        """Remove the buckets that have refilled completely."""
+        now = time.time()
+        for key, bucket in list(self.buckets.items()):
+            limit = self.command_limits[key[1]] if isinstance(key, tuple) \
+                else self.user_limit
+            if bucket[0] + (now - bucket[1]) * limit[1] >= limit[0]:
+                del self.buckets[key]
@@ -1,9 +1,29 @@
 """A collection of useful functions for LazySusan."""
 
+import os
+import tempfile
 import traceback
 from functools import wraps
 from lazysusan.plugins import CommandPlugin
 
+PERMISSION_DENIED = {
+    'admin_required': 'You must be an admin to execute that command.',
+    'admin_or_moderator_required': ('You must be either an admin or a '
+                                    'moderator to execute that command.'),
+    'moderator_required': 'You must be a moderator to execute that command.'}
+
+
+def _decorated(wrapper, function, kind):
+    """Record that wrapper applies the decorator `kind` to function.
+
+    This allows CommandDescriptor to flatten a stack of these decorators into
+    a single guard. The wrapper is recorded too, as functools.wraps copies the
+    record to any outer wrapper.
+
+    """
+    wrapper.func_dict['decoration'] = (wrapper, function, kind)
+    return wrapper
+
 
 def admin_required(function):
     """A command decorator that requires an admin to run.
@@ -19,14 +39,12 @@ def admin_required(function):
         else:  # Support the built-in commands
             bot = cls
 
-        user_id = get_sender_id(args[1])
-        # Verify the user is a moderator
-        if user_id not in bot.config['admin_ids']:
-            message = 'You must be an admin to execute that command.'
-            return bot.api.pm(message, user_id)
+        user_id = get_sender_id(args[-1])
+        if not bot.is_admin(user_id):
+            return bot.pm(PERMISSION_DENIED['admin_required'], user_id)
         return function(cls, *args, **kwargs)
     wrapper.func_dict['admin_required'] = True
-    return wrapper
+    return _decorated(wrapper, function, 'admin_required')
 
 
 def admin_or_moderator_required(function):
@@ -42,16 +60,13 @@ def admin_or_moderator_required(function):
         else:  # Support the built-in commands
             bot = cls
 
-        user_id = get_sender_id(args[1])
-        # Verify the user is a moderator
-        if user_id not in bot.moderator_ids \
-                and user_id not in bot.config['admin_ids']:
-            message = ('You must be either an admin or a moderator to execute '
-                       'that command.')
-            return bot.api.pm(message, user_id)
+        user_id = get_sender_id(args[-1])
+        if not (bot.is_moderator(user_id) or bot.is_admin(user_id)):
+            return bot.pm(PERMISSION_DENIED['admin_or_moderator_required'],
+                          user_id)
         return function(cls, *args, **kwargs)
     wrapper.func_dict['admin_or_moderator_required'] = True
-    return wrapper
+    return _decorated(wrapper, function, 'admin_or_moderator_required')
 
 
 def display_exceptions(function):
@@ -62,7 +77,7 @@ def display_exceptions(function):
             return function(*args, **kwargs)
         except:  # Handle all exceptions -- pylint: disable-msg=W0702
             traceback.print_exc()
-    return wrapper
+    return _decorated(wrapper, function, 'display_exceptions')
 
 
 def dynamic_permissions(admin=False, mod=False):
@@ -74,8 +89,8 @@ def dynamic_permissions(admin=False, mod=False):
             return dyn(*args, **kwargs)
 
         dyn = DynamicPermissions(function, mod=mod, admin=admin)
-        wrapper.func_dict['dynamic_permissions'] = True
-        return wrapper
+        wrapper.func_dict['dynamic_permissions'] = dyn
+        return _decorated(wrapper, dyn.wrapped, 'dynamic_permissions')
     return generator
 
 
@@ -90,6 +105,22 @@ def get_sender_id(data):
                         .format(data['command']))
 
 
+def write_atomically(path, text):
+    """Replace the file at path with text, so that readers never see a partly
+    written file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(text)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)  # Windows cannot rename over an existing file
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
 def moderator_required(function):
     """A command decorator that requires a moderator to run.
 
@@ -107,14 +138,12 @@ def moderator_required(function):
         else:  # Support the built-in commands
             bot = cls
 
-        user_id = get_sender_id(args[1])
-        # Verify the user is a moderator
-        if user_id not in bot.moderator_ids:
-            message = 'You must be a moderator to execute that command.'
-            return bot.api.pm(message, user_id)
+        user_id = get_sender_id(args[-1])
+        if not bot.is_moderator(user_id):
+            return bot.pm(PERMISSION_DENIED['moderator_required'], user_id)
         return function(cls, *args, **kwargs)
     wrapper.func_dict['moderator_required'] = True
-    return wrapper
+    return _decorated(wrapper, function, 'moderator_required')
 
 
 def no_arg_command(function):
@@ -124,7 +153,7 @@ def no_arg_command(function):
         if message:
             return
         return function(cls, *args, **kwargs)
-    return wrapper
+    return _decorated(wrapper, function, 'no_arg_command')
 
 
 def single_arg_command(function):
@@ -134,7 +163,7 @@ def single_arg_command(function):
         if not args[0] or ' ' in args[0]:  # Input will only contain spaces
             return
         return function(cls, *args, **kwargs)
-    return wrapper
+    return _decorated(wrapper, function, 'single_arg_command')
 
 
 class DynamicPermissions(object):
@@ -0,0 +1,253 @@
+"""An index for finding names from partial or misspelled input."""
+
+import math
+from collections import deque
+
+
+def _trigrams(text):
+    """Return the set of three character substrings of text."""
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def prefix_distance(query, name, limit):
+    """Return the edit distance between query and the closest prefix of name.
+
+    Swapping two adjacent characters counts as a single edit. Return
+    limit + 1 as soon as the distance is known to exceed limit.
+
+    """
+    name = name[:len(query) + limit]
+    before = None
+    previous = list(range(len(name) + 1))
+    for i, char in enumerate(query):
+        current = [i + 1]
+        for j, other in enumerate(name):
+            distance = min(previous[j + 1] + 1, current[j] + 1,
+                           previous[j] + (char != other))
+            if i and j and char == name[j - 1] and query[i - 1] == other:
+                distance = min(distance, before[j - 1] + 1)
+            current.append(distance)
+        # A swap reaches back a row, so both rows must exceed limit
+        if min(current) > limit and min(previous) >= limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous)
+
+
+class NameIndex(object):
+
+    """A set of names that supports prefix, substring and fuzzy lookups.
+
+    Names are matched case-insensitively, though names that differ only in
+    case are kept apart and an exact match is preferred. A prefix trie
+    answers prefix queries and a trigram index narrows substring and
+    misspelled queries to a few candidates, so lookups do not scan every
+    name. Names can be added and removed at any time.
+
+    """
+
+    FUZZY_MAX_POSTING = 0.05
+    FUZZY_MIN_SIMILARITY = 0.3
+    FUZZY_SCAN_SIZE = 100
+
+    def __init__(self, names=()):
+        self._names = {}  # Maps a folded name to the set of original names
+        self._trie = {}
+        self._trigrams = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return name in self._names.get(name.lower(), ())
+
+    def __iter__(self):
+        for names in self._names.values():
+            for name in names:
+                yield name
+
+    def __len__(self):
+        return sum(len(x) for x in self._names.values())
+
+    def _accepted(self, folded, accept, exact=None):
+        """Return the accepted names that fold to folded, exact first."""
+        names = self._names[folded]
+        if len(names) == 1:  # The common case
+            name, = names
+            return [name] if accept is None or accept(name) else []
+        return sorted((x for x in self._names[folded]
+                       if accept is None or accept(x)),
+                      key=lambda x: (x != exact, x))
+
+    def _prefixed(self, prefix, limit, accept):
+        """Return up to limit folded names that begin with prefix.
+
+        The trie is searched breadth first so shorter names are found first.
+
+        """
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        found = []
+        queue = deque([node])
+        while queue and len(found) < limit:
+            node = queue.popleft()
+            if None in node and self._accepted(node[None], accept):
+                found.append(node[None])
+            for char in sorted(x for x in node if x is not None):
+                queue.append(node[char])
+        return found
+
+    def add(self, name):
+        """Add a name to the index."""
+        folded = name.lower()
+        if folded in self._names:
+            self._names[folded].add(name)
+            return
+        self._names[folded] = set([name])
+        node = self._trie
+        for char in folded:
+            node = node.setdefault(char, {})
+        node[None] = folded
+        for trigram in _trigrams(folded):
+            self._trigrams.setdefault(trigram, set()).add(folded)
+
+    def discard(self, name):
+        """Remove a name from the index if it is present.
+
+        Names that differ from it only in case remain.
+
+        """
+        folded = name.lower()
+        names = self._names.get(folded)
+        if not names or name not in names:
+            return
+        names.discard(name)
+        if names:
+            return
+        del self._names[folded]
+        path = [self._trie]
+        for char in folded:
+            path.append(path[-1][char])
+        del path[-1][None]
+        for i in range(len(folded), 0, -1):  # Prune empty nodes
+            if path[i]:
+                break
+            del path[i - 1][folded[i - 1]]
+        for trigram in _trigrams(folded):
+            postings = self._trigrams[trigram]
+            postings.discard(folded)
+            if not postings:
+                del self._trigrams[trigram]
+
+    def update(self, names):
+        """Make the index contain exactly names, adding and removing names."""
+        names = set(names)
+        for name in list(self):
+            if name not in names:
+                self.discard(name)
+        for name in names:
+            if name not in self:
+                self.add(name)
+
+    def search(self, query, limit=10, accept=None):
+        """Return up to limit names matching query, best matches first.
+
+        Exact matches rank first, followed by names beginning with the query,
+        names containing the query, and finally names similar to the query.
+
+        :param accept: An optional function that each returned name must
+            satisfy.
+
+        """
+        return [name for _, name in self._search(query, limit, accept)]
+
+    def _search(self, query, limit, accept):
+        """Return up to limit (kind, name) tuples matching query.
+
+        kind is 0 for exact, 1 for prefix, 2 for substring and 3 for fuzzy
+        matches.
+
+        """
+        def take(kind, folded_names):
+            for folded in folded_names:
+                if folded not in seen:
+                    seen.add(folded)
+                    results.extend((kind, x) for x in
+                                   self._accepted(folded, accept, original))
+
+        original, query = query, query.lower()
+        results = []
+        seen = set()
+        if query in self._names:
+            take(0, [query])
+        # Shorter names are found first as they are more likely what was meant
+        take(1, self._prefixed(query, limit + 1, accept))
+        if len(results) >= limit:
+            return results[:limit]
+
+        trigrams = _trigrams(query)
+        if not trigrams:  # Queries that are too short to use the index
+            take(2, sorted((x for x in self._names if query in x),
+                           key=lambda x: (x.index(query), len(x), x)))
+            return results[:limit]
+        postings = sorted((self._trigrams.get(x, ()) for x in trigrams),
+                          key=len)
+        if postings[0]:
+            candidates = set(postings[0]).intersection(*postings[1:])
+            take(2, sorted((x for x in candidates if query in x),
+                           key=lambda x: (x.index(query), len(x), x)))
+        if results:  # Only fall back to fuzzy matching when nothing matched
+            return results[:limit]
+
+        max_distance = 1 + len(query) // 8
+        if len(self._names) > self.FUZZY_SCAN_SIZE:
+            # Trigrams common to a large fraction of the names say little
+            # about a match and are skipped. Each edit changes at most four of
+            # the remaining trigrams, so a close match shares at least
+            # `needed`.
+            max_posting = self.FUZZY_MAX_POSTING * len(self._names)
+            postings = [x for x in postings if len(x) <= max_posting]
+            needed = max(len(postings) - 4 * max_distance, 1, int(
+                math.ceil(self.FUZZY_MIN_SIMILARITY * len(postings))))
+        else:  # Small indexes, such as a user's playlists, are checked whole
+            postings.append(self._names)  # Makes every name a candidate
+            needed = 1
+        shared = {}
+        for posting in postings:
+            for folded in posting:
+                shared[folded] = shared.get(folded, 0) + 1
+        fuzzy = []
+        for folded, count in shared.items():
+            if count < needed:
+                continue
+            distance = prefix_distance(query, folded, max_distance)
+            if distance <= max_distance:
+                fuzzy.append((distance, -count, len(folded), folded))
+        fuzzy.sort()
+        take(3, [x[-1] for x in fuzzy])
+        return results[:limit]
+
+    def best(self, query, limit=10, accept=None):
+        """Return the name query refers to if there is a single viable option.
+
+        Otherwise return a (possibly empty) list of ranked candidates.
+        Misspelled matches are always returned as a list so that they can be
+        confirmed.
+
+        """
+        folded = query.lower()
+        if folded in self._names:
+            exact = self._accepted(folded, accept, query)
+            if exact and (exact[0] == query or len(exact) == 1):
+                return exact[0]
+            elif exact:  # Names differing only in case, none as typed
+                return exact
+        results = self._search(query, limit, accept)
+        prefixed = [name for kind, name in results if kind == 1]
+        if len(prefixed) == 1:
+            return prefixed[0]
+        elif prefixed:
+            return prefixed
+        return [name for _, name in results]
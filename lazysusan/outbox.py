@@ -0,0 +1,146 @@
+"""A queue of outgoing chat messages."""
+
+import time
+from collections import deque
+from lazysusan.helpers import display_exceptions
+
+INTERACTIVE = 0
+BULK = 1
+
+
+def split_message(text, limit):
+    """Return a list of pieces of text no longer than limit.
+
+    Text is split at the last whitespace before the limit when possible.
+
+    """
+    pieces = []
+    while len(text) > limit:
+        index = text.rfind(' ', 0, limit + 1)
+        if index <= 0:
+            index = limit
+        pieces.append(text[:index].rstrip())
+        text = text[index:].lstrip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+class _Batch(object):
+
+    """The messages waiting to be sent to a single recipient."""
+
+    __slots__ = ('chunks', 'priority', 'user_id')
+
+    def __init__(self, user_id, priority):
+        self.chunks = deque()
+        self.priority = priority
+        self.user_id = user_id
+
+    def add(self, text, limit):
+        """Append text, merging it into the last chunk when it fits."""
+        pieces = split_message(text, limit)
+        if pieces and self.chunks \
+                and len(self.chunks[-1]) + 1 + len(pieces[0]) <= limit:
+            self.chunks[-1] += ' ' + pieces.pop(0)
+        self.chunks.extend(pieces)
+
+
+class Outbox(object):
+
+    """Send room chat and private messages one at a time.
+
+    Messages to the same recipient (the room, or a user via pm) that are
+    queued within `window` seconds of each other, or while an earlier message
+    is in flight, are merged into a single message of up to MAX_LENGTH
+    characters. Longer messages are split. INTERACTIVE messages are sent
+    before BULK ones, and the next message is only sent once turntable has
+    acknowledged the previous one.
+
+    The outbox is not thread safe; it relies on the api lock held by all
+    event handlers and scheduled callbacks.
+
+    """
+
+    MAX_LENGTH = 400
+    TIMEOUT = 10
+    WINDOW = 0.05
+
+    def __init__(self, api, schedule, window=None):
+        self.api = api
+        self.in_flight = None  # The time the outstanding message was sent
+        self.sent = 0
+        self.window = self.WINDOW if window is None else window
+        self._batches = {}  # Maps a recipient to its _Batch
+        self._flush_job = None
+        self._queues = (deque(), deque())  # Recipients for each priority
+        self._schedule = schedule
+
+    def __len__(self):
+        return sum(len(x.chunks) for x in self._batches.values())
+
+    @display_exceptions
+    def _acknowledged(self, _):
+        """Handle turntable's response to the outstanding message."""
+        self.in_flight = None
+        self._flush()
+
+    def _flush(self):
+        """Send the next message if nothing is in flight."""
+        now = time.time()
+        if self.in_flight is not None \
+                and now - self.in_flight < self.TIMEOUT:
+            self._wake(self.in_flight + self.TIMEOUT - now)
+            return
+        if self.api.rateLimit:  # Wait rather than block in ttapi's _send
+            delay = self.api.lastSend + self.api.rateLimit - now
+            if delay > 0:
+                self._wake(delay)
+                return
+        for queue in self._queues:
+            if queue:
+                break
+        else:
+            return
+        user_id = queue.popleft()
+        batch = self._batches[user_id]
+        text = batch.chunks.popleft()
+        if batch.chunks:  # Take turns with the other recipients
+            queue.append(user_id)
+        else:
+            del self._batches[user_id]
+        self.in_flight = now
+        self.sent += 1
+        if user_id is None:
+            self.api.speak(text, self._acknowledged)
+        else:
+            self.api.pm(text, user_id, self._acknowledged)
+
+    def _wake(self, delay):
+        """Make sure _flush runs within delay seconds."""
+        job = self._flush_job
+        if job is None or not job.active:
+            self._flush_job = self._schedule(delay, self._flush)
+        elif job.deadline > time.time() + delay:
+            job.reschedule(delay)
+
+    def clear(self):
+        """Drop every queued message."""
+        self._batches.clear()
+        for queue in self._queues:
+            queue.clear()
+        if self._flush_job is not None:
+            self._flush_job.cancel()
+
+    def send(self, text, user_id=None, priority=INTERACTIVE):
+        """Queue text for the room, or for user_id as a private message."""
+        batch = self._batches.get(user_id)
+        if batch is None:
+            batch = self._batches[user_id] = _Batch(user_id, priority)
+            self._queues[priority].append(user_id)
+        elif priority < batch.priority:  # Promote the waiting messages
+            self._queues[batch.priority].remove(user_id)
+            self._queues[priority].append(user_id)
+            batch.priority = priority
+        batch.add(text, self.MAX_LENGTH)
+        self._wake(self.window)
@@ -0,0 +1,628 @@
+"""Engines that perform bulk operations on turntable playlists."""
+
+import sqlite3
+import time
+from bisect import bisect_left
+from collections import deque
+from lazysusan.helpers import display_exceptions
+from lazysusan.tasks import Future
+
+
+class _FenwickTree(object):
+
+    """A binary indexed tree that counts occupied slots in O(log n)."""
+
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, slot, delta):
+        """Add delta to the count of slot."""
+        slot += 1
+        while slot < len(self.tree):
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    def count_before(self, slot):
+        """Return the total count of the slots preceding slot."""
+        total = 0
+        while slot > 0:
+            total += self.tree[slot]
+            slot -= slot & -slot
+        return total
+
+
+def longest_increasing_subsequence(sequence):
+    """Return the indexes of a longest strictly increasing subsequence."""
+    tails = []  # The smallest tail value of increasing runs of each length
+    tail_indexes = []
+    previous = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+        else:
+            tails[length] = value
+            tail_indexes[length] = i
+        previous[i] = tail_indexes[length - 1] if length else None
+    indexes = []
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        indexes.append(i)
+        i = previous[i]
+    indexes.reverse()
+    return indexes
+
+
+def plan_reorder(current, target):
+    """Return the moves that rearrange current into target.
+
+    Both sequences must contain the same unique items. The result is a list of
+    (from_index, to_index) tuples suitable for successive playlistReorder
+    requests, where to_index refers to the position after the item has been
+    removed from from_index.
+
+    Items that form a longest increasing subsequence of target positions stay
+    in place, so the number of moves is minimal. Each remaining item is moved
+    directly after its predecessor in the target order. Positions are tracked
+    with a Fenwick tree so that computing each move is O(log n).
+
+    """
+    target_index = dict((item, i) for i, item in enumerate(target))
+    original = dict((item, i) for i, item in enumerate(current))
+    sequence = [target_index[item] for item in current]
+    stays = set(current[i] for i in longest_increasing_subsequence(sequence))
+
+    # Every item has a key for its current position and, if it moves, a key
+    # for its final position: directly after the nearest preceding item in
+    # target order that stays, following the other moved items in between.
+    keys = [(i, 0) for i in range(len(current))]
+    final_keys = {}
+    anchor, offset = -1, 0
+    for item in target:
+        if item in stays:
+            anchor, offset = original[item], 0
+        else:
+            offset += 1
+            final_keys[item] = (anchor, offset)
+    slot_of = dict((key, i) for i, key in
+                   enumerate(sorted(keys + list(final_keys.values()))))
+
+    tree = _FenwickTree(len(slot_of))
+    for key in keys:
+        tree.add(slot_of[key], 1)
+    moves = []
+    for item in target:
+        if item in stays:
+            continue
+        src_slot = slot_of[(original[item], 0)]
+        dst_slot = slot_of[final_keys[item]]
+        src = tree.count_before(src_slot)
+        tree.add(src_slot, -1)
+        dst = tree.count_before(dst_slot)
+        tree.add(dst_slot, 1)
+        if src != dst:
+            moves.append((src, dst))
+    return moves
+
+
+class PlaylistMirror(object):
+
+    """An ordered local copy of a remote playlist.
+
+    The songs are kept both as a sequence and as an index from song id to
+    position so that membership and position lookups are O(1). Local changes
+    are applied incrementally as their requests succeed. When the copy can no
+    longer be trusted, for instance because a request failed, it is marked
+    `stale` and should be reloaded from the server with `load`.
+
+    """
+
+    def __init__(self, name, stale=True):
+        self.name = name
+        self.metadata = {}
+        self.songs = []
+        self.stale = stale
+        self.version = 0  # Incremented on every change
+        self._positions = {}
+
+    def __contains__(self, song_id):
+        return song_id in self._positions
+
+    def __iter__(self):
+        return iter(self.songs)
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __repr__(self):
+        return '<PlaylistMirror {0} ({1} songs{2})>'.format(
+            self.name, len(self.songs), ', stale' if self.stale else '')
+
+    def _reindex(self, start, stop=None):
+        """Update the positions of the songs in the range [start, stop)."""
+        for i in range(start, len(self.songs) if stop is None else stop):
+            self._positions[self.songs[i]] = i
+
+    def clear(self):
+        """Remove every song."""
+        self.songs = []
+        self._positions = {}
+        self.version += 1
+
+    def index(self, song_id):
+        """Return the position of song_id, or None if it is not present."""
+        return self._positions.get(song_id)
+
+    def insert(self, index, song_id, metadata=None):
+        """Insert song_id at index."""
+        index = min(max(index, 0), len(self.songs))
+        self.songs.insert(index, song_id)
+        self.version += 1
+        if metadata:
+            self.metadata[song_id] = metadata
+        if index == len(self.songs) - 1:
+            self._positions[song_id] = index
+        else:
+            self._reindex(index)
+
+    def load(self, items):
+        """Replace the contents with the `list` from a playlistAll response."""
+        self.songs = [x['_id'] for x in items]
+        self._positions = {}
+        self._reindex(0)
+        for item in items:
+            if item.get('metadata'):
+                self.metadata[item['_id']] = item['metadata']
+        self.stale = False
+        self.version += 1
+
+    def move(self, from_index, to_index):
+        """Move the song at from_index to to_index (a playlistReorder)."""
+        self.songs.insert(to_index, self.songs.pop(from_index))
+        self.version += 1
+        self._reindex(min(from_index, to_index),
+                      max(from_index, to_index) + 1)
+
+    def remove(self, index):
+        """Remove and return the song at index."""
+        song_id = self.songs.pop(index)
+        self.version += 1
+        if self._positions.get(song_id) == index:
+            del self._positions[song_id]
+        self._reindex(index)
+        return song_id
+
+
+class PlaylistCache(object):
+
+    """Persist playlist mirrors and song metadata in an SQLite database.
+
+    Playlists are stored per bot user so several bots may share a database.
+    Only the playlists whose mirror changed since the last save are written.
+
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS playlist (
+            user_id TEXT, name TEXT, saved REAL,
+            PRIMARY KEY (user_id, name));
+        CREATE TABLE IF NOT EXISTS playlist_song (
+            user_id TEXT, name TEXT, position INTEGER, song_id TEXT,
+            PRIMARY KEY (user_id, name, position));
+        CREATE TABLE IF NOT EXISTS song (
+            song_id TEXT PRIMARY KEY, artist TEXT, song TEXT);
+    """
+
+    def __init__(self, path, user_id, max_age=None):
+        """Open (and create if necessary) the cache database.
+
+        :param path: The path to the SQLite database.
+        :param user_id: The bot's user id.
+        :param max_age: Playlists saved more than max_age seconds ago are
+            loaded as stale.
+
+        """
+        # Access is serialized by the bot's event lock, but may occur from
+        # both the websocket and scheduler threads.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self.max_age = max_age
+        self.user_id = user_id
+        self._saved = {}  # Maps name to the (version, stale) last saved
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
+
+    def load(self):
+        """Return a dictionary mapping playlist names to PlaylistMirrors."""
+        mirrors = {}
+        now = time.time()
+        for name, saved in self.conn.execute(
+                'SELECT name, saved FROM playlist WHERE user_id = ?',
+                (self.user_id,)):
+            stale = self.max_age is not None and now - saved > self.max_age
+            mirrors[name] = PlaylistMirror(name, stale=stale)
+        for name, song_id, artist, song in self.conn.execute(
+                'SELECT ps.name, ps.song_id, s.artist, s.song '
+                'FROM playlist_song ps LEFT JOIN song s USING (song_id) '
+                'WHERE ps.user_id = ? ORDER BY ps.name, ps.position',
+                (self.user_id,)):
+            mirror = mirrors[name]
+            metadata = None
+            if artist is not None:
+                metadata = {'artist': artist, 'song': song}
+            mirror.insert(len(mirror), song_id, metadata)
+        for name, mirror in mirrors.items():
+            self._saved[name] = (mirror.version, mirror.stale)
+        return mirrors
+
+    def save(self, mirrors):
+        """Write the playlists in mirrors that changed since the last save.
+
+        Stale playlists and those no longer in mirrors are removed.
+
+        """
+        now = time.time()
+        with self.conn:
+            for name in set(self._saved) - set(mirrors):
+                self._delete(name)
+                del self._saved[name]
+            for name, mirror in mirrors.items():
+                state = (mirror.version, mirror.stale)
+                if self._saved.get(name) == state:
+                    continue
+                self._delete(name)
+                self._saved[name] = state
+                if mirror.stale:
+                    continue
+                self.conn.execute('INSERT INTO playlist VALUES (?, ?, ?)',
+                                  (self.user_id, name, now))
+                self.conn.executemany(
+                    'INSERT INTO playlist_song VALUES (?, ?, ?, ?)',
+                    ((self.user_id, name, i, song_id) for i, song_id
+                     in enumerate(mirror.songs)))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO song VALUES (?, ?, ?)',
+                    ((song_id, mirror.metadata[song_id].get('artist'),
+                      mirror.metadata[song_id].get('song'))
+                     for song_id in mirror.songs
+                     if song_id in mirror.metadata))
+
+    def _delete(self, name):
+        """Remove a playlist from the database."""
+        for table in ('playlist', 'playlist_song'):
+            self.conn.execute('DELETE FROM {0} WHERE user_id = ? AND name = ?'
+                              .format(table), (self.user_id, name))
+
+
+class BulkOperation(object):
+
+    """The base class for operations that send many playlist requests.
+
+    Rather than waiting for the response to each request before sending the
+    next, up to `window` requests are outstanding at once. Subclasses
+    implement `_fill` to send requests until the window is full and call
+    `_done` as each song completes. The `future` attribute finishes with the
+    operation, so that coroutines can wait for it.
+
+    """
+
+    ACTION = None  # The past tense verb used to describe progress
+    PROGRESS_INTERVAL = 30
+    WINDOW = 4
+
+    def __init__(self, api, playlist_name, total, window=None, progress=None,
+                 complete=None, mirror=None):
+        """Prepare the operation. Call `start` to begin sending requests.
+
+        :param api: The ttapi Bot to send the requests through.
+        :param playlist_name: The playlist the operation affects.
+        :param total: The number of songs the operation affects.
+        :param window: The maximum number of outstanding requests.
+        :param progress: A function that is called with this object every
+            PROGRESS_INTERVAL completed songs.
+        :param complete: A function that is called with this object once
+            every song has completed, or once a cancelled operation has no
+            outstanding requests.
+        :param mirror: A PlaylistMirror of the playlist to update as requests
+            succeed. It is marked stale when a request fails.
+
+        """
+        self.api = api
+        self.playlist_name = playlist_name
+        self.total = total
+        self.window = window or self.WINDOW
+        self.progress = progress
+        self.complete = complete
+        self.mirror = mirror
+
+        self.cancelled = False
+        self.failed = {}
+        self.finish_time = None
+        self.future = Future()
+        self.in_flight = 0
+        self.start_time = None
+        self.succeeded = []
+
+    @property
+    def completed(self):
+        """Return the number of songs that either succeeded or failed."""
+        return len(self.succeeded) + len(self.failed)
+
+    @property
+    def elapsed(self):
+        """Return the number of seconds the operation has been running."""
+        if self.start_time is None:
+            return 0
+        return (self.finish_time or time.time()) - self.start_time
+
+    @property
+    def finished(self):
+        """Return True if the operation has completed."""
+        return self.finish_time is not None
+
+    @property
+    def rate(self):
+        """Return the number of songs completed per second."""
+        elapsed = self.elapsed
+        return self.completed / elapsed if elapsed else 0.0
+
+    def _done(self, song_id, error=None):
+        """Record the completion of a song and report progress."""
+        if error is None:
+            self.succeeded.append(song_id)
+        else:
+            self.failed[song_id] = error
+            if self.mirror is not None:
+                self.mirror.stale = True
+        if self.progress and self.completed < self.total \
+                and self.completed % self.PROGRESS_INTERVAL == 0:
+            self.progress(self)
+
+    def _fill(self):
+        """Send requests until the window is full. Return True when done."""
+        raise NotImplementedError
+
+    def _next(self):
+        """Fill the window, and invoke `complete` when there is no work."""
+        if self.finished:
+            return
+        if not self.cancelled and not self._fill():
+            return
+        if not self.in_flight:
+            self.finish_time = time.time()
+            if self.complete:
+                self.complete(self)
+            self.future.set_result(self)
+
+    def cancel(self):
+        """Stop sending new requests.
+
+        `complete` is called once the outstanding requests have finished.
+
+        """
+        self.cancelled = True
+        self._next()
+
+    def start(self):
+        """Begin sending requests. Return this object."""
+        self.start_time = time.time()
+        self._next()
+        return self
+
+
+class BulkAdd(BulkOperation):
+
+    """Add many songs to a playlist keeping several requests in flight.
+
+    Failed additions are retried up to `retries` times before the song is
+    recorded in `failed` along with the last error.
+
+    """
+
+    ACTION = 'Added'
+    RETRIES = 2
+
+    def __init__(self, api, playlist_name, song_ids, index=None, start=0,
+                 retries=None, **kwargs):
+        """Prepare the songs to add. Call `start` to begin adding them.
+
+        :param song_ids: The ids of the songs to add, in order. Duplicates are
+            only added once.
+        :param index: The index to add every song at. When None, songs are
+            appended in order beginning at index `start`.
+
+        See BulkOperation for the remaining parameters.
+
+        """
+        self.queue = deque()
+        seen = set()
+        for song_id in song_ids:
+            if song_id not in seen:
+                seen.add(song_id)
+                self.queue.append(song_id)
+        super(BulkAdd, self).__init__(api, playlist_name, len(self.queue),
+                                      **kwargs)
+        self.attempts = {}
+        self.index = index
+        self.retries = self.RETRIES if retries is None else retries
+        self.start_index = start
+
+    @property
+    def added(self):
+        """Return the list of song ids that were added."""
+        return self.succeeded
+
+    def _callback(self, song_id, index):
+        """Return the callback that handles the response for song_id."""
+        @display_exceptions
+        def _closure(data):
+            self.in_flight -= 1
+            if data['success']:
+                if self.mirror is not None:
+                    self.mirror.insert(index, song_id)
+                self._done(song_id)
+            else:
+                self.attempts[song_id] = self.attempts.get(song_id, 0) + 1
+                if self.attempts[song_id] <= self.retries:
+                    self.queue.appendleft(song_id)
+                    if self.mirror is not None:  # Later indexes are off
+                        self.mirror.stale = True
+                else:
+                    self._done(song_id, data.get('err'))
+            self._next()
+        return _closure
+
+    def _fill(self):
+        while self.queue and self.in_flight < self.window:
+            song_id = self.queue.popleft()
+            if self.index is None:
+                index = self.start_index + len(self.added) + self.in_flight
+            else:
+                index = self.index
+            self.in_flight += 1
+            self.api.playlistAdd(self.playlist_name, song_id, index,
+                                 self._callback(song_id, index))
+        return not self.queue
+
+
+class BulkClear(BulkOperation):
+
+    """Remove every song from a playlist keeping several requests in flight.
+
+    Songs are removed from the end of the playlist so that the index of each
+    outstanding removal remains valid regardless of which requests fail.
+
+    With `recreate` set, the playlist is instead deleted and created again
+    which removes all of its songs at once. The default playlist cannot be
+    deleted.
+
+    """
+
+    ACTION = 'Removed'
+
+    def __init__(self, api, playlist_name, count, recreate=False, **kwargs):
+        """Prepare the removal. Call `start` to begin removing songs.
+
+        :param count: The number of songs in the playlist.
+        :param recreate: Delete and recreate the playlist rather than removing
+            each song.
+
+        See BulkOperation for the remaining parameters.
+
+        """
+        super(BulkClear, self).__init__(api, playlist_name, count, **kwargs)
+        self.next_index = count - 1
+        self.recreate = recreate
+
+    @property
+    def removed(self):
+        """Return the list of song ids that were removed.
+
+        The list is empty when the playlist was recreated.
+
+        """
+        return [x for x in self.succeeded if x is not None]
+
+    def _callback(self, index):
+        """Return the callback that handles the removal of index."""
+        @display_exceptions
+        def _closure(data):
+            self.in_flight -= 1
+            if data['success']:
+                song_dict = data.get('song_dict') or [{}]
+                if self.mirror is not None and index < len(self.mirror):
+                    self.mirror.remove(index)
+                self._done(song_dict[0].get('fileid'))
+            else:
+                self._done(index, data.get('err'))
+            self._next()
+        return _closure
+
+    def _fill(self):
+        if self.recreate:
+            if self.next_index >= 0:
+                self.next_index = -1
+                self.in_flight += 1
+                self.api.playlistDelete(self.playlist_name,
+                                        self._delete_callback)
+            return True
+        while self.next_index >= 0 and self.in_flight < self.window:
+            self.in_flight += 1
+            self.api.playlistRemove(self.playlist_name, self.next_index,
+                                    self._callback(self.next_index))
+            self.next_index -= 1
+        return self.next_index < 0
+
+    @display_exceptions
+    def _create_callback(self, data):
+        """Handle the response to recreating the playlist."""
+        self.in_flight -= 1
+        if data['success']:
+            if self.mirror is not None:
+                self.mirror.clear()
+                self.mirror.stale = False
+            self.succeeded.extend([None] * self.total)
+        else:
+            self.failed[None] = data.get('err')
+        self._next()
+
+    @display_exceptions
+    def _delete_callback(self, data):
+        """Handle the response to deleting the playlist."""
+        if data['success']:
+            self.api.playlistCreate(self.playlist_name, self._create_callback)
+        else:
+            self.in_flight -= 1
+            self.failed[None] = data.get('err')
+            self._next()
+
+
+class BulkReorder(BulkOperation):
+
+    """Apply a sequence of moves to a playlist keeping requests in flight.
+
+    Each move depends on the moves that precede it, so the operation stops
+    sending requests after the first failure.
+
+    """
+
+    ACTION = 'Moved'
+
+    def __init__(self, api, playlist_name, moves, **kwargs):
+        """Prepare the moves. Call `start` to begin reordering.
+
+        :param moves: A list of (from_index, to_index) tuples such as the one
+            returned by plan_reorder.
+
+        See BulkOperation for the remaining parameters.
+
+        """
+        super(BulkReorder, self).__init__(api, playlist_name, len(moves),
+                                          **kwargs)
+        self.queue = deque(moves)
+
+    def _callback(self, move):
+        """Return the callback that handles the response for move."""
+        @display_exceptions
+        def _closure(data):
+            self.in_flight -= 1
+            if data['success']:
+                if self.mirror is not None:
+                    self.mirror.move(*move)
+                self._done(move)
+            else:
+                self._done(move, data.get('err'))
+                self.cancelled = True
+            self._next()
+        return _closure
+
+    def _fill(self):
+        while self.queue and self.in_flight < self.window:
+            move = self.queue.popleft()
+            self.in_flight += 1
+            self.api.playlistReorder(self.playlist_name, move[0], move[1],
+                                     self._callback(move))
+        return not self.queue
@@ -1,23 +1,93 @@
 """The plugins namespace is used to contain the various LazySusan plugins."""
 
+from __future__ import print_function
+import sys
+from weakref import WeakSet
+
+
+def find_plugin(plugin_name, attempt_reload=False):
+    """Import and return the class of a LazySusan plugin by name, or None.
+
+    Plugins are first looked for in the modules on the path, which includes
+    the plugin directory, and then in the lazysusan.plugins package.
+
+    :param plugin_name: Indicates the plugin to load. The plugin name should
+        be of the format `module.PluginClass`. However, in the event that the
+        class name and the module name are the same, the short version `name`
+        is appropriate.
+    :param attempt_reload: Reload the plugin's module if it is already
+        imported.
+
+    """
+    parts = plugin_name.split('.')
+    if len(parts) > 1:
+        module_name = '.'.join(parts[:-1])
+        class_name = parts[-1]
+    else:
+        # Use the titlecase format of the module name as the class name
+        module_name = parts[0]
+        class_name = parts[0].title()
+
+    module = None
+    for package in (None, 'lazysusan.plugins'):
+        if package:
+            module_name = '{0}.{1}'.format(package, module_name)
+
+        if attempt_reload and module_name in sys.modules:
+            module = reload(sys.modules[module_name])
+        else:
+            try:
+                module = __import__(module_name, fromlist=[class_name])
+            except ImportError:
+                pass
+        if module:
+            break
+    if module and hasattr(module, class_name):
+        return getattr(module, class_name)
+    print('Cannot find plugin `{0}`.'.format(plugin_name))
+    return None
+
 
 class Plugin(object):
 
     """The base LazySusan plugin that is meant to be extended.
 
     This class provides the methods register, and unregister, that are
-    necessary for (un)registering callback to certain API events.
+    necessary for (un)registering callback to certain API events, and the
+    method schedule for scheduling events that are cancelled when the plugin
+    is unloaded.
 
     """
 
+    NAME = None  # Set to the name the plugin is loaded by
+
     def __init__(self, bot):
         self.bot = bot
+        self._jobs = WeakSet()
         self._registered = {}
         self._reg_num = 0
 
     def __del__(self):
-        for register_number in self._registered:
+        self.cleanup()
+
+    def get_state(self):
+        """Return the plugin's state to save in the bot's snapshot, or None.
+
+        The state must be serializable as JSON. When the bot restarts from the
+        snapshot, it is passed to set_state after the plugin is loaded.
+
+        """
+        return None
+
+    def set_state(self, state):
+        """Restore the state returned by get_state before a restart."""
+
+    def cleanup(self):
+        """Unregister all callbacks and cancel all pending scheduled events."""
+        for register_number in list(self._registered):
             self.unregister(register_number)
+        for job in list(self._jobs):
+            job.cancel()
 
     def register(self, event, callback):
         """Register a callback to a certain API event.
@@ -27,12 +97,23 @@ class Plugin(object):
 
         """
 
-        self.bot.api.on(event, callback)
+        callback = self.bot.api.on(event, callback, self.NAME)
         reg_num = self._reg_num
         self._registered[reg_num] = (event, callback)
         self._reg_num += 1
         return reg_num
 
+    def schedule(self, min_delay, callback, *args, **kwargs):
+        """Schedule an event to occur at least min_delay seconds in the future.
+
+        Return the Job handle. Pending jobs are cancelled when the plugin is
+        unloaded.
+
+        """
+        job = self.bot.schedule(min_delay, callback, *args, **kwargs)
+        self._jobs.add(job)
+        return job
+
     def unregister(self, register_number):
         """Unregister a previously registered callback by register number.
 
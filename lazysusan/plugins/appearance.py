@@ -2,6 +2,7 @@
 
 from lazysusan.helpers import display_exceptions, single_arg_command
 from lazysusan.plugins import CommandPlugin
+from lazysusan.tasks import coroutine
 
 
 class Appearance(CommandPlugin):
@@ -13,35 +14,31 @@ class Appearance(CommandPlugin):
 
     @display_exceptions
     @single_arg_command
+    @coroutine
     def set_avatar(self, message, data):
         """Set's the bot's avatar to the desired avatar id."""
-        @display_exceptions
-        def callback(cb_data):
-            """Handle the response to the setAvatar API call."""
-            if not cb_data['success']:
-                self.bot.reply(cb_data['err'], data)
         if not message.isdigit():
             self.bot.reply('`{0}` is not a valid avatar id.'.format(message),
                            data)
             return
-        self.bot.api.setAvatar(message, callback)
+        response = yield self.bot.api.request('setAvatar', message)
+        if not response['success']:
+            self.bot.reply(response['err'], data)
 
     @display_exceptions
     @single_arg_command
+    @coroutine
     def set_machine(self, message, data):
         """Set's the bot's machine.
 
         Available machines are: linux, mac, pc, chrome"""
-        @display_exceptions
-        def callback(cb_data):
-            """Handle the response to the modifyLaptop API call."""
-            if cb_data['success']:
-                self.bot.reply('Bot change successful.'
-                               'You may need to re-join the table.', data)
         if message in ('android', 'iphone'):
             self.bot.reply('Preventing change that disables PMs.', data)
         elif message not in ('linux', 'mac', 'pc', 'chrome'):
             self.bot.reply('`{0}` is not a valid machine.'.format(message),
                            data)
         else:
-            self.bot.api.modifyLaptop(message, callback)
+            response = yield self.bot.api.request('modifyLaptop', message)
+            if response['success']:
+                self.bot.reply('Bot change successful.'
+                               'You may need to re-join the table.', data)
@@ -1,26 +1,14 @@
 """A set of LazySusan plugins that control the bot as a dj."""
 
+import os
 import random
 from lazysusan.helpers import (display_exceptions, admin_or_moderator_required,
                                no_arg_command, single_arg_command)
+from lazysusan.names import NameIndex
+from lazysusan.playlist import (BulkAdd, BulkClear, BulkReorder,
+                                PlaylistCache, PlaylistMirror, plan_reorder)
 from lazysusan.plugins import CommandPlugin
-
-
-def best_match(selection, options):
-    """Return the best match from a set of options if possible.
-
-    Return a list when there is not a single viable option.
-
-    """
-    if selection in options:
-        return selection
-    possibles = [x for x in options if x.startswith(selection)]
-    if not possibles:
-        return [x for x in options if selection in x]
-    elif len(possibles) == 1:
-        return possibles[0]
-    else:
-        return possibles
+from lazysusan.tasks import Return, coroutine
 
 
 class Dj(CommandPlugin):
@@ -65,6 +53,14 @@ class Dj(CommandPlugin):
         self.register('registered', self.dj_update)
         self.register('rem_dj', self.dj_update)
 
+    def get_state(self):
+        return {'end_song_step_down': self.end_song_step_down,
+                'should_auto_skip': self.should_auto_skip}
+
+    def set_state(self, state):
+        self.end_song_step_down = state.get('end_song_step_down', False)
+        self.should_auto_skip = state.get('should_auto_skip', False)
+
     @no_arg_command
     def auto_skip(self, data):
         """Toggle whether the bot should play anything."""
@@ -89,6 +85,9 @@ class Dj(CommandPlugin):
                     self.should_auto_skip = False
                 return  # Ignore updates from the bot
 
+        if self.bot.max_djs is None:
+            return  # The room's information has yet to arrive
+
         if self.should_step_down:
             if self.is_playing:
                 self.end_song_step_down = True
@@ -153,56 +152,184 @@ class Playlist(CommandPlugin):
                 '/plload': 'load',
                 '/plshuffle': 'shuffle',
                 '/plskip': 'skip_next',
+                '/plstop': 'stop',
                 '/plswitch': 'switch',
                 '/plupdate': 'update_playlist'}
+    CACHE_INTERVAL = 60
     LIST_MAX_ITEMS = 5
     PLAYLIST_PREFIX = 'botplaylist.'
     UPDATE_MAX_ITEMS = 10
-    UPDATE_MIN_LISTENERS = 5
-    UPDATE_MIN_ROOMS = 20
 
     def __init__(self, *args, **kwargs):
         super(Playlist, self).__init__(*args, **kwargs)
+        self.operation = None
         self.playlist = None
         self.playlists = {}
+        self.playlist_names = NameIndex()
         self.register('roomChanged', self._room_init)
-        self.room_list = {}
+        self.rooms = self.bot.room_directory()
+        # Keep the directory warm so that /plupdate never waits for it. The
+        # directory may be shared, so only refresh it once it has expired.
+        interval = self.rooms.ttl / 4
+        self.schedule(interval, self.rooms.refresh, api=self.bot.api) \
+            .every(interval)
+        self.window = int(self.bot.config.get('playlist_window',
+                                              BulkAdd.WINDOW))
+        self.cache = None
+        if self.bot.config.get('playlist_cache'):
+            max_age = self.bot.config.get('playlist_cache_max_age')
+            self.cache = PlaylistCache(
+                os.path.expanduser(self.bot.config['playlist_cache']),
+                self.bot.bot_id, float(max_age) if max_age else None)
+            self.playlists = self.cache.load()
+            self.playlist_names.update(self.playlists)
+            self.schedule(self.CACHE_INTERVAL, self.save_cache) \
+                .every(self.CACHE_INTERVAL)
         # Fetch room info if this is a reload
         if self.bot.api.roomId:
             self.bot.api.roomInfo(self._room_init)
 
+    def cleanup(self):
+        """Stop the running bulk operation before unloading."""
+        if self.operation and not self.operation.finished:
+            self.operation.cancel()
+        if self.cache:
+            self.save_cache()
+            self.cache.close()
+            self.cache = None
+        super(Playlist, self).cleanup()
+
+    def get_state(self):
+        return {'playlist': self.playlist, 'playlists': sorted(self.playlists)}
+
+    def set_state(self, state):
+        """Restore the active playlist and the names of the playlists, whose
+        songs are fetched when needed or loaded from the playlist cache.
+
+        With the active playlist known, joining a room no longer lists the
+        playlists."""
+        for name in state.get('playlists', ()):
+            if name not in self.playlists:
+                self._add_playlist(PlaylistMirror(name))
+        self.playlist = state.get('playlist') or self.playlist
+
+    def _add_playlist(self, mirror):
+        """Track the playlist mirror and return it."""
+        self.playlists[mirror.name] = mirror
+        self.playlist_names.add(mirror.name)
+        return mirror
+
+    def _remove_playlist(self, name):
+        """Stop tracking the named playlist."""
+        self.playlists.pop(name, None)
+        self.playlist_names.discard(name)
+
+    def _busy(self, data):
+        """Reply and return True if a bulk operation is running."""
+        if self.operation and not self.operation.finished:
+            self.bot.reply('Busy with playlist {0}. Use /plstop to stop.'
+                           .format(self.operation.playlist_name), data)
+            return True
+        return False
+
+    @coroutine
     def _room_init(self, _):
         """Initialization that must wait until connected to a room."""
+        listed = None
         if not self.playlist:
-            self.bot.api.playlistListAll(self._playlist_init)
-        self.bot.api.listRooms(skip=0, callback=self.get_room_list(0))
+            listed = self.bot.api.request('playlistListAll')
+        self.rooms.refresh(api=self.bot.api)
+        if listed:
+            response = yield listed
+            if response['success']:
+                self._playlist_init(response)
 
     def _playlist_init(self, data):
+        names = set()
         for item in data['list']:
-            self.playlists[item['name']] = set()
+            names.add(item['name'])
+            if item['name'] not in self.playlists:
+                self._add_playlist(PlaylistMirror(item['name']))
             if item['active']:
                 self.playlist = item['name']
-        self.bot.api.playlistAll(self.playlist, self._playlist_info)
+        for name in set(self.playlists) - names:  # Deleted elsewhere
+            self._remove_playlist(name)
+        self.sync(self.playlist)
+
+    @coroutine
+    def _activate(self, name, data):
+        """Create the named playlist if necessary and switch to it.
+
+        Return the current mirror of the playlist, or None after replying with
+        the error.
 
-    def _playlist_info(self, data):
-        self.playlists[self.playlist] = set(x['_id'] for x in data['list'])
+        """
+        if name not in self.playlists:
+            response = yield self.bot.api.request('playlistCreate', name)
+            if not response['success']:
+                self.bot.reply(response['err'], data)
+                raise Return(None)
+            self._add_playlist(PlaylistMirror(name, stale=False))
+        if name != self.playlist:
+            response = yield self.bot.api.request('playlistSwitch', name)
+            if not response['success']:
+                self.bot.reply(response['err'], data)
+                raise Return(None)
+            self.playlist = response['playlist_name']
+        raise Return((yield self.sync(self.playlist)))
+
+    def save_cache(self):
+        """Write changed playlists to the playlist cache."""
+        if self.cache:
+            self.cache.save(self.playlists)
+
+    @coroutine
+    def sync(self, name):
+        """Return the mirror of the playlist once it is current.
+
+        The playlist is only fetched from the server when the mirror is stale.
+        None is returned when fetching it fails.
+
+        """
+        mirror = self.playlists.get(name)
+        if mirror is None or mirror.stale:
+            response = yield self.bot.api.request('playlistAll', name)
+            if not response['success']:
+                raise Return(None)
+            if name not in self.playlists:
+                self._add_playlist(PlaylistMirror(name))
+            mirror = self.playlists[name]
+            mirror.load(response['list'])
+        raise Return(mirror)
 
     @no_arg_command
+    @coroutine
     def add(self, data):
         """Add the current song to the bot's default playlist."""
-        if not self.bot.api.currentSongId:
+        song_id = self.bot.api.currentSongId
+        if not song_id:
             self.bot.reply('There is no song playing.', data)
             return
         playlist = self.playlists[self.playlist]
-        if self.bot.api.currentSongId in playlist:
+        if song_id in playlist:
             self.bot.reply('We already have that song.', data)
-        else:
-            self.bot.reply('Cool tunes, daddio.', data)
-            self.bot.api.playlistAdd('default', self.bot.api.currentSongId,
-                                     len(playlist))
-            if self.playlist == 'default':
-                playlist.add(self.bot.api.currentSongId)
+            self.bot.api.bop()
+            return
+        self.bot.reply('Cool tunes, daddio.', data)
+        default = yield self.sync('default')  # To add the song at its end
+        if default is None:
+            return
+        index = len(default)
+        song = (self.bot.api.tmpSong or {}).get('room', {}) \
+            .get('metadata', {}).get('current_song') or {}
+        metadata = song.get('metadata') if song.get('_id') == song_id \
+            else None
+        added = self.bot.api.request('playlistAdd', 'default', song_id, index)
         self.bot.api.bop()
+        if (yield added)['success']:
+            default.insert(index, song_id, metadata)
+        else:
+            default.stale = True
 
     @admin_or_moderator_required
     @no_arg_command
@@ -218,266 +345,244 @@ class Playlist(CommandPlugin):
 
     @admin_or_moderator_required
     @no_arg_command
+    @coroutine
     def clear(self, data):
         """Clear the bot's current playlist."""
-        def delete_callback(cb_data):
-            def create_callback(cb_data2):
-                if cb_data2['success']:
-                    reply = 'Cleared playlist {0}.'.format(self.playlist)
-                else:
-                    reply = cb_data['err']
-                self.bot.reply(reply, data)
-
-            if cb_data['success']:
-                self.playlists[self.playlist] = set()
-                self.bot.api.playlistCreate(self.playlist, create_callback)
-            else:
-                self.bot.reply(cb_data['err'], data)
-
-        if not self.playlists[self.playlist]:
+        playlist = yield self.sync(self.playlist)
+        if playlist is None:
+            return
+        if not playlist:
             self.bot.reply('The playlist is already empty.', data)
-        elif self.playlist != 'default':
-            self.bot.api.playlistDelete(self.playlist, delete_callback)
+            return
+        if self._busy(data):
+            return
+        self.operation = BulkClear(
+            self.bot.api, playlist.name, len(playlist),
+            recreate=playlist.name != 'default', window=self.window,
+            progress=self.progress(data), mirror=playlist).start()
+        engine = yield self.operation.future
+        if engine.cancelled:
+            reply = ('Stopped clearing playlist {0}. There are still {1} '
+                     'items.'.format(engine.playlist_name, len(playlist)))
+        elif engine.failed:
+            reply = ('Failure clearing playlist. There are still {0} '
+                     'items.'.format(len(playlist)))
         else:
-            self.bot.api.playlistRemove(self.playlist, 0,
-                                        self.clear_callback(data))
-
-    def clear_callback(self, caller_data, complete_callback=None):
-        @display_exceptions
-        def _closure(data):
-            if not data['success']:
-                self.bot.reply('Failure clearing playlist. There are still '
-                               '{0} items.'.format(len(playlist)),
-                               caller_data)
-                return
-            playlist.remove(data['song_dict'][0]['fileid'])
-            removed = original_count - len(playlist)
-            if removed % 30 == 0:
-                self.bot.reply('Removed {0} of {1} songs so far.'
-                               .format(removed, original_count), caller_data)
-            if playlist:  # While there are songs, continue to remove
-                self.bot.api.playlistRemove(self.playlist, 0, _closure)
-            elif complete_callback:  # Perform completion action
-                complete_callback()
-            else:
-                self.bot.reply('Cleared playlist {0}.'.format(self.playlist),
-                               caller_data)
-
-        playlist = self.playlists[self.playlist]
-        original_count = len(playlist)
-        return _closure
+            reply = ('Cleared playlist {0} ({1} songs in {2:.1f} seconds, '
+                     '{3:.1f} songs/s).'.format(
+                         engine.playlist_name, engine.total, engine.elapsed,
+                         engine.rate))
+        self.bot.reply(reply, data)
 
     @single_arg_command
+    @coroutine
     def create(self, message, data):
         """Create a playlist with the provided name."""
-        def callback(cb_data):
-            if cb_data['success']:
-                reply = 'Created playlist {0}.'.format(
-                    cb_data['playlist_name'])
-                self.playlists[message] = set()
-            else:
-                reply = cb_data['err']
-            self.bot.reply(reply, data)
-        self.bot.api.playlistCreate(message, callback)
+        response = yield self.bot.api.request('playlistCreate', message)
+        if response['success']:
+            reply = 'Created playlist {0}.'.format(response['playlist_name'])
+            self._add_playlist(PlaylistMirror(message, stale=False))
+        else:
+            reply = response['err']
+        self.bot.reply(reply, data)
 
     @single_arg_command
+    @coroutine
     def delete(self, message, data):
         """Delete a playlist with the provided name."""
-        def callback(cb_data):
-            if cb_data['success']:
-                reply = 'Deleted playlist {0}'.format(cb_data['playlist_name'])
-                del self.playlists[message]
-            else:
-                reply = cb_data['err']
-            self.bot.reply(reply, data)
-        self.bot.api.playlistDelete(message, callback)
-
-    def get_room_list(self, skip):
-        @display_exceptions
-        def _closure(data):
-            count = skip
-            for room, _ in data['rooms']:
-                if room['chatserver'] != self.bot.api.roomChatServer:
-                    continue
-                count += 1
-                if room['metadata']['listeners'] < self.UPDATE_MIN_LISTENERS \
-                        and count > self.UPDATE_MIN_ROOMS:
-                    break
-                self.room_list[room['shortcut']] = room['roomid']
-            else:
-                # Python closures are read-only so we have to recreate
-                self.bot.api.listRooms(skip=count,
-                                       callback=self.get_room_list(count))
-                return
-        return _closure
+        response = yield self.bot.api.request('playlistDelete', message)
+        if response['success']:
+            reply = 'Deleted playlist {0}'.format(response['playlist_name'])
+            self._remove_playlist(message)
+        else:
+            reply = response['err']
+        self.bot.reply(reply, data)
 
+    @display_exceptions
     @no_arg_command
+    @coroutine
     def list(self, data):
         """Output a summary of the songs in the current playlist."""
-        @display_exceptions
-        def callback(cb_data):
-            preview = []
-            playlist = set()
-            for item in cb_data['list']:
-                playlist.add(item['_id'])
-                artist = item['metadata']['artist'].encode('utf-8')
-                song = item['metadata']['song'].encode('utf-8')
-                item = '"{0}" by {1}'.format(song, artist)
-                if len(preview) < self.LIST_MAX_ITEMS:
-                    preview.append(item)
-            reply = ('There are {0} songs in the playlist. '
-                     .format(len(playlist)))
-            if preview:
-                reply += 'The first {0} are: {1}'.format(len(preview),
-                                                         ', '.join(preview))
-            self.playlists[self.playlist] = playlist
-            self.bot.reply(reply, data)
-        self.bot.api.playlistAll(self.playlist, callback)
+        playlist = self.playlists.get(self.playlist)
+        if playlist is not None:
+            preview = playlist.songs[:self.LIST_MAX_ITEMS]
+            if any(x not in playlist.metadata for x in preview):
+                playlist.stale = True  # Fetch the missing song information
+        playlist = yield self.sync(self.playlist)
+        if playlist is None:
+            return
+        preview = []
+        for song_id in playlist.songs[:self.LIST_MAX_ITEMS]:
+            metadata = playlist.metadata.get(song_id) or {}
+            if not metadata.get('artist') or not metadata.get('song'):
+                preview.append('an unknown song ({0})'.format(song_id))
+                continue
+            artist = metadata['artist'].encode('utf-8')
+            song = metadata['song'].encode('utf-8')
+            preview.append('"{0}" by {1}'.format(song, artist))
+        reply = 'There are {0} songs in the playlist. '.format(len(playlist))
+        if preview:
+            reply += 'The first {0} are: {1}'.format(len(preview),
+                                                     ', '.join(preview))
+        self.bot.reply(reply, data)
 
     @no_arg_command
+    @coroutine
     def list_playlists(self, data):
         """List the available playlists."""
-        @display_exceptions
-        def callback(cb_data):
-            def display(name):
-                return name if name != self.playlist else name + '*'
+        def display(name):
+            return name if name != self.playlist else name + '*'
+        response = yield self.bot.api.request('playlistListAll')
+        if response['success']:
             reply = 'Available playlists: {0}'.format(
                 ', '.join(display(x['name']) for x in
-                          sorted(cb_data['list'], key=lambda x: x['name'])))
-            self.bot.reply(reply, data)
-        self.bot.api.playlistListAll(callback)
+                          sorted(response['list'], key=lambda x: x['name'])))
+        else:
+            reply = response['err']
+        self.bot.reply(reply, data)
 
     @admin_or_moderator_required
     @single_arg_command
+    @coroutine
     def load(self, message, data):
         """Load the specified local playlist into a new playlist."""
-        def add_songs(cb_data=None):
-            if cb_data and cb_data['success']:
-                failed.pop(0)
-            playlist = self.playlists[playlist_name]
-            while song_ids:
-                song_id = song_ids.pop(0)
-                failed.insert(0, song_id)  # Removed on success
-                if song_id not in playlist:
-                    playlist.add(song_id)
-                    self.bot.api.playlistAdd(playlist_name, song_id,
-                                             len(playlist) - 1, add_songs)
-                    break
-            else:
-                self.bot.api.playlistSwitch(playlist_name, switch_callback)
-
-        def create_callback(cb_data):
-            if cb_data['success']:
-                self.playlists[playlist_name] = set()
-                add_songs()
-            else:
-                self.bot.reply(cb_data['err'], data)
-
-        def delete_callback(cb_data):
-            if cb_data['success']:
-                del self.playlists[playlist_name]
-                self.bot.api.playlistCreate(playlist_name, create_callback)
-            else:
-                self.bot.reply(cb_data['err'], data)
-
-        def switch_callback(cb_data):
-            if cb_data['success']:
-                self.playlist = cb_data['playlist_name']
-                reply = ('Loaded {0} songs from local playlist {1}.'
-                         .format(len(self.playlist), message))
-                if failed:
-                    reply += (' Failed to load the following song ids: {0}'
-                              .format(','.join(failed)))
-            else:
-                reply = cb_data['err']
-            self.bot.reply(reply, data)
-
         config_name = '{0}{1}'.format(self.PLAYLIST_PREFIX, message)
         if config_name not in self.bot.config:
             self.bot.reply('Playlist `{0}` does not exist.'
                            .format(config_name), data)
             return
 
+        if self._busy(data):
+            return
         song_ids = self.bot.config[config_name].split('\n')
-        failed = []
         playlist_name = 'local_{0}'.format(message)
         if playlist_name in self.playlists:  # Delete the playlist
-            self.bot.api.playlistDelete(playlist_name, delete_callback)
-        else:  # Create the playlist
-            self.bot.api.playlistCreate(playlist_name, create_callback)
+            response = yield self.bot.api.request('playlistDelete',
+                                                  playlist_name)
+            if not response['success']:
+                self.bot.reply(response['err'], data)
+                return
+            self._remove_playlist(playlist_name)
+        response = yield self.bot.api.request('playlistCreate', playlist_name)
+        if not response['success']:
+            self.bot.reply(response['err'], data)
+            return
+        playlist = self._add_playlist(PlaylistMirror(playlist_name,
+                                                     stale=False))
+        self.operation = BulkAdd(
+            self.bot.api, playlist_name, song_ids, window=self.window,
+            progress=self.progress(data), mirror=playlist).start()
+        engine = yield self.operation.future
+        if engine.cancelled:
+            self.bot.reply('Stopped loading {0} after {1} songs.'
+                           .format(playlist_name, len(engine.added)), data)
+            return
+
+        response = yield self.bot.api.request('playlistSwitch', playlist_name)
+        if response['success']:
+            self.playlist = response['playlist_name']
+            reply = ('Loaded {0} songs from local playlist {1}.'
+                     .format(len(engine.added), message))
+            if engine.failed:
+                reply += (' Failed to load the following song ids: {0}'
+                          .format(','.join(sorted(engine.failed))))
+        else:
+            reply = response['err']
+        self.bot.reply(reply, data)
+
+    def progress(self, caller_data):
+        """Return a function that reports the progress of a bulk operation."""
+        def _closure(engine):
+            self.bot.reply('{0} {1} of {2} songs so far.'
+                           .format(engine.ACTION, engine.completed,
+                                   engine.total), caller_data, bulk=True)
+        return _closure
 
     @no_arg_command
+    @coroutine
     def shuffle(self, data):
-        """Randomly select the next 10 songs in the bot's current playlist."""
-        def get_endpoints():
-            dst = index[0]
-            index[0] += 1
-            item = new_order.pop(0)
-            src = original.index(item)
-            if src != dst:  # Reorder for next use
-                del original[src]
-                original.insert(dst, item)
-            return src, dst
-
-        def callback(cb_data):
-            if not cb_data['success']:
-                self.bot.reply('Error shuffling playlist.', data)
-            elif index[0] >= num:
-                self.bot.reply('Everyday I\'m shuffling (completed).', data)
-            else:
-                src, dst = get_endpoints()
-                self.bot.api.playlistReorder(self.playlist, src, dst, callback)
-
-        # We don't actually keep track of the song order so just use their
-        # current indexes
-        original = list(range(len(self.playlists[self.playlist])))
-        num = min(len(original), 10)
-        if num < 2:
+        """Randomly reorder all of the songs in the bot's current playlist."""
+        if self._busy(data):
+            return
+        playlist = yield self.sync(self.playlist)
+        if playlist is None or self._busy(data):
+            return
+        # Plan on positions so that duplicate songs are handled
+        current = list(range(len(playlist)))
+        if len(current) < 2:
             self.bot.reply('There are too few items to shuffle in {0}.'
-                           .format(self.playlist), data)
+                           .format(playlist.name), data)
             return
-        new_order = random.sample(original, num)
-        index = [0]  # Needs to be a list in order to mutate
-        src, dst = get_endpoints()
-        self.bot.api.playlistReorder(self.playlist, src, dst, callback)
+        target = random.sample(current, len(current))
+        self.operation = BulkReorder(
+            self.bot.api, playlist.name, plan_reorder(current, target),
+            window=self.window, progress=self.progress(data),
+            mirror=playlist).start()
+        engine = yield self.operation.future
+        if engine.failed:
+            self.bot.reply('Error shuffling playlist.', data)
+        elif engine.cancelled:
+            self.bot.reply('Stopped shuffling after {0} of {1} moves.'
+                           .format(engine.completed, engine.total), data)
+        else:
+            self.bot.reply('Everyday I\'m shuffling (completed).', data)
 
     @no_arg_command
+    @coroutine
     def skip_next(self, data):
         """Skip the next song in the bot's current playlist.
 
         Note: This will not affect the currently playing song.
 
         """
-        def callback(cb_data):
-            if cb_data['success']:
-                self.bot.reply('Next song skipped.', data)
-            else:
-                self.bot.reply('Error skipping next song.', data)
-        self.bot.api.playlistReorder(self.playlist, 0,
-                                     len(self.playlists[self.playlist]) - 1,
-                                     callback)
+        playlist = yield self.sync(self.playlist)
+        if playlist is None:
+            return
+        last = len(playlist) - 1
+        if last < 1:
+            self.bot.reply('There is no next song to skip.', data)
+            return
+        response = yield self.bot.api.request('playlistReorder',
+                                              playlist.name, 0, last)
+        if response['success']:
+            playlist.move(0, last)
+            self.bot.reply('Next song skipped.', data)
+        else:
+            playlist.stale = True
+            self.bot.reply('Error skipping next song.', data)
+
+    @admin_or_moderator_required
+    @no_arg_command
+    def stop(self, data):
+        """Stop the running bulk playlist operation (e.g. /plclear)."""
+        if not self.operation or self.operation.finished:
+            self.bot.reply('There is nothing to stop.', data)
+        else:
+            self.operation.cancel()
 
     @single_arg_command
+    @coroutine
     def switch(self, message, data):
         """Switch to the specified playlist."""
-        def callback(cb_data):
-            if cb_data['success']:
-                self.playlist = cb_data['playlist_name']
-                reply = 'Switched to playlist {0}'.format(self.playlist)
-                self.bot.api.playlistAll(self.playlist, self._playlist_info)
-            else:
-                reply = cb_data['err']
-            self.bot.reply(reply, data)
-        selection = best_match(message, self.playlists.keys())
+        selection = self.playlist_names.best(message)
         if not selection:
             self.bot.reply('Invalid playlist name.', data)
+            return
         elif isinstance(selection, list):
             self.bot.reply('Possible playlist matches: {0}'
                            .format(', '.join(selection)), data)
+            return
+        response = yield self.bot.api.request('playlistSwitch', selection)
+        if response['success']:
+            self.playlist = response['playlist_name']
+            reply = 'Switched to playlist {0}'.format(self.playlist)
+            self.sync(self.playlist)
         else:
-            self.bot.api.playlistSwitch(selection, callback)
+            reply = response['err']
+        self.bot.reply(reply, data)
 
     @single_arg_command
+    @coroutine
     def update_playlist(self, message, data):
         """Update the room playlist from songs played in the provideded room.
 
@@ -485,70 +590,59 @@ class Playlist(CommandPlugin):
         room. Upon completion, the bot will switch to this playlist.
 
         """
-        def room_info_callback(cb_data):
-            def add_songs():
-                def add_song_callback(_):
-                    if to_add:
-                        _, song_id = to_add.pop(0)
-                        playlist.add(song_id)
-                        self.bot.api.playlistAdd(self.playlist, song_id, 0,
-                                                 add_song_callback)
-                    else:
-                        self.bot.reply('Added {0} songs'.format(num), data)
-
-                playlist = self.playlists[self.playlist]
-                songs = cb_data['room']['metadata']['songlog']
-
-                to_add = []
-                for song in songs:
-                    if song['_id'] not in playlist:
-                        to_add.append((song.get('score'), song['_id']))
-                if not to_add:
-                    self.bot.reply('No songs to add.', data)
-                    return
-
-                # Most popular songs will play first (added last)
-                to_add.sort()
-                num = len(to_add)
-                add_song_callback(None)
-
-            def list_callback(cb_data2):
-                self.playlists[self.playlist] = set(x['_id'] for x in
-                                                    cb_data2['list'])
-                add_songs()
-
-            def switch_callback(cb_data2):
-                if cb_data2['success']:
-                    self.playlist = cb_data2['playlist_name']
-                    self.bot.api.playlistAll(self.playlist, list_callback)
-                else:
-                    self.bot.reply(cb_data2['err'], data)
-
-            def create_callback(cb_data2):
-                if cb_data2['success']:
-                    self.bot.api.playlistSwitch(message, switch_callback)
-                else:
-                    self.bot.reply(reply, cb_data2['err'])
-
-            if message not in self.playlists:  # Create the playlist
-                self.bot.api.playlistCreate(message, create_callback)
-            elif message == self.playlist:  # Add songs
-                add_songs()
-            else:  # Switch to the playlist
-                self.bot.api.playlistSwitch(message, switch_callback)
-
-        selection = best_match(message, self.room_list.keys())
+        if self._busy(data):
+            return
+        chat_server = self.bot.api.roomChatServer
+        selection = self.rooms.find(message, chat_server)
         if not selection:
+            room_list = self.rooms.shortcuts(chat_server)
             reply = 'Could not find `{0}` in the room_list. '.format(message)
-            reply += 'Perhaps try one of these: '
-            reply += ', '.join(sorted(random.sample(self.room_list,
-                                                    self.UPDATE_MAX_ITEMS)))
+            if room_list:
+                reply += 'Perhaps try one of these: '
+                reply += ', '.join(sorted(random.sample(
+                    room_list, min(len(room_list), self.UPDATE_MAX_ITEMS))))
+            else:
+                reply += 'The room list is still loading.'
             self.bot.reply(reply, data)
+            return
         elif isinstance(selection, list):
             self.bot.reply('Possible room matches: {0}'
                            .format(', '.join(selection)), data)
-        else:
-            message = selection
-            room_id = self.room_list[message]
-            self.bot.reply('Querying {0} ({1})'.format(message, room_id), data)
-            self.bot.api.roomInfo(room_info_callback, room_id=room_id)
+            return
+
+        message = selection
+        room_id = self.rooms.rooms[message].room_id
+        self.bot.reply('Querying {0} ({1})'.format(message, room_id), data)
+        # The room's song log is independent of preparing the playlist
+        room, playlist = yield [
+            self.bot.api.request('roomInfo', room_id=room_id),
+            self._activate(message, data)]
+        if playlist is None:
+            return
+        if not room['success']:
+            self.bot.reply(room['err'], data)
+            return
+
+        to_add = []
+        for song in room['room']['metadata']['songlog']:
+            if song['_id'] not in playlist:
+                to_add.append((song.get('score'), song['_id']))
+                if song.get('metadata'):
+                    playlist.metadata[song['_id']] = song['metadata']
+        if not to_add:
+            self.bot.reply('No songs to add.', data)
+            return
+        if self._busy(data):
+            return
+
+        # Most popular songs will play first (added last)
+        to_add.sort()
+        self.operation = BulkAdd(
+            self.bot.api, playlist.name, [x[1] for x in to_add], index=0,
+            window=self.window, progress=self.progress(data),
+            mirror=playlist).start()
+        engine = yield self.operation.future
+        reply = 'Added {0} songs'.format(len(engine.added))
+        if engine.failed:
+            reply += ' ({0} failed)'.format(len(engine.failed))
+        self.bot.reply(reply, data)
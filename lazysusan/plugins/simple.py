@@ -16,4 +16,4 @@ class Talk(CommandPlugin):
 
     def say(self, message, _):
         """Repeat everything after /speak to the bot's current room."""
-        self.bot.api.speak(message)
+        self.bot.speak(message)
@@ -20,6 +20,12 @@ class Theme(CommandPlugin):
 
     theme = None
 
+    def get_state(self):
+        return {'theme': self.theme}
+
+    def set_state(self, state):
+        self.theme = state.get('theme')
+
     @no_arg_command
     def get_theme(self, data):
         """Gets the current theme."""
@@ -34,7 +40,7 @@ class Theme(CommandPlugin):
     def set_theme(self, message, data):
         """Sets the current theme."""
         self.theme = message.strip()
-        self.bot.api.speak("The theme is now: \"{}\"".format(self.theme))
+        self.bot.speak("The theme is now: \"{}\"".format(self.theme))
 
     @display_exceptions
     @admin_or_moderator_required
@@ -42,4 +48,4 @@ class Theme(CommandPlugin):
     def clear_theme(self, data):
         """Removes the current theme."""
         self.theme = None
-        self.bot.api.speak("There's no theme right now; anything goes!")
+        self.bot.speak("There's no theme right now; anything goes!")
@@ -0,0 +1,148 @@
+"""A bounded pool of threads that runs the work of each plugin in order."""
+
+import threading
+import traceback
+from collections import deque
+from Queue import Queue
+
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+
+
+class SerialQueue(object):
+
+    """The work of a single plugin, run one item at a time by a WorkerPool.
+
+    Items of different queues run in parallel, while the items of a queue run
+    in the order they were submitted. At most `max_size` droppable items, such
+    as events, wait at once; when the queue is full either the oldest waiting
+    droppable item or the new one is dropped, according to `policy`. Items
+    that are not droppable, such as the responses to the plugin's own
+    requests, are always queued.
+
+    """
+
+    MAX_SIZE = 100
+
+    def __init__(self, pool, name, max_size=None, policy=None):
+        self.dropped = 0
+        self.max_depth = 0
+        self.max_size = int(max_size or self.MAX_SIZE)
+        self.name = name
+        self.policy = policy or DROP_OLDEST
+        self.processed = 0
+        self._closed = False
+        self._droppable = 0  # The number of droppable items waiting
+        self._items = deque()  # (droppable, function, args) tuples
+        self._lock = threading.Lock()
+        self._pool = pool
+        self._scheduled = False  # True while waiting in or run by the pool
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def idle(self):
+        """Return True if no item is waiting or running."""
+        return not self._scheduled
+
+    def _drop_oldest(self):
+        """Remove the oldest droppable item. Hold the lock."""
+        for index, item in enumerate(self._items):
+            if item[0]:
+                del self._items[index]
+                self._droppable -= 1
+                return
+
+    def close(self):
+        """Discard the waiting items and refuse new ones."""
+        with self._lock:
+            self._closed = True
+            self._droppable = 0
+            self._items.clear()
+
+    def run(self):
+        """Run the next item. Called by the pool's threads."""
+        with self._lock:
+            if not self._items:
+                self._scheduled = False
+                return
+            droppable, function, args = self._items.popleft()
+            if droppable:
+                self._droppable -= 1
+        try:
+            function(*args)
+        except:  # Handle all exceptions -- pylint: disable-msg=W0702
+            traceback.print_exc()
+        with self._lock:
+            self.processed += 1
+            if self._items:  # Take turns with the other queues
+                self._pool.put(self)
+            else:
+                self._scheduled = False
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call to function with args.
+
+        Pass `droppable=False` for items that must not be dropped. Return
+        False if the item was dropped.
+
+        """
+        droppable = kwargs.get('droppable', True)
+        with self._lock:
+            if self._closed:
+                return False
+            if droppable and self._droppable >= self.max_size:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self._drop_oldest()
+            self._items.append((droppable, function, args))
+            if droppable:
+                self._droppable += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            if not self._scheduled:
+                self._scheduled = True
+                self._pool.put(self)
+        return True
+
+    def summary(self):
+        """Return a line describing the queue's metrics."""
+        return ('queue {0}: {1} waiting (max {2}), {3} run, {4} dropped'
+                .format(self.name, len(self._items), self.max_depth,
+                        self.processed, self.dropped))
+
+
+class WorkerPool(object):
+
+    """A fixed number of threads that run the SerialQueues with work.
+
+    The threads are started when the first queue has work.
+
+    """
+
+    SIZE = 4
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self._lock = threading.Lock()
+        self._ready = Queue()
+        self._threads = []
+
+    def _run(self):
+        """Thread loop that runs queues as they become ready."""
+        while True:
+            self._ready.get().run()
+
+    def put(self, queue):
+        """Have one of the threads run the queue's next item."""
+        self._ready.put(queue)
+        if len(self._threads) < self.size:
+            with self._lock:
+                while len(self._threads) < self.size:
+                    thread = threading.Thread(
+                        target=self._run, name='lazysusan-pool-{0}'
+                        .format(len(self._threads)))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
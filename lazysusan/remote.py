@@ -0,0 +1,555 @@
+"""Run plugins in processes of their own.
+
+A plugin listed with the `process` flag in `plugins:` is loaded into a child
+process, where it talks to a RemoteBot instead of LazySusan. The bot loads a
+RemotePlugin in its place, which forwards the plugin's commands and the events
+it registers for over a pipe, and makes the api calls the plugin asks for on
+its behalf. The plugin can then use a core of its own, and a crash only costs
+the plugin a restart.
+
+Messages are tuples whose first item is their kind. The parent sends:
+
+    ('command', function_name, message, data)
+    ('event', signal, data)
+    ('response', call_id, data)
+    ('room', (roomId, currentDjId, currentSongId, max_djs, username,
+              roomChatServer, current_song))
+    ('stop',)
+    ('sync', state)
+    ('users', event)
+
+and the plugin's process sends:
+
+    ('bot', 'pm' or 'speak', args)
+    ('call', call_id, method, args, kwargs, timeout)
+    ('ready', commands)
+    ('register', signal)
+
+"""
+
+from __future__ import print_function
+import itertools
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import defaultdict
+from multiprocessing import Pipe, Process
+from ttapi import Bot
+from lazysusan.commands import (ADMIN, ADMIN_OR_MODERATOR, MODERATOR,
+                                CommandDescriptor)
+from lazysusan.helpers import (admin_or_moderator_required, admin_required,
+                               display_exceptions, moderator_required,
+                               no_arg_command, single_arg_command)
+from lazysusan.plugins import (CommandPlugin, Plugin, PluginException,
+                               find_plugin)
+from lazysusan.rooms import RoomDirectory
+from lazysusan.scheduler import Scheduler
+from lazysusan.tasks import Future
+from lazysusan.users import UserRegistry
+
+# Methods of the ttapi Bot that manage the connection itself
+RESERVED = frozenset(('auth_clb', 'clb', 'connect', 'emit', 'info_clb', 'on',
+                      'on_message', 'start'))
+# The bot attributes mirrored in the plugin's process, besides `users` and
+# those returned by _room
+STATE = ('admin_ids', 'bot_id', 'config', 'start_time')
+
+_PERMISSIONS = {ADMIN: admin_required,
+                ADMIN_OR_MODERATOR: admin_or_moderator_required,
+                MODERATOR: moderator_required}
+
+
+def _room(bot):
+    """Return the bot's attributes that change with the room and song.
+
+    Of ttapi's tmpSong only the current song is sent, as the rest changes
+    with every vote.
+
+    """
+    room = (bot.api.tmpSong or {}).get('room') or {}
+    return (bot.api.roomId, bot.api.currentDjId, bot.api.currentSongId,
+            bot.max_djs, bot.username, bot.api.roomChatServer,
+            room.get('metadata', {}).get('current_song'))
+
+
+def _forwarder(function_name, arity, permission, help_text):
+    """Return a command function that forwards to the plugin's process.
+
+    The function is decorated as the plugin's own, so the command registry
+    checks its arity and permissions before anything is forwarded.
+
+    """
+    def forward(self, *args):  # pylint: disable-msg=C0111
+        message, data = args if len(args) == 2 else ('', args[0])
+        self.send(('command', function_name, message, data))
+    forward.__doc__ = help_text
+    forward.__name__ = function_name
+    if arity == 0:
+        forward = no_arg_command(forward)
+    elif arity == 1:
+        forward = single_arg_command(forward)
+    if permission in _PERMISSIONS:
+        forward = _PERMISSIONS[permission](forward)
+    return forward
+
+
+class RemoteApi(object):
+
+    """Stands in for the BotApi in a plugin's process.
+
+    Calls to ttapi methods are sent to the bot, and their callbacks are run
+    once the bot relays the response. Other attributes of the BotApi are not
+    available, apart from those mirrored by the RemoteBot.
+
+    """
+
+    def __init__(self, bot):
+        self.currentDjId = None  # pylint: disable-msg=C0103
+        self.currentSongId = None  # pylint: disable-msg=C0103
+        self.roomChatServer = None  # pylint: disable-msg=C0103
+        self.roomId = None  # pylint: disable-msg=C0103
+        self.signals = defaultdict(list)
+        self.tmpSong = None  # pylint: disable-msg=C0103
+        self._bot = bot
+
+    def __getattr__(self, method):
+        if method.startswith('_') or method in RESERVED \
+                or not callable(getattr(Bot, method, None)):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):  # pylint: disable-msg=C0111
+            return self._bot.call(method, args, kwargs)
+        call.__name__ = method
+        return call
+
+    def on(self, event, callback, owner=None):  # pylint: disable-msg=W0613
+        """Register callback for the event and return it."""
+        if not self.signals[event]:
+            self._bot.send(('register', event))
+        self.signals[event].append(callback)
+        return callback
+
+    def request(self, method, *args, **kwargs):
+        """Call the ttapi method and return a Future of its response.
+
+        :param timeout: The seconds the bot waits for a response.
+
+        """
+        future = Future()
+        timeout = kwargs.pop('timeout', None)
+        self._bot.call(method, args + (future.set_result,), kwargs, timeout)
+        return future
+
+
+class RemoteBot(object):
+
+    """Stands in for LazySusan in a plugin's process.
+
+    The attributes in STATE, `max_djs`, `username`, `users` and the roomId,
+    currentDjId, currentSongId and roomChatServer of `api` mirror the bot's,
+    as does the current song of `api.tmpSong`. Messages from the bot and
+    scheduled callbacks hold `lock`, so that the plugin's handlers never run
+    concurrently.
+
+    """
+
+    dj_ids = property(lambda self: self.users.dj_ids)
+    listener_ids = property(lambda self: self.users.listener_ids)
+    moderator_ids = property(lambda self: self.users.moderator_ids)
+
+    def __init__(self, conn, state, room):
+        self.api = RemoteApi(self)
+        self.lock = threading.RLock()
+        self.users = UserRegistry()
+        self.scheduler = Scheduler(self._dispatch)
+        self._callbacks = {}  # Maps a call id to the callback of that call
+        self._call_ids = itertools.count()
+        self._conn = conn
+        self._directory = None
+        self.handle(('room', room))
+        self.handle(('sync', state))
+
+    def _dispatch(self, callback, args, kwargs):
+        """Run a scheduled callback holding the lock."""
+        with self.lock:
+            callback(*args, **kwargs)
+
+    def call(self, method, args, kwargs=None, timeout=None):
+        """Ask the bot to call the api method.
+
+        A `callback` keyword argument, or else a callable last argument, is
+        called with the response. The bot passes its own callback in the same
+        place.
+
+        """
+        call_id = None
+        kwargs = dict(kwargs or {})
+        if callable(kwargs.get('callback')):
+            call_id = next(self._call_ids)
+            self._callbacks[call_id] = kwargs['callback']
+            kwargs['callback'] = None
+        elif args and callable(args[-1]):
+            call_id = next(self._call_ids)
+            self._callbacks[call_id] = args[-1]
+            args = args[:-1]
+        self.send(('call', call_id, method, args, kwargs, timeout))
+
+    def handle(self, message):
+        """Handle a message from the bot."""
+        kind = message[0]
+        if kind == 'event':
+            callbacks = list(self.api.signals.get(message[1], ()))
+        elif kind == 'response':
+            callbacks = [self._callbacks.pop(message[1], None)]
+        elif kind == 'room':
+            (self.api.roomId, self.api.currentDjId, self.api.currentSongId,
+             self.max_djs, self.username, self.api.roomChatServer,
+             song) = message[1]
+            self.api.tmpSong = song and {
+                'command': 'endsong', 'room': {'metadata': {
+                    'current_song': song}}, 'success': True}
+        elif kind == 'users':
+            self.users.update(message[1])
+        elif kind == 'sync':
+            state = dict(message[1])
+            self.users.set_state(state.pop('users'))
+            self.__dict__.update(state)
+        if kind not in ('event', 'response'):
+            return
+        for callback in callbacks:
+            try:
+                if callback:
+                    callback(message[2])
+            except:  # Handle all exceptions -- pylint: disable-msg=W0702
+                traceback.print_exc()
+
+    def is_admin(self, item):
+        """item can be either the user_id, or a dictionary from a message."""
+        if isinstance(item, dict):
+            item = item['userid' if item['command'] == 'speak'
+                        else 'senderid']
+        return item in self.admin_ids
+
+    def is_moderator(self, item):
+        """item can be either the user_id, or a dictionary from a message."""
+        if isinstance(item, dict):
+            item = item['userid' if item['command'] == 'speak'
+                        else 'senderid']
+        return item in self.moderator_ids
+
+    def pm(self, message, user_id, bulk=False):
+        """Have the bot queue a private message to user_id."""
+        self.send(('bot', 'pm', (message, user_id, bulk)))
+
+    def reply(self, message, data, bulk=False):
+        """Reply to a command on the same stream (pm/room chat) as invoked."""
+        if data['command'] == 'speak':
+            self.speak(message, bulk)
+        elif data['command'] == 'pmmed':
+            self.pm(message, data['senderid'], bulk)
+        else:
+            raise Exception('Unrecognized command type `{0}`'
+                            .format(data['command']))
+
+    def roles(self, user_id):
+        """Return an (is_admin, is_moderator) tuple for the user."""
+        return user_id in self.admin_ids, user_id in self.moderator_ids
+
+    def room_directory(self):
+        """Return a directory of rooms crawled through the bot."""
+        if self._directory is None:
+            self._directory = RoomDirectory(self.api)
+        return self._directory
+
+    def schedule(self, min_delay, callback, *args, **kwargs):
+        """Schedule an event to occur at least min_delay seconds in the future.
+
+        Return the Job handle."""
+        return self.scheduler.schedule(min_delay, callback, args, kwargs)
+
+    def schedule_every(self, interval, callback, *args, **kwargs):
+        """Schedule an event to occur every interval seconds."""
+        return self.scheduler.schedule(interval, callback, args, kwargs,
+                                       interval=interval)
+
+    def send(self, message):
+        """Send a message to the bot."""
+        self._conn.send(message)
+
+    def speak(self, message, bulk=False):
+        """Have the bot queue a message to its current room."""
+        self.send(('bot', 'speak', (message, bulk)))
+
+
+def _run_plugin(conn, plugin_name, attempt_reload, state, room):
+    """Load the plugin and handle the bot's messages until told to stop.
+
+    Interrupts are left to the bot, which stops the process as it unloads the
+    plugin.
+
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot = RemoteBot(conn, state, room)
+    plugin_class = find_plugin(plugin_name, attempt_reload)
+    if plugin_class is None:
+        sys.exit(1)
+    plugin_class.NAME = plugin_name
+    with bot.lock:
+        plugin = plugin_class(bot)
+    commands = {}
+    if isinstance(plugin, CommandPlugin):
+        for command, function_name in plugin.COMMANDS.items():
+            descriptor = CommandDescriptor(command,
+                                           getattr(plugin, function_name))
+            commands[command] = (function_name, descriptor.arity,
+                                 descriptor.permission, descriptor.help)
+    bot.send(('ready', commands))
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'stop':
+                break
+            with bot.lock:
+                if message[0] != 'command':
+                    bot.handle(message)
+                    continue
+                try:
+                    getattr(plugin, message[1])(message[2], message[3])
+                except:  # Handle all exceptions -- pylint: disable-msg=W0702
+                    traceback.print_exc()
+    except (EOFError, IOError):
+        pass
+    with bot.lock:
+        plugin.cleanup()
+
+
+class RemotePlugin(CommandPlugin):
+
+    """Stands in for a plugin that runs in a process of its own.
+
+    The process is restarted when it exits, after BACKOFF_MIN seconds doubled
+    for each crash in a row, up to BACKOFF_MAX. A process that ran for
+    STABLE_TIME seconds resets the backoff. The plugin's commands are those it
+    reported when it was first loaded.
+
+    """
+
+    BACKOFF_MAX = 300
+    BACKOFF_MIN = 1
+    STABLE_TIME = 120
+    START_TIMEOUT = 30
+
+    def __init__(self, bot, plugin_name, attempt_reload=False):
+        """Start the plugin's process and wait for its commands.
+
+        Raise PluginException if the plugin does not start.
+
+        """
+        self.NAME = plugin_name  # pylint: disable-msg=C0103
+        # CommandPlugin requires COMMANDS, which the process has yet to report
+        Plugin.__init__(self, bot)  # pylint: disable-msg=W0233
+        self.COMMANDS = {}  # pylint: disable-msg=C0103
+        self.failures = 0
+        self.process = None
+        self.restarts = 0
+        self._conn = None
+        self._forwarded = set()  # The signals the plugin registered for
+        self._room = None  # The result of _room last sent to the process
+        self._send_lock = threading.Lock()
+        self._start_time = None
+        self._stopped = False
+        for event in UserRegistry.EVENTS:
+            self.register(event, self._update)
+        for event in ('roomChanged', 'users_reconciled'):
+            self.register(event, self._sync)
+        self._start(attempt_reload)
+        try:
+            commands, backlog = self._wait_ready()
+        except PluginException:
+            self.cleanup()
+            raise
+        for command, (function_name, arity, permission, help_text) \
+                in commands.items():
+            attribute = 'remote_{0}'.format(function_name)
+            setattr(self, attribute, types.MethodType(
+                _forwarder(function_name, arity, permission, help_text),
+                self, type(self)))
+            self.COMMANDS[command] = attribute
+        self._listen(backlog)
+
+    def _call(self, call_id, method, args, kwargs, timeout):
+        """Make an api call for the plugin's process."""
+        if method.startswith('_') or method in RESERVED \
+                or not callable(getattr(Bot, method, None)):
+            print('Plugin `{0}` cannot call `{1}`.'.format(self.NAME, method))
+            if call_id is not None:
+                self.send(('response', call_id, {
+                    'err': 'Unsupported api call.', 'success': False}))
+            return
+        if call_id is not None:
+            conn = self._conn  # Responses are not sent to a later process
+
+            def respond(data):  # pylint: disable-msg=C0111
+                self.send(('response', call_id, data), conn)
+            if 'callback' in kwargs:
+                kwargs['callback'] = respond
+            else:
+                args += (respond,)
+        self.bot.api.request_timeout = timeout
+        try:
+            getattr(self.bot.api, method)(*args, **kwargs)
+        finally:
+            self.bot.api.request_timeout = None
+
+    def _exited(self):
+        """Schedule a restart of the process, which has exited."""
+        if time.time() - self._start_time > self.STABLE_TIME:
+            self.failures = 0
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_MIN * 2 ** self.failures)
+        self.failures += 1
+        self.process.join(1)
+        print('Plugin `{0}` exited with code {1}. Restarting in {2}s.'
+              .format(self.NAME, self.process.exitcode, delay))
+        self.schedule(delay, self._restart)
+
+    def _forward(self, event):
+        """Return a callback that forwards the event to the process."""
+        def forward(data):  # pylint: disable-msg=C0111
+            self.send(('event', event, data))
+        forward.__name__ = 'forward_{0}'.format(event)
+        return forward
+
+    @display_exceptions
+    def _handle(self, message):
+        """Handle a message from the plugin's process."""
+        kind = message[0]
+        if kind == 'call':
+            self.bot.api.run_as(None, self.NAME, self._call, *message[1:])
+        elif kind == 'bot' and message[1] in ('pm', 'speak'):
+            self.bot.api.run_as(None, self.NAME, getattr(self.bot, message[1]),
+                                *message[2])
+        elif kind == 'register' and message[1] not in self._forwarded:
+            self._forwarded.add(message[1])
+            with self.bot.api.lock:
+                self.register(message[1], self._forward(message[1]))
+
+    def _listen(self, backlog):
+        """Handle the process's messages on a thread until it exits."""
+        conn = self._conn
+
+        def _run():
+            messages = iter(backlog)
+            try:
+                while True:
+                    self._handle(next(messages, None) or conn.recv())
+            except (EOFError, IOError):
+                pass
+            if not self._stopped and conn is self._conn:
+                self._exited()
+        thread = threading.Thread(target=_run, name='lazysusan-plugin-{0}'
+                                  .format(self.NAME))
+        thread.daemon = True
+        thread.start()
+
+    def _restart(self):
+        """Start the plugin's process again."""
+        if self._stopped:
+            return
+        self.restarts += 1
+        self._start()
+        self._listen([])
+
+    def _start(self, attempt_reload=False):
+        """Start the plugin's process."""
+        with self.bot.api.lock:
+            state = self._state()
+            self._room = _room(self.bot)
+        self._conn, child_conn = Pipe()
+        self.process = Process(
+            target=_run_plugin, args=(child_conn, self.NAME, attempt_reload,
+                                      state, self._room),
+            name='lazysusan-plugin-{0}'.format(self.NAME))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()  # So that the process exiting ends reads
+        self._start_time = time.time()
+
+    def _state(self):
+        """Return the bot's state mirrored by the process."""
+        state = dict((x, getattr(self.bot, x)) for x in STATE)
+        state['users'] = self.bot.users.get_state()
+        return state
+
+    def _sync(self, _):
+        """Send the process the bot's state after the room's users were
+        replaced."""
+        self.send(('sync', self._state()))
+
+    def _update(self, data):
+        """Send the process the part of a user event its registry uses."""
+        if 'user' in data:
+            update = {'command': data['command'], 'user': [
+                {'userid': x['userid'], 'name': x.get('name')}
+                for x in data['user']]}
+        else:
+            update = {'command': data['command'], 'userid': data['userid']}
+        self.send(('users', update))
+
+    def _wait_ready(self):
+        """Return the process's commands and the messages that preceded them.
+
+        Signal registrations are handled immediately.
+
+        """
+        backlog = []
+        deadline = time.time() + self.START_TIMEOUT
+        try:
+            while self._conn.poll(max(0, deadline - time.time())):
+                message = self._conn.recv()
+                if message[0] == 'ready':
+                    return message[1], backlog
+                elif message[0] == 'register':
+                    self._handle(message)
+                else:
+                    backlog.append(message)
+        except (EOFError, IOError):
+            pass
+        raise PluginException('Plugin `{0}` did not start.'.format(self.NAME))
+
+    def cleanup(self):
+        """Unregister all callbacks and stop the plugin's process."""
+        self._stopped = True
+        super(RemotePlugin, self).cleanup()
+        if self.process is None or not self.process.is_alive():
+            return
+        self.send(('stop',))
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def summary(self):
+        """Return a line describing the plugin's process."""
+        return 'process {0} (pid {1}): {2} restarts'.format(
+            self.NAME, self.process.pid if self.process.is_alive() else '-',
+            self.restarts)
+
+    def send(self, message, conn=None):
+        """Send a message to the plugin's process.
+
+        The bot's state is sent first when it has changed. Messages to a
+        process that has exited are discarded.
+
+        """
+        conn = conn or self._conn
+        with self._send_lock:
+            try:
+                room = _room(self.bot)
+                if room != self._room and conn is self._conn:
+                    self._room = room
+                    conn.send(('room', room))
+                conn.send(message)
+            except (EOFError, IOError):
+                pass
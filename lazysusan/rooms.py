@@ -0,0 +1,171 @@
+"""A cached directory of the rooms on turntable."""
+
+import threading
+import time
+from lazysusan.helpers import display_exceptions
+from lazysusan.names import NameIndex
+
+
+class Room(object):
+
+    """The directory entry for a single room."""
+
+    __slots__ = ('shortcut', 'room_id', 'chat_server', 'listeners')
+
+    def __init__(self, shortcut, room_id, chat_server, listeners):
+        self.shortcut = shortcut
+        self.room_id = room_id
+        self.chat_server = chat_server
+        self.listeners = listeners
+
+    def __repr__(self):
+        return '<Room {0} ({1} listeners)>'.format(self.shortcut,
+                                                   self.listeners)
+
+
+class _Crawl(object):
+
+    """The state of a single pass over the listRooms pages."""
+
+    def __init__(self, api):
+        self.api = api
+        self.count = 0
+        self.finished = False
+        self.next_skip = 0
+        self.pending = 0
+        self.rooms = {}
+        self.start_time = time.time()
+
+
+class RoomDirectory(object):
+
+    """A directory of rooms built by crawling the listRooms pages.
+
+    Several pages are requested concurrently. Rooms are listed by decreasing
+    popularity, so the crawl stops once at least MIN_ROOMS rooms have been
+    seen and rooms have fewer than MIN_LISTENERS listeners. The directory is
+    only replaced once a crawl completes, so lookups always see a complete
+    directory, and it is refreshed after `ttl` seconds.
+
+    A directory can be shared by bots that run on different threads. Each
+    crawl is made through the api of the bot that started it, and a lock
+    guards the crawl's progress and the lookups.
+
+    """
+
+    CONCURRENCY = 3
+    MIN_LISTENERS = 5
+    MIN_ROOMS = 20
+    PAGE_SIZE = 20
+    TTL = 900
+
+    def __init__(self, api, ttl=None, concurrency=None):
+        self.api = api
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.names = NameIndex()
+        self.rooms = {}  # Maps a room's shortcut to its Room
+        self.ttl = ttl or self.TTL
+        self.updated = None
+        self._crawl = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.rooms)
+
+    @property
+    def expired(self):
+        """Return True if the directory should be refreshed."""
+        return self.updated is None or time.time() - self.updated > self.ttl
+
+    @property
+    def refreshing(self):
+        """Return True while a crawl is in progress.
+
+        A crawl that has not completed within `ttl` seconds is abandoned.
+
+        """
+        return self._crawl is not None \
+            and time.time() - self._crawl.start_time < self.ttl
+
+    def _callback(self, crawl):
+        """Return the callback that handles a page of crawl."""
+        @display_exceptions
+        def _closure(data):
+            with self._lock:
+                crawl.pending -= 1
+                if crawl is not self._crawl:  # An abandoned crawl
+                    return
+                rooms = []
+                if data.get('success'):
+                    rooms = data.get('rooms') or []
+                for room, _ in rooms:
+                    crawl.count += 1
+                    listeners = room['metadata']['listeners']
+                    if listeners < self.MIN_LISTENERS \
+                            and crawl.count > self.MIN_ROOMS:
+                        crawl.finished = True
+                        break
+                    crawl.rooms[room['shortcut']] = Room(
+                        room['shortcut'], room['roomid'],
+                        tuple(room['chatserver']), listeners)
+                if len(rooms) < self.PAGE_SIZE:  # The last page or an error
+                    crawl.finished = True
+                self._fill(crawl)
+        return _closure
+
+    def _fill(self, crawl):
+        """Request pages until `concurrency` are outstanding. Hold the lock."""
+        while not crawl.finished and crawl.pending < self.concurrency:
+            crawl.pending += 1
+            crawl.api.listRooms(skip=crawl.next_skip,
+                                callback=self._callback(crawl))
+            crawl.next_skip += self.PAGE_SIZE
+        if crawl.finished and not crawl.pending:
+            self.rooms = crawl.rooms
+            self.names.update(self.rooms)
+            self.updated = time.time()
+            self._crawl = None
+
+    def find(self, query, chat_server=None):
+        """Return the shortcut query refers to, or a list of candidates.
+
+        :param chat_server: When provided, only consider rooms on that chat
+            server.
+
+        """
+        with self._lock:
+            if chat_server is None:
+                return self.names.best(query)
+            chat_server = tuple(chat_server)
+            return self.names.best(
+                query,
+                accept=lambda x: self.rooms[x].chat_server == chat_server)
+
+    def refresh(self, force=False, api=None):
+        """Begin crawling the room list if the directory has expired.
+
+        :param api: The api to crawl with, instead of the directory's own.
+
+        Return True if a crawl was started.
+
+        """
+        with self._lock:
+            if self.refreshing or not (force or self.expired):
+                return False
+            self._crawl = _Crawl(api or self.api)
+            self._fill(self._crawl)
+        return True
+
+    def shortcuts(self, chat_server=None):
+        """Return a dictionary mapping room shortcuts to room ids.
+
+        :param chat_server: When provided, only include rooms on that chat
+            server.
+
+        """
+        if chat_server is not None:
+            chat_server = tuple(chat_server)
+        with self._lock:
+            return dict((x.shortcut, x.room_id) for x in self.rooms.values()
+                        if chat_server is None
+                        or x.chat_server == chat_server)
@@ -0,0 +1,201 @@
+"""A timer thread that runs scheduled callbacks at their deadlines."""
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+def _call(callback, args, kwargs):
+    """Default dispatch function that directly invokes the callback."""
+    callback(*args, **kwargs)
+
+
+class Job(object):
+
+    """A handle to a callback that has been scheduled with a Scheduler.
+
+    The handle can be used to cancel the job, to move its deadline, or to turn
+    it into a recurring job.
+
+    """
+
+    def __init__(self, scheduler, callback, args, kwargs, dispatch=None):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.dispatch = dispatch
+        self.interval = None
+        self._entry = None  # The job's live heap entry, None when inactive
+
+    def __repr__(self):
+        if self._entry:
+            status = 'in {0:.1f}s'.format(self.deadline - time.time())
+        else:
+            status = 'inactive'
+        return '<Job {0} {1}>'.format(
+            getattr(self.callback, '__name__', self.callback), status)
+
+    @property
+    def active(self):
+        """Return True if the job is scheduled to run (again)."""
+        return self._entry is not None
+
+    @property
+    def deadline(self):
+        """Return the time the job will next run, or None if inactive."""
+        return self._entry[0] if self._entry else None
+
+    def cancel(self):
+        """Prevent the job from running (again).
+
+        Return True if the job was pending.
+
+        """
+        return self.scheduler.cancel(self)
+
+    def every(self, interval):
+        """Run the job every `interval` seconds after its next deadline.
+
+        Return the job to allow chaining with Scheduler.schedule.
+
+        """
+        self.interval = interval
+        return self
+
+    def reschedule(self, delay):
+        """Move the job's next deadline to `delay` seconds from now.
+
+        Inactive jobs are scheduled again. Return the job.
+
+        """
+        self.scheduler.reschedule(self, delay)
+        return self
+
+
+class Scheduler(object):
+
+    """Run callbacks on a dedicated thread once their deadline has passed.
+
+    Callbacks are run through the `dispatch` function, which receives the
+    callback and its arguments. Jobs may provide their own dispatch function,
+    which LazySusan uses to run callbacks while holding the lock that guards
+    the handling of its turntable events, so that a single scheduler can serve
+    several bots.
+
+    Cancelled and rescheduled jobs leave a tombstone entry in the heap that is
+    discarded when it reaches the top. When tombstones outnumber live entries
+    the heap is compacted so that many cancellations remain cheap.
+
+    """
+
+    COMPACT_MIN_SIZE = 1024
+
+    def __init__(self, dispatch=None):
+        self.dispatch = dispatch or _call
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._thread = None
+        self._tombstones = 0
+
+    def __len__(self):
+        """Return the number of active jobs."""
+        return len(self._heap) - self._tombstones
+
+    def _bury(self, job):
+        """Turn the job's heap entry into a tombstone. Hold the condition."""
+        job._entry[2] = None  # pylint: disable-msg=W0212
+        job._entry = None  # pylint: disable-msg=W0212
+        self._tombstones += 1
+        if self._tombstones > self.COMPACT_MIN_SIZE \
+                and self._tombstones * 2 > len(self._heap):
+            self._heap = [x for x in self._heap if x[2] is not None]
+            heapq.heapify(self._heap)
+            self._tombstones = 0
+
+    def _pop_due(self, now):
+        """Pop the next due job from the heap. Hold the condition.
+
+        Return a tuple (job, delay) where job is None when no job is due, and
+        delay is the time until the next deadline (None if there are no jobs).
+
+        """
+        while self._heap:
+            deadline, _, job = self._heap[0]
+            if job is None:
+                heapq.heappop(self._heap)
+                self._tombstones -= 1
+            elif deadline > now:
+                return None, deadline - now
+            elif job.interval:  # Replace the entry with the next occurrence
+                self._push(job, max(deadline + job.interval, now), True)
+                return job, 0
+            else:
+                heapq.heappop(self._heap)
+                job._entry = None  # pylint: disable-msg=W0212
+                return job, 0
+        return None, None
+
+    def _push(self, job, deadline, replace=False):
+        """Add an entry for the job to the heap. Hold the condition."""
+        entry = [deadline, next(self._sequence), job]
+        job._entry = entry  # pylint: disable-msg=W0212
+        if replace:
+            heapq.heapreplace(self._heap, entry)
+        else:
+            heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:  # The next deadline changed
+            self._condition.notify()
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run,
+                                            name='lazysusan-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """Timer thread loop that waits for and runs due jobs."""
+        while True:
+            with self._condition:
+                job, delay = self._pop_due(time.time())
+                while job is None:
+                    self._condition.wait(delay)
+                    job, delay = self._pop_due(time.time())
+            try:
+                (job.dispatch or self.dispatch)(job.callback, job.args,
+                                                job.kwargs)
+            except:  # Handle all exceptions -- pylint: disable-msg=W0702
+                traceback.print_exc()
+
+    def cancel(self, job):
+        """Cancel a job. Return True if the job was pending."""
+        with self._condition:
+            if not job.active:
+                return False
+            self._bury(job)
+        return True
+
+    def reschedule(self, job, delay):
+        """Move a job's next deadline to `delay` seconds from now."""
+        with self._condition:
+            if job.active:
+                self._bury(job)
+            self._push(job, time.time() + delay)
+
+    def schedule(self, delay, callback, args=(), kwargs=None, interval=None,
+                 dispatch=None):
+        """Schedule callback to run at least `delay` seconds from now.
+
+        When `interval` is provided, the callback is run repeatedly every
+        `interval` seconds until the returned Job is cancelled. When `dispatch`
+        is provided, it is used to run the callback instead of the scheduler's
+        dispatch function.
+
+        """
+        job = Job(self, callback, args, kwargs or {}, dispatch)
+        job.interval = interval
+        with self._condition:
+            self._push(job, time.time() + delay)
+        return job
@@ -0,0 +1,145 @@
+"""Latency statistics and sampled profiling for LazySusan handlers."""
+
+import cProfile
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# The upper bounds, in seconds, of the latency histogram buckets
+BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+          0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _format_duration(seconds):
+    """Return a short human readable version of seconds."""
+    if seconds < 1:
+        return '{0:.1f}ms'.format(seconds * 1000)
+    return '{0:.2f}s'.format(seconds)
+
+
+class Histogram(object):
+
+    """Call counts and a fixed-bucket latency histogram for a single key."""
+
+    __slots__ = ('buckets', 'count', 'max', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)  # The last bucket is unbounded
+        self.count = 0
+        self.max = 0
+        self.total = 0
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket containing the percentile.
+
+        The maximum is returned for percentiles in the unbounded bucket.
+
+        """
+        remaining = self.count * percent / 100.0
+        for index, count in enumerate(self.buckets[:-1]):
+            remaining -= count
+            if remaining <= 0:
+                return min(BOUNDS[index], self.max)
+        return self.max
+
+    def record(self, elapsed):
+        """Add a call that took elapsed seconds."""
+        self.buckets[bisect_left(BOUNDS, elapsed)] += 1
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+
+class Stats(object):
+
+    """Histograms for the events, plugins, commands and jobs LazySusan runs.
+
+    Keys are (kind, name) tuples such as ('event', 'speak'),
+    ('plugin', 'botdj.Playlist') and ('command', '/pllist').
+
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.start_time = time.time()
+        self._lock = threading.Lock()  # Plugins record from several threads
+
+    def record(self, keys, elapsed):
+        """Record a call that took elapsed seconds under each key."""
+        with self._lock:
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.record(elapsed)
+
+    def summary(self, count=5, kind=None):
+        """Return lines describing the keys with the most total time.
+
+        :param kind: When provided, only consider keys of that kind.
+
+        """
+        with self._lock:
+            items = [(histogram.total, key, histogram) for key, histogram
+                     in self.histograms.items() if kind in (None, key[0])]
+        items.sort(reverse=True)
+        lines = []
+        for total, (key_kind, name), histogram in items[:count]:
+            lines.append('{0} {1}: {2} calls, {3} total, p95 {4}, max {5}'
+                         .format(key_kind, name, histogram.count,
+                                 _format_duration(total),
+                                 _format_duration(histogram.percentile(95)),
+                                 _format_duration(histogram.max)))
+        return lines
+
+    def wrap(self, callback, *keys):
+        """Return a version of callback that records its latency under keys."""
+        @wraps(callback)
+        def wrapper(*args, **kwargs):  # pylint: disable-msg=C0111
+            start = time.time()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.record(keys, time.time() - start)
+        return wrapper
+
+
+class SampledProfiler(object):
+
+    """Profile a sample of the calls made through `call`.
+
+    Calls are profiled during the first DURATION seconds of every INTERVAL
+    seconds, and the accumulated statistics are written to `path` (in the
+    format read by the pstats module) at most once every INTERVAL seconds.
+    The profiler only observes the thread making the call, so every call must
+    be made while holding the same lock.
+
+    """
+
+    DURATION = 6
+    INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.samples = 0
+        self._dumped = time.time()
+
+    def call(self, function, *args, **kwargs):
+        """Call function, profiling the call if it falls in a sample window."""
+        now = time.time()
+        if now % self.INTERVAL >= self.DURATION:
+            return function(*args, **kwargs)
+        self.samples += 1
+        try:
+            return self.profile.runcall(function, *args, **kwargs)
+        finally:
+            if now - self._dumped >= self.INTERVAL:
+                self.dump()
+
+    def dump(self):
+        """Write the statistics collected so far to `path`."""
+        self.profile.dump_stats(self.path)
+        self._dumped = time.time()
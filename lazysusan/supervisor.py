@@ -0,0 +1,294 @@
+"""Spread bots across a pool of worker processes."""
+
+from __future__ import print_function
+import resource
+import sys
+import time
+import traceback
+from multiprocessing import Pipe, Process
+
+
+def _usage():
+    """Return the CPU seconds used and the peak memory (MB) of the process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+
+def _run_worker(conn, host_class, host_options, inherited=()):
+    """Host the bots the supervisor assigns until told to stop.
+
+    Bots are (section, room_id) tuples. The worker handles `add` and `remove`
+    messages, and reports the number of messages each bot has received along
+    with its own resource usage every METRICS_INTERVAL seconds. It also stops
+    when its pipe to the supervisor closes.
+
+    :param inherited: The supervisor's ends of the workers' pipes, which are
+        closed so that only the supervisor keeps them open.
+
+    """
+    for other_conn in inherited:
+        other_conn.close()
+    host = host_class()
+    host.start(block=False)
+    bots = {}
+    try:
+        while True:
+            if conn.poll(Supervisor.METRICS_INTERVAL):
+                action, spec = conn.recv()
+                if action == 'stop':
+                    break
+                elif action == 'add':
+                    try:
+                        bots[spec] = host.add(
+                            spec[0], room_ids=[spec[1]], **host_options)[0]
+                    except Exception:  # pylint: disable-msg=W0703
+                        traceback.print_exc()
+                elif action == 'remove' and spec in bots:
+                    host.remove(bots.pop(spec))
+            cpu, memory = _usage()
+            conn.send(('metrics', {
+                'bots': dict((x, bot.api.received)
+                             for x, bot in bots.items()),
+                'cpu': cpu, 'memory': memory, 'time': time.time()}))
+    except (EOFError, IOError, KeyboardInterrupt):
+        pass
+    for bot in list(bots.values()):
+        host.remove(bot)
+
+
+class Worker(object):
+
+    """The supervisor's view of a worker process.
+
+    Event rates are smoothed so that short bursts, such as the flurry of
+    messages when a bot joins its room, do not trigger rebalancing.
+
+    """
+
+    SMOOTHING = 0.2  # The weight of the latest sample
+
+    def __init__(self, index):
+        self.backoff_until = 0
+        self.bots = set()  # The (section, room_id) specs assigned to it
+        self.conn = None
+        self.cpu_percent = 0
+        self.failures = 0
+        self.index = index
+        self.metrics = None
+        self.process = None
+        self.rates = {}  # Maps each spec to its events per second
+        self.restarts = 0
+        self.start_time = None
+
+    @property
+    def load(self):
+        """Return the total event rate of the worker's bots."""
+        return sum(self.rates.get(x, 0) for x in self.bots)
+
+    def record(self, metrics):
+        """Update the rates from a worker's metrics message."""
+        previous = self.metrics
+        self.metrics = metrics
+        if not previous or metrics['time'] <= previous['time']:
+            return
+        elapsed = metrics['time'] - previous['time']
+        for spec, count in metrics['bots'].items():
+            before = previous['bots'].get(spec)
+            if before is None or count < before:
+                continue
+            rate = (count - before) / elapsed
+            if spec in self.rates:
+                rate = self.rates[spec] + self.SMOOTHING * (
+                    rate - self.rates[spec])
+            self.rates[spec] = rate
+        self.cpu_percent = 100 * (metrics['cpu'] - previous['cpu']) / elapsed
+
+
+class Supervisor(object):
+
+    """Run bots in a pool of worker processes.
+
+    Each worker hosts its share of the bots with a Host. Crashed workers are
+    restarted with exponential backoff, and every REBALANCE_INTERVAL seconds
+    bots are moved from the busiest worker to the least busy one when the
+    measured event rates are unbalanced. A summary of every worker's metrics
+    is output every REPORT_INTERVAL seconds.
+
+    """
+
+    BACKOFF_MAX = 300
+    BACKOFF_MIN = 1
+    IMBALANCE = 1.25  # Rebalance when the busiest worker exceeds the average
+    MAX_MOVES = 2  # The most bots moved per rebalance
+    METRICS_INTERVAL = 10
+    REBALANCE_INTERVAL = 300
+    REPORT_INTERVAL = 60
+    STABLE_TIME = 120  # Workers alive for this long have their backoff reset
+
+    def __init__(self, specs, num_workers, host_class, host_options):
+        """Initialize the supervisor.
+
+        :param specs: A list of (section, room_id) tuples, one per bot.
+        :param num_workers: The number of worker processes.
+        :param host_class: The Host class each worker runs its bots with.
+        :param host_options: The keyword arguments passed to `Host.add`.
+
+        """
+        self.host_class = host_class
+        self.host_options = host_options
+        num_workers = max(min(num_workers, len(specs)), 1)
+        self.workers = [Worker(x) for x in range(num_workers)]
+        for index, spec in enumerate(specs):
+            self.workers[index % len(self.workers)].bots.add(spec)
+
+    def _drain(self, worker):
+        """Handle every message waiting from worker."""
+        try:
+            while worker.conn.poll():
+                kind, data = worker.conn.recv()
+                if kind == 'metrics':
+                    worker.record(data)
+        except (EOFError, IOError):
+            pass
+
+    def _send(self, worker, action, spec=None):
+        """Send a message to worker, ignoring workers that have died."""
+        try:
+            worker.conn.send((action, spec))
+        except (EOFError, IOError):
+            pass
+
+    def _start(self, worker):
+        """Start the worker's process and give it its bots."""
+        if worker.conn:
+            worker.conn.close()
+        worker.conn, child_conn = Pipe()
+        inherited = [x.conn for x in self.workers if x.conn]
+        worker.process = Process(
+            target=_run_worker, args=(child_conn, self.host_class,
+                                      self.host_options, inherited),
+            name='lazysusan-worker-{0}'.format(worker.index))
+        # Not a daemon, so that it can start plugin processes. A worker exits
+        # when its pipe to the supervisor closes.
+        worker.process.start()
+        child_conn.close()  # So that the worker exiting ends reads
+        worker.metrics = None
+        worker.rates = {}
+        worker.start_time = time.time()
+        for spec in sorted(worker.bots):
+            self._send(worker, 'add', spec)
+
+    def check(self):
+        """Restart workers that have exited once their backoff has passed."""
+        now = time.time()
+        for worker in self.workers:
+            if worker.process.is_alive():
+                if now - worker.start_time > self.STABLE_TIME:
+                    worker.failures = 0
+                continue
+            if not worker.backoff_until:
+                delay = min(self.BACKOFF_MAX,
+                            self.BACKOFF_MIN * 2 ** worker.failures)
+                print('Worker {0} exited with code {1}. Restarting in {2}s.'
+                      .format(worker.index, worker.process.exitcode, delay))
+                worker.backoff_until = now + delay
+                worker.failures += 1
+            elif now >= worker.backoff_until:
+                worker.backoff_until = 0
+                worker.restarts += 1
+                self._start(worker)
+
+    def rebalance(self):
+        """Move bots from the busiest worker to the least busy one.
+
+        Only workers that have been running for REBALANCE_INTERVAL seconds
+        are considered, so that their rates have settled. Return the number
+        of bots moved.
+
+        """
+        now = time.time()
+        workers = [x for x in self.workers if x.process.is_alive()
+                   and now - x.start_time >= self.REBALANCE_INTERVAL]
+        if len(workers) < 2:
+            return 0
+        moved = 0
+        source = None
+        while moved < self.MAX_MOVES:
+            average = sum(x.load for x in workers) / len(workers)
+            busiest = max(workers, key=lambda x: x.load)
+            idlest = min(workers, key=lambda x: x.load)
+            gap = busiest.load - idlest.load
+            if busiest.load <= average * self.IMBALANCE \
+                    or len(busiest.bots) < 2 \
+                    or busiest is not (source or busiest):
+                break
+            source = busiest
+            # The move that brings the two workers closest to an even split
+            spec = min(busiest.bots,
+                       key=lambda x: abs(busiest.rates.get(x, 0) - gap / 2))
+            rate = busiest.rates.get(spec, 0)
+            if rate >= gap:  # Moving would not help
+                break
+            busiest.bots.remove(spec)
+            self._send(busiest, 'remove', spec)
+            idlest.bots.add(spec)
+            self._send(idlest, 'add', spec)
+            idlest.rates[spec] = busiest.rates.pop(spec, 0)
+            print('Moved {0} ({1:.1f} events/s) from worker {2} to worker {3}.'
+                  .format('/'.join(spec), rate, busiest.index, idlest.index))
+            moved += 1
+        return moved
+
+    def report(self):
+        """Output every worker's metrics, followed by the totals."""
+        total_bots = total_rate = 0
+        for worker in self.workers:
+            memory = worker.metrics['memory'] if worker.metrics else 0
+            print('worker {0} (pid {1}): {2} bots, {3:.1f} events/s, {4:.0f}% '
+                  'cpu, {5:.1f} MB, {6} restarts'.format(
+                      worker.index, worker.process.pid, len(worker.bots),
+                      worker.load, worker.cpu_percent, memory,
+                      worker.restarts))
+            for spec in sorted(worker.bots):
+                print('    {0}: {1:.1f} events/s'.format(
+                    '/'.join(spec), worker.rates.get(spec, 0)))
+            total_bots += len(worker.bots)
+            total_rate += worker.load
+        print('total: {0} bots, {1:.1f} events/s'
+              .format(total_bots, total_rate))
+        sys.stdout.flush()
+
+    def run(self):
+        """Supervise the workers until interrupted."""
+        for worker in self.workers:
+            self._start(worker)
+        next_rebalance = time.time() + self.REBALANCE_INTERVAL
+        next_report = time.time() + self.REPORT_INTERVAL
+        try:
+            while True:
+                time.sleep(1)
+                for worker in self.workers:
+                    self._drain(worker)
+                self.check()
+                now = time.time()
+                if now >= next_rebalance:
+                    self.rebalance()
+                    next_rebalance = now + self.REBALANCE_INTERVAL
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.REPORT_INTERVAL
+        except KeyboardInterrupt:
+            print('Interrupt received.')
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Ask every worker to stop, and terminate those that do not."""
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                self._send(worker, 'stop')
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
@@ -0,0 +1,177 @@
+"""Generator based coroutines driven by turntable api callbacks.
+
+A coroutine is a generator function decorated with `coroutine`. It yields a
+Future (such as the one returned by `BotApi.request`) to wait for its result,
+or a list of futures to wait for all of them at once, which lets independent
+requests overlap their round trips:
+
+    @coroutine
+    def example(self):
+        room, playlists = yield [self.bot.api.request('roomInfo'),
+                                 self.bot.api.request('playlistListAll')]
+        raise Return(len(playlists['list']))
+
+There is no event loop: a coroutine runs until its first yield when called
+and is resumed by whichever callback completes the future it is waiting on,
+so it runs wherever that callback would have: on the plugin's queue, or on the
+websocket or scheduler thread holding the api lock.
+
+"""
+
+import sys
+import traceback
+from functools import wraps
+from types import GeneratorType
+
+
+class Return(Exception):
+
+    """Raised by a coroutine to finish with a value."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class Future(object):
+
+    """The result of an operation that completes later."""
+
+    def __init__(self):
+        self._callbacks = []
+        self._exc_info = None
+        self._result = None
+        self.finished = False
+
+    def _finish(self):
+        """Mark the future as finished and run its callbacks."""
+        self.finished = True
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback with this future once it has finished."""
+        if self.finished:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def exc_info(self):
+        """Return the exception info the future failed with, or None."""
+        return self._exc_info
+
+    def result(self):
+        """Return the result of the future, or raise its exception."""
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_exc_info(self, exc_info):
+        """Fail the future with the exception of a sys.exc_info() tuple."""
+        self._exc_info = exc_info
+        self._finish()
+
+    def set_result(self, result):
+        """Finish the future with result.
+
+        The method can be passed as the callback of any api request.
+
+        """
+        self._result = result
+        self._finish()
+
+
+class Task(Future):
+
+    """A future for the result of a running coroutine."""
+
+    def __init__(self, generator):
+        super(Task, self).__init__()
+        self._generator = generator
+        self._waited = False  # Whether a callback will handle the outcome
+        self._step(None, None)
+
+    def _resume(self, future):
+        """Continue the coroutine with the outcome of future."""
+        self._step(future._result, future._exc_info)
+        if self._exc_info and not self._waited:
+            # Nothing is waiting on this task, so report the failure here
+            traceback.print_exception(*self._exc_info)
+
+    def _step(self, value, exc_info):
+        """Run the coroutine until it waits on an unfinished future."""
+        while True:
+            try:
+                if exc_info:
+                    yielded = self._generator.throw(*exc_info)
+                else:
+                    yielded = self._generator.send(value)
+            except Return as exc:
+                return self.set_result(exc.value)
+            except StopIteration:
+                return self.set_result(None)
+            except Exception:  # pylint: disable-msg=W0703
+                return self.set_exc_info(sys.exc_info())
+            if isinstance(yielded, list):
+                yielded = gather(*yielded)
+            if not isinstance(yielded, Future):
+                value, exc_info = None, (TypeError, TypeError(
+                    'Coroutines must yield futures, not {0!r}'
+                    .format(yielded)), None)
+            elif yielded.finished:
+                value, exc_info = yielded._result, yielded._exc_info
+            else:
+                yielded.add_done_callback(self._resume)
+                return
+
+    def add_done_callback(self, callback):
+        self._waited = True
+        super(Task, self).add_done_callback(callback)
+
+
+def coroutine(function):
+    """Decorate a generator function so that calling it returns a Task.
+
+    An exception raised before the coroutine first waits propagates to the
+    caller, as it would from an ordinary function. Later exceptions fail the
+    task, and are printed when nothing is waiting on the task.
+
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):  # pylint: disable-msg=C0111
+        result = function(*args, **kwargs)
+        if not isinstance(result, GeneratorType):
+            future = Future()
+            future.set_result(result)
+            return future
+        task = Task(result)
+        if task._exc_info:
+            task.result()
+        return task
+    return wrapper
+
+
+def gather(*futures):
+    """Return a future for the list of results of futures.
+
+    The future fails as soon as any of futures fails.
+
+    """
+    result = Future()
+    remaining = [len(futures)]
+
+    def _callback(future):
+        if result.finished:
+            return
+        if future._exc_info:
+            return result.set_exc_info(future._exc_info)
+        remaining[0] -= 1
+        if not remaining[0]:
+            result.set_result([x._result for x in futures])
+
+    if not futures:
+        result.set_result([])
+    for future in futures:
+        future.add_done_callback(_callback)
+    return result
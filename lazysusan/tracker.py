@@ -0,0 +1,208 @@
+"""Deadlines, retries and per-plugin limits for turntable api requests."""
+
+import time
+import traceback
+from collections import deque
+from weakref import WeakSet
+
+# Requests that can safely be sent again when turntable does not respond.
+# user.modify and user.set_avatar change state, but they set fields to the
+# values in the request rather than adjusting them, so a repeat is harmless.
+IDEMPOTENT = frozenset(('playlist.all', 'playlist.list_all', 'playlist.switch',
+                        'room.directory_graph', 'room.info',
+                        'room.list_rooms', 'room.now', 'user.get_fan_of',
+                        'user.get_fans', 'user.get_favorites', 'user.get_id',
+                        'user.get_profile', 'user.info', 'user.modify',
+                        'user.set_avatar'))
+# Requests whose callbacks ttapi replaces, which are sent without tracking
+UNTRACKED = frozenset(('room.register',))
+
+
+class _Request(object):
+
+    """A request that is waiting for a slot or for turntable's response."""
+
+    __slots__ = ('attempts', 'callback', 'deadline', 'owner', 'rq',
+                 'start_time', 'timeout')
+
+    def __init__(self, rq, callback, owner, timeout):
+        self.attempts = 0
+        self.callback = callback
+        self.deadline = None
+        self.owner = owner
+        self.rq = rq
+        self.start_time = time.time()
+        self.timeout = timeout
+
+
+class RequestTracker(object):
+
+    """Track every api request until turntable responds to it.
+
+    A request that is not answered within its timeout is withdrawn from
+    ttapi. Requests in IDEMPOTENT are sent again up to `retries` times,
+    waiting BACKOFF seconds (doubled for each attempt) first; other requests
+    have their callback called with a failed response, so that the flows
+    waiting on them finish and nothing they hold stays in memory.
+
+    Each plugin may have `max_in_flight` requests outstanding. Further
+    requests are queued and sent as the plugin's earlier requests complete.
+    Requests made by the core are never queued.
+
+    The tracker is not thread safe; it relies on the api lock held by the
+    core handlers, the scheduled callbacks and `BotApi._send`.
+
+    """
+
+    BACKOFF = 1
+    MAX_IN_FLIGHT = 16
+    RETRIES = 2
+    TIMEOUT = 30
+
+    def __init__(self, api, send, schedule, timeout=None, max_in_flight=None,
+                 retries=None):
+        """Initialize the tracker.
+
+        :param api: The ttapi Bot whose requests are tracked.
+        :param send: The function that sends a request, taking the request and
+            its callback, such as ttapi's own `Bot._send`.
+        :param schedule: The function used to schedule expiry and retries.
+        :param timeout: The default number of seconds to wait for a response.
+        :param max_in_flight: The number of requests each plugin can have
+            outstanding at once.
+        :param retries: The number of times idempotent requests are retried.
+
+        """
+        self.api = api
+        self.max_in_flight = int(max_in_flight or self.MAX_IN_FLIGHT)
+        self.retries = self.RETRIES if retries is None else int(retries)
+        self.timeout = float(timeout or self.TIMEOUT)
+        self.expired = 0
+        self.pending = {}  # Maps a msgid to its _Request
+        self.queued = {}  # Maps a plugin to its deque of waiting _Requests
+        self.retried = 0
+        self.slots = {}  # Maps a plugin to its number of unfinished requests
+        self._expire_job = None
+        self._retry_jobs = WeakSet()
+        self._schedule = schedule
+        self._send = send
+
+    def __len__(self):
+        """Return the number of requests waiting for a response."""
+        return len(self.pending)
+
+    def _release(self, request):
+        """Free the owner's slot and send its next queued request."""
+        if request.owner is None:
+            return
+        queue = self.queued.get(request.owner)
+        if queue:
+            next_request = queue.popleft()
+            if not queue:
+                del self.queued[request.owner]
+            self._transmit(next_request)
+        elif self.slots[request.owner] > 1:
+            self.slots[request.owner] -= 1
+        else:
+            del self.slots[request.owner]
+
+    def _respond(self, request, data):
+        """Handle turntable's response to request."""
+        if self.pending.pop(request.rq['msgid'], None) is not request:
+            return  # The request has already expired
+        self._release(request)
+        if request.callback:
+            request.callback(data)
+
+    def _transmit(self, request):
+        """Send request to turntable."""
+        request.attempts += 1
+        request.deadline = time.time() + request.timeout
+        self._send(request.rq, lambda data: self._respond(request, data))
+        self.pending[request.rq['msgid']] = request
+        self._wake(request.timeout)
+
+    def _wake(self, delay):
+        """Make sure expire runs within delay seconds."""
+        job = self._expire_job
+        if job is None or not job.active:
+            self._expire_job = self._schedule(delay, self.expire)
+        elif job.deadline > time.time() + delay:
+            job.reschedule(delay)
+
+    def clear(self):
+        """Forget every request without calling its callback."""
+        for job in list(self._retry_jobs) + [self._expire_job]:
+            if job is not None:
+                job.cancel()
+        self.pending.clear()
+        self.queued.clear()
+        self.slots.clear()
+
+    def expire(self):
+        """Retry or fail the requests whose deadline has passed."""
+        now = time.time()
+        expired = [x for x in self.pending.values() if x.deadline <= now]
+        for request in expired:
+            msgid = request.rq['msgid']
+            del self.pending[msgid]
+            commands = self.api._cmds  # pylint: disable-msg=W0212
+            for index, command in enumerate(commands):
+                if command[0] == msgid:
+                    del commands[index]
+                    break
+            else:  # ttapi no longer knows of the request
+                self._release(request)
+                continue
+            if request.rq['api'] in IDEMPOTENT \
+                    and request.attempts <= self.retries:
+                self.retried += 1
+                self._retry_jobs.add(self._schedule(
+                    self.BACKOFF * 2 ** (request.attempts - 1),
+                    self._transmit, request))
+                continue
+            self.expired += 1
+            self._release(request)
+            if not request.callback:
+                continue
+            try:
+                request.callback({'err': 'Turntable did not respond.',
+                                  'msgid': msgid, 'success': False})
+            except:  # Handle all exceptions -- pylint: disable-msg=W0702
+                traceback.print_exc()
+        if self.pending:
+            self._wake(max(0, min(x.deadline for x in self.pending.values())
+                           - now))
+
+    def oldest(self):
+        """Return the age in seconds of the oldest unanswered request."""
+        if not self.pending:
+            return 0
+        return time.time() - min(x.start_time for x in self.pending.values())
+
+    def send(self, rq, callback, owner=None, timeout=None):
+        """Send rq, or queue it while owner has too many requests in flight.
+
+        :param owner: The name of the plugin making the request, or None for
+            the core.
+        :param timeout: The seconds to wait for a response, instead of the
+            tracker's default.
+
+        """
+        if rq['api'] in UNTRACKED:
+            return self._send(rq, callback)
+        request = _Request(rq, callback, owner, timeout or self.timeout)
+        if owner is not None:
+            if self.slots.get(owner, 0) >= self.max_in_flight:
+                self.queued.setdefault(owner, deque()).append(request)
+                return
+            self.slots[owner] = self.slots.get(owner, 0) + 1
+        self._transmit(request)
+
+    def summary(self):
+        """Return a line describing the requests being tracked."""
+        return ('{0} requests in flight (oldest {1:.1f}s), {2} queued, '
+                '{3} retried, {4} expired'.format(
+                    len(self.pending), self.oldest(),
+                    sum(len(x) for x in self.queued.values()), self.retried,
+                    self.expired))
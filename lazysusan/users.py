@@ -0,0 +1,168 @@
+"""The users in the bot's room, indexed by id and by name."""
+
+import time
+
+
+class User(object):
+
+    """A user in the room.
+
+    `dj` and `moderator` reflect the room's current state; `joined` is the
+    time the bot first saw the user in the room.
+
+    """
+
+    __slots__ = ('dj', 'joined', 'moderator', 'name', 'user_id')
+
+    def __init__(self, user_id, name, joined=None, dj=False, moderator=False):
+        self.dj = dj
+        self.joined = joined or time.time()
+        self.moderator = moderator
+        self.name = name
+        self.user_id = user_id
+
+    def __repr__(self):
+        return '<User {0} ({1})>'.format(self.name, self.user_id)
+
+
+class UserRegistry(object):
+
+    """The users in the bot's room, along with its djs and moderators.
+
+    Users are looked up by id, or by case-insensitive name. The registry is
+    kept up to date from turntable's events by `update`, which tolerates
+    events that repeat what is already known or refer to unknown users, and
+    is corrected in a single pass by `reconcile` from a full room listing.
+
+    `dj_ids` and `moderator_ids` are kept independently of the users, as
+    turntable lists djs and moderators that are not in the room.
+
+    """
+
+    EVENTS = frozenset(('add_dj', 'deregistered', 'new_moderator',
+                        'registered', 'rem_dj', 'rem_moderator'))
+
+    def __init__(self):
+        self.dj_ids = set()
+        self.listener_ids = set()
+        self.moderator_ids = set()
+        self._by_id = {}
+        self._by_name = {}  # Maps a lowercase name to the latest such User
+
+    def __contains__(self, user_id):
+        return user_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _index_name(self, user):
+        """Make the user the one found by its name."""
+        if user.name:
+            self._by_name[user.name.lower()] = user
+
+    def _unindex_name(self, user):
+        """Stop finding the user by its name."""
+        if user.name and self._by_name.get(user.name.lower()) is user:
+            del self._by_name[user.name.lower()]
+
+    def add(self, user_id, name, joined=None):
+        """Add the user to the room, or update its name, and return it."""
+        user = self._by_id.get(user_id)
+        if user is None:
+            user = self._by_id[user_id] = User(
+                user_id, name, joined, user_id in self.dj_ids,
+                user_id in self.moderator_ids)
+            self.listener_ids.add(user_id)
+        elif user.name != name:
+            self._unindex_name(user)
+            user.name = name
+        self._index_name(user)
+        return user
+
+    def find(self, name):
+        """Return the user with the name, ignoring case, or None."""
+        return self._by_name.get(name.strip().lower())
+
+    def get(self, user_id):
+        """Return the user with the id, or None."""
+        return self._by_id.get(user_id)
+
+    def get_state(self):
+        """Return the registry's contents as lists, for set_state."""
+        return {'dj_ids': list(self.dj_ids),
+                'moderator_ids': list(self.moderator_ids),
+                'users': [(x.user_id, x.name, x.joined) for x in self]}
+
+    def reconcile(self, users, dj_ids, moderator_ids):
+        """Replace the registry's contents with a full room listing.
+
+        Users that remain in the room keep their records and join times.
+
+        :param users: An iterable of (user_id, name) tuples.
+
+        """
+        self.dj_ids = set(dj_ids)
+        self.moderator_ids = set(moderator_ids)
+        previous, self._by_id = self._by_id, {}
+        self._by_name = {}
+        for user_id, name in users:
+            user = previous.get(user_id)
+            if user is None:
+                user = User(user_id, name)
+            user.name = name
+            user.dj = user_id in self.dj_ids
+            user.moderator = user_id in self.moderator_ids
+            self._by_id[user_id] = user
+            self._index_name(user)
+        self.listener_ids = set(self._by_id)
+
+    def remove(self, user_id):
+        """Remove the user from the room and return it, or None."""
+        user = self._by_id.pop(user_id, None)
+        if user is not None:
+            self.listener_ids.discard(user_id)
+            self._unindex_name(user)
+        return user
+
+    def set_dj(self, user_id, dj):
+        """Record whether the user is a dj."""
+        if dj:
+            self.dj_ids.add(user_id)
+        else:
+            self.dj_ids.discard(user_id)
+        if user_id in self._by_id:
+            self._by_id[user_id].dj = dj
+
+    def set_moderator(self, user_id, moderator):
+        """Record whether the user is a moderator."""
+        if moderator:
+            self.moderator_ids.add(user_id)
+        else:
+            self.moderator_ids.discard(user_id)
+        if user_id in self._by_id:
+            self._by_id[user_id].moderator = moderator
+
+    def set_state(self, state):
+        """Restore the registry's contents from get_state."""
+        self.reconcile([x[:2] for x in state['users']], state['dj_ids'],
+                       state['moderator_ids'])
+        for user_id, _, joined in state['users']:
+            self._by_id[user_id].joined = joined
+
+    def update(self, data):
+        """Apply one of the turntable events in EVENTS."""
+        command = data['command']
+        if command == 'registered':
+            for user in data['user']:
+                self.add(user['userid'], user.get('name'))
+        elif command == 'deregistered':
+            for user in data['user']:
+                self.remove(user['userid'])
+        elif command in ('add_dj', 'rem_dj'):
+            for user in data['user']:
+                self.set_dj(user['userid'], command == 'add_dj')
+        elif command in ('new_moderator', 'rem_moderator'):
+            self.set_moderator(data['userid'], command == 'new_moderator')
@@ -0,0 +1,98 @@
+"""Tests for lazysusan.flood."""
+
+import unittest
+from lazysusan.flood import FloodControl, parse_limit
+
+
+def age(flood, key, seconds):
+    """Pretend that the bucket for key was last refilled seconds earlier."""
+    flood.buckets[key][1] -= seconds
+
+
+class ParseLimitTest(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual((5, 0.5), parse_limit('5/10'))
+        self.assertEqual((1, 4.0), parse_limit('1/0.25'))
+
+    def test_invalid(self):
+        for value in ('', '5', '5/', '/10', 'a/b', '5/10/2', '0/10', '5/0',
+                      '-1/10', '5/-10', '2.5/10'):
+            self.assertIsNone(parse_limit(value), value)
+
+
+class FloodControlTest(unittest.TestCase):
+
+    def test_burst_then_drop(self):
+        flood = FloodControl('3/30')
+        for _ in range(3):
+            self.assertTrue(flood.admit('user', 'bop'))
+        self.assertIsNone(flood.admit('user', 'bop'))
+        self.assertEqual(1, flood.dropped)
+        self.assertTrue(flood.admit('other', 'bop'))
+
+    def test_refill(self):
+        flood = FloodControl('2/10')
+        flood.admit('user', 'bop')
+        flood.admit('user', 'bop')
+        self.assertIsNone(flood.admit('user', 'bop'))
+        age(flood, 'user', 4)  # Refills 0.8 tokens
+        self.assertIsNone(flood.admit('user', 'bop'))
+        age(flood, 'user', 1.5)
+        self.assertTrue(flood.admit('user', 'bop'))
+        self.assertIsNone(flood.admit('user', 'bop'))
+
+    def test_refill_is_capped_at_burst(self):
+        flood = FloodControl('2/10')
+        flood.admit('user', 'bop')
+        age(flood, 'user', 1000)
+        self.assertTrue(flood.admit('user', 'bop'))
+        self.assertTrue(flood.admit('user', 'bop'))
+        self.assertIsNone(flood.admit('user', 'bop'))
+
+    def test_command_limit(self):
+        flood = FloodControl('5/10', {'skip': '1/60'})
+        self.assertTrue(flood.admit('user', 'skip'))
+        self.assertIsNone(flood.admit('user', 'skip'))
+        self.assertTrue(flood.admit('user', 'bop'))
+        # The rejected skip must not have used a token from the user bucket
+        self.assertEqual(3, int(flood.buckets['user'][0]))
+
+    def test_admin_exemption(self):
+        flood = FloodControl('1/60', {'skip': '1/60'})
+        for _ in range(5):
+            self.assertTrue(flood.admit('admin', 'skip', exempt=True))
+        self.assertEqual({}, flood.buckets)
+        self.assertEqual(0, flood.dropped)
+
+    def test_max_in_flight(self):
+        flood = FloodControl('100/1', max_in_flight=2)
+        first = flood.admit('user', 'bop')
+        flood.admit('user', 'bop')
+        self.assertIsNone(flood.admit('user', 'bop'))
+        first.finished()
+        self.assertTrue(flood.admit('user', 'bop'))
+
+    def test_evict(self):
+        flood = FloodControl('2/10', {'skip': '1/60'})
+        flood.admit('user', 'skip')
+        flood.admit('other', 'bop')
+        age(flood, 'user', 10)
+        age(flood, ('user', 'skip'), 30)
+        age(flood, 'other', 1)
+        flood.evict()
+        self.assertEqual(set([('user', 'skip'), 'other']),
+                         set(flood.buckets))
+        age(flood, ('user', 'skip'), 30)
+        flood.evict()
+        self.assertEqual(['other'], list(flood.buckets))
+
+    def test_invalid_user_limit_falls_back(self):
+        flood = FloodControl('often', {'skip': 'never'})
+        self.assertEqual(parse_limit(FloodControl.USER_LIMIT),
+                         flood.user_limit)
+        self.assertEqual({}, flood.command_limits)
+
+
+if __name__ == '__main__':
+    unittest.main()
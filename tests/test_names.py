@@ -0,0 +1,69 @@
+"""Tests for lazysusan.names."""
+
+import unittest
+from lazysusan.names import NameIndex, prefix_distance
+
+
+class PrefixDistanceTest(unittest.TestCase):
+
+    def test_swap_is_a_single_edit(self):
+        self.assertEqual(1, prefix_distance('defualt', 'default', 1))
+
+    def test_distance_to_closest_prefix(self):
+        self.assertEqual(0, prefix_distance('rock', 'rockmusic', 1))
+        self.assertEqual(1, prefix_distance('rokc', 'rockmusic', 1))
+
+    def test_exceeding_limit(self):
+        self.assertEqual(2, prefix_distance('jazz', 'rockmusic', 1))
+
+
+class NameIndexTest(unittest.TestCase):
+
+    PLAYLISTS = ['rockmusic', 'jazzclub', 'default', 'local_party']
+
+    def test_small_index_finds_misspellings(self):
+        index = NameIndex(self.PLAYLISTS)
+        self.assertEqual(['rockmusic'], index.best('rockmusc'))
+        self.assertEqual(['default'], index.best('defualt'))
+        self.assertEqual(['jazzclub'], index.best('jazclub'))
+
+    def test_small_index_without_match(self):
+        self.assertEqual([], NameIndex(self.PLAYLISTS).best('zzzz'))
+
+    def test_large_index_finds_misspellings(self):
+        names = ['room_{0:04d}_{1}'.format(x, 'abcdefghij'[x % 10])
+                 for x in range(1000)] + ['indie_rock_lounge']
+        self.assertEqual(['indie_rock_lounge'],
+                         NameIndex(names).best('indie_rokc_lounge'))
+
+    def test_names_differing_in_case(self):
+        index = NameIndex(['Rock', 'rock', 'jazz'])
+        self.assertEqual(3, len(index))
+        self.assertEqual('Rock', index.best('Rock'))
+        self.assertEqual('rock', index.best('rock'))
+        self.assertEqual(['Rock', 'rock'], index.best('ROCK'))
+        self.assertEqual(['Rock', 'rock'], index.search('ro'))
+
+    def test_discard_keeps_names_differing_in_case(self):
+        index = NameIndex(['Rock', 'rock', 'jazz'])
+        index.discard('rock')
+        self.assertNotIn('rock', index)
+        self.assertIn('Rock', index)
+        self.assertEqual('Rock', index.best('rock'))
+        self.assertEqual(['Rock'], index.search('roc'))
+        index.discard('Rock')
+        self.assertEqual([], index.search('roc'))
+
+    def test_update(self):
+        index = NameIndex(['Rock', 'rock', 'jazz'])
+        index.update(['rock', 'blues'])
+        self.assertEqual(['blues', 'rock'], sorted(index))
+
+    def test_exact_and_prefix(self):
+        index = NameIndex(self.PLAYLISTS)
+        self.assertEqual('default', index.best('DEFAULT'))
+        self.assertEqual('local_party', index.best('loc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Tests for the reorder planning and BulkReorder in lazysusan.playlist."""
+
+import random
+import unittest
+from lazysusan.playlist import (BulkReorder, PlaylistMirror, _FenwickTree,
+                                longest_increasing_subsequence, plan_reorder)
+
+
+def apply_moves(items, moves):
+    """Return a copy of items after applying successive playlistReorders."""
+    items = list(items)
+    for from_index, to_index in moves:
+        items.insert(to_index, items.pop(from_index))
+    return items
+
+
+class FakeApi(object):
+
+    """Record playlistReorder requests so that tests can answer them."""
+
+    def __init__(self):
+        self.pending = []
+
+    def playlistReorder(self, playlist_name, from_index, to_index, callback):
+        self.pending.append((from_index, to_index, callback))
+
+    def respond(self, success=True):
+        """Answer the oldest outstanding request."""
+        callback = self.pending.pop(0)[2]
+        callback({'success': success, 'err': None if success else 'nope'})
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_count_before(self):
+        tree = _FenwickTree(10)
+        for slot in (0, 3, 4, 9):
+            tree.add(slot, 1)
+        self.assertEqual(0, tree.count_before(0))
+        self.assertEqual(1, tree.count_before(3))
+        self.assertEqual(3, tree.count_before(5))
+        self.assertEqual(4, tree.count_before(10))
+        tree.add(3, -1)
+        self.assertEqual(2, tree.count_before(5))
+
+
+class LongestIncreasingSubsequenceTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], longest_increasing_subsequence([]))
+
+    def test_subsequence(self):
+        sequence = [3, 1, 4, 1, 5, 9, 2, 6]
+        indexes = longest_increasing_subsequence(sequence)
+        self.assertEqual(4, len(indexes))
+        values = [sequence[x] for x in indexes]
+        self.assertEqual(sorted(set(values)), values)
+        self.assertEqual(sorted(indexes), indexes)
+
+    def test_length_matches_brute_force(self):
+        rand = random.Random(6)
+        for _ in range(200):
+            sequence = [rand.randrange(8) for _ in range(rand.randrange(9))]
+            best = 0
+            for mask in range(1 << len(sequence)):
+                values = [x for i, x in enumerate(sequence) if mask >> i & 1]
+                if all(a < b for a, b in zip(values, values[1:])):
+                    best = max(best, len(values))
+            self.assertEqual(best,
+                             len(longest_increasing_subsequence(sequence)))
+
+
+class PlanReorderTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual([], plan_reorder(['a', 'b', 'c'], ['a', 'b', 'c']))
+
+    def test_random_permutations(self):
+        rand = random.Random(42)
+        for size in list(range(1, 12)) + [50, 200]:
+            for _ in range(20):
+                current = ['song{0}'.format(x) for x in range(size)]
+                target = current[:]
+                rand.shuffle(target)
+                moves = plan_reorder(current, target)
+                self.assertEqual(target, apply_moves(current, moves))
+                positions = dict((x, i) for i, x in enumerate(target))
+                kept = longest_increasing_subsequence(
+                    [positions[x] for x in current])
+                self.assertEqual(size - len(kept), len(moves))
+
+
+class BulkReorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.current = ['song{0}'.format(x) for x in range(20)]
+        self.target = self.current[:]
+        random.Random(7).shuffle(self.target)
+        self.moves = plan_reorder(self.current, self.target)
+        self.mirror = PlaylistMirror('default', stale=False)
+        self.mirror.load([{'_id': x} for x in self.current])
+        self.api = FakeApi()
+
+    def test_reaches_target(self):
+        operation = BulkReorder(self.api, 'default', self.moves, window=3,
+                                mirror=self.mirror).start()
+        while self.api.pending:
+            self.assertTrue(len(self.api.pending) <= 3)
+            self.api.respond()
+        self.assertTrue(operation.finished)
+        self.assertIs(operation, operation.future.result())
+        self.assertEqual(len(self.moves), len(operation.succeeded))
+        self.assertEqual(self.target, self.mirror.songs)
+        self.assertFalse(self.mirror.stale)
+
+    def test_stops_after_failure(self):
+        operation = BulkReorder(self.api, 'default', self.moves, window=2,
+                                mirror=self.mirror).start()
+        self.api.respond(success=False)
+        self.api.respond()
+        self.assertEqual([], self.api.pending)
+        self.assertTrue(operation.finished)
+        self.assertEqual(1, len(operation.failed))
+        self.assertEqual(1, len(operation.succeeded))
+        self.assertTrue(self.mirror.stale)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Tests for lazysusan.scheduler."""
+
+import threading
+import time
+import unittest
+from lazysusan.scheduler import Scheduler
+
+FAR = 1000  # A delay that the timer thread never reaches during a test
+
+
+def noop():
+    pass
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.start = time.time()
+
+    def pop_due(self, offset):
+        """Return the job due `offset` seconds after the test started."""
+        with self.scheduler._condition:  # pylint: disable-msg=W0212
+            return self.scheduler._pop_due(  # pylint: disable-msg=W0212
+                self.start + offset)[0]
+
+    def test_runs_callback(self):
+        ran = threading.Event()
+        self.scheduler.schedule(0.01, ran.set)
+        self.assertTrue(ran.wait(5))
+
+    def test_cancel_before_due(self):
+        ran = threading.Event()
+        job = self.scheduler.schedule(0.05, ran.set)
+        self.assertTrue(job.cancel())
+        self.assertFalse(job.active)
+        self.assertFalse(job.cancel())
+        self.assertEqual(0, len(self.scheduler))
+        self.assertFalse(ran.wait(0.2))
+
+    def test_reschedule(self):
+        job = self.scheduler.schedule(FAR, noop)
+        job.reschedule(2 * FAR)
+        self.assertEqual(1, len(self.scheduler))
+        self.assertIsNone(self.pop_due(FAR + 1))
+        self.assertIs(job, self.pop_due(2 * FAR + 1))
+        self.assertFalse(job.active)
+        self.assertEqual(0, len(self.scheduler._heap))
+
+    def test_reschedule_inactive_job(self):
+        job = self.scheduler.schedule(FAR, noop)
+        job.cancel()
+        job.reschedule(FAR)
+        self.assertTrue(job.active)
+        self.assertIs(job, self.pop_due(FAR + 1))
+
+    def test_every(self):
+        job = self.scheduler.schedule(FAR, noop).every(10)
+        self.assertIs(job, self.pop_due(FAR + 1))
+        self.assertTrue(job.active)
+        self.assertAlmostEqual(self.start + FAR + 10, job.deadline, places=0)
+        self.assertIsNone(self.pop_due(FAR + 5))
+        self.assertIs(job, self.pop_due(FAR + 11))
+        job.cancel()
+        self.assertIsNone(self.pop_due(FAR + 100))
+
+    def test_every_skips_missed_occurrences(self):
+        job = self.scheduler.schedule(FAR, noop, interval=10)
+        self.assertIs(job, self.pop_due(FAR + 95))
+        self.assertAlmostEqual(self.start + FAR + 95, job.deadline, places=0)
+
+    def test_compaction(self):
+        self.scheduler.COMPACT_MIN_SIZE = 10
+        jobs = [self.scheduler.schedule(FAR, noop) for _ in range(30)]
+        for job in jobs[:15]:
+            job.cancel()
+        self.assertEqual(30, len(self.scheduler._heap))
+        self.assertEqual(15, len(self.scheduler))
+        jobs[15].cancel()  # Tombstones now outnumber live entries
+        self.assertEqual(14, len(self.scheduler._heap))
+        self.assertEqual(0, self.scheduler._tombstones)
+        self.assertEqual(14, len(self.scheduler))
+        self.assertTrue(all(x.active for x in jobs[16:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
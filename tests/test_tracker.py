@@ -0,0 +1,135 @@
+"""Tests for lazysusan.tracker."""
+
+import time
+import unittest
+from lazysusan.tracker import RequestTracker
+
+
+class FakeJob(object):
+
+    """A scheduled call that the test runs by hand."""
+
+    def __init__(self, delay, callback, args):
+        self.active = True
+        self.args = args
+        self.callback = callback
+        self.deadline = time.time() + delay
+        self.delay = delay
+
+    def cancel(self):
+        self.active = False
+
+    def reschedule(self, delay):
+        self.deadline = time.time() + delay
+
+    def run(self):
+        self.active = False
+        self.callback(*self.args)
+
+
+class FakeApi(object):
+
+    """The parts of a ttapi Bot that the tracker uses."""
+
+    def __init__(self):
+        self._cmds = []
+        self._msgId = 0
+        self.sent = []
+
+    def send(self, rq, callback):
+        rq['msgid'] = self._msgId
+        self._msgId += 1
+        self._cmds.append([rq['msgid'], rq, callback])
+        self.sent.append(rq['api'])
+
+    def respond(self, msgid, data):
+        for command in self._cmds:
+            if command[0] == msgid:
+                self._cmds.remove(command)
+                command[2](data)
+                return
+
+
+class RequestTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeApi()
+        self.jobs = []
+        self.tracker = RequestTracker(self.api, self.api.send, self.schedule,
+                                      timeout=10, retries=2)
+        self.responses = []
+
+    def schedule(self, delay, callback, *args):
+        job = FakeJob(delay, callback, args)
+        self.jobs.append(job)
+        return job
+
+    def expire(self):
+        """Let every deadline pass and run the expiry."""
+        for request in self.tracker.pending.values():
+            request.deadline = 0
+        self.tracker.expire()
+
+    def retry(self):
+        """Run the scheduled retries."""
+        for job in [x for x in self.jobs if x.active
+                    and x.callback != self.tracker.expire]:
+            job.run()
+
+    def test_response(self):
+        self.tracker.send({'api': 'room.info'}, self.responses.append)
+        self.api.respond(0, {'success': True})
+        self.assertEqual([{'success': True}], self.responses)
+        self.assertEqual(0, len(self.tracker))
+
+    def test_expired_request_is_withdrawn(self):
+        self.tracker.send({'api': 'room.vote'}, self.responses.append)
+        self.assertEqual(1, len(self.api._cmds))
+        self.expire()
+        self.assertEqual([], self.api._cmds)
+        self.assertEqual(0, len(self.tracker))
+        self.assertEqual(1, self.tracker.expired)
+        self.assertEqual([{'err': 'Turntable did not respond.', 'msgid': 0,
+                           'success': False}], self.responses)
+        self.api.respond(0, {'success': True})  # A late response is dropped
+        self.assertEqual(1, len(self.responses))
+
+    def test_only_idempotent_requests_are_retried(self):
+        self.tracker.send({'api': 'room.info'}, self.responses.append)
+        self.tracker.send({'api': 'room.speak'}, self.responses.append)
+        self.expire()
+        self.assertEqual(1, self.tracker.retried)
+        self.assertEqual([False], [x['success'] for x in self.responses])
+        self.assertEqual(1, self.responses[0]['msgid'])
+        self.retry()
+        self.assertEqual(['room.info', 'room.speak', 'room.info'],
+                         self.api.sent)
+        self.api.respond(2, {'success': True})
+        self.assertEqual({'success': True}, self.responses[-1])
+
+    def test_retries_are_limited(self):
+        self.tracker.send({'api': 'room.info'}, self.responses.append)
+        delays = []
+        for _ in range(2):
+            self.expire()
+            delays.append(self.jobs[-1].delay)
+            self.retry()
+        self.assertEqual([1, 2], delays)
+        self.expire()
+        self.assertEqual(3, len(self.api.sent))
+        self.assertEqual([], self.api._cmds)
+        self.assertEqual([False], [x['success'] for x in self.responses])
+
+    def test_plugin_requests_are_queued(self):
+        self.tracker.max_in_flight = 1
+        self.tracker.send({'api': 'room.info'}, None, owner='plugin')
+        self.tracker.send({'api': 'room.now'}, None, owner='plugin')
+        self.tracker.send({'api': 'user.info'}, None)
+        self.assertEqual(['room.info', 'user.info'], self.api.sent)
+        self.api.respond(0, {'success': True})
+        self.assertEqual(['room.info', 'user.info', 'room.now'],
+                         self.api.sent)
+
+
+if __name__ == '__main__':
+    unittest.main()